@@ -5,10 +5,12 @@
 # @Last Modified time: 2021-08-04 11:20:10
 
 import os                       # os library, used to read files
+import sys                      # exit code
 import argparse                 # argument parser
 import yaml                     # read parameters
 
-from src.folder import listdir_fullpath
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'src'))
+from pipeline import run_pipeline, pipeline_report, pipeline_failed
 
 def main():
     # Arguments details
@@ -23,6 +25,14 @@ def main():
                         help='File with video parameters.')
     parser.add_argument('-w', '--overwrite', action='store_true',
                         help='Overwrite existent registrations')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='Number of registrations running at the same time. Default: 1')
+    parser.add_argument('--render-workers', type=int, default=None,
+                        help='Number of workers of the video synthesis. Default: jobs')
+    parser.add_argument('--noise-workers', type=int, default=None,
+                        help='Number of processes of the noise stage. Default: jobs')
+    parser.add_argument('-b', '--backend', type=str, default='ants', choices=['ants', 'sitk'],
+                        help='Registration backend of the breathing model: ants or sitk (in process). Default: ants')
     parser.add_argument('-d','--debug', action='store_true',
                         help='Enable debug mode')
     parser.add_argument('-v','--verbose', action='store_true',
@@ -38,73 +48,21 @@ def main():
     debug = args.debug
     verbose = args.verbose
 
-    str_debug = '-d' if debug else '';
-    str_write = '-w' if overwrite else '';
-
-    # Parse noise parameters
+    # Parse parameters
     stream = open(file_parameters, 'r')
     params = yaml.safe_load(stream)
 
-    noise_model     = None  # noise model
-    noise_percent   = 0.1   # noise percentage
-
-    if 'Video' in params:
-        if 'noise-model' in params['Video']:
-            noise_model = params['Video']['noise-model']
-        if 'noise-percentage' in params['Video']:
-            noise_percent = params['Video']['noise-percentage']
-
-    # Folders and Files
-    folder_4dct = os.path.join(folder_input, '4dct')
-    folder_mr = os.path.join(folder_input, 'mr')
-    folder_rt = os.path.join(folder_input, 'rt')
-
-    files_4dct = listdir_fullpath(folder_4dct)
-    file_4dct00 = files_4dct[0]
-    file_mr = listdir_fullpath(folder_mr)[0]
-
-    # Breathing model
-    # - sequential registration
-    # - 4dct00 to mri
-
-    print('='*50 + '\n\t\tBreathing Model\n' + '='*50)
-    cmd = 'python src/breathing-model-registration.py -o {} {} {}'.format(str_debug, 
-        folder_4dct, folder_model)
-    if verbose:
-        print(cmd)
-    os.system(cmd)
-    print()
-
-    cmd = 'python src/breathing-model-4dct00-mr.py {} {} {} {}'.format(str_debug, 
-        file_4dct00, file_mr, folder_model)
-    if verbose:
-        print(cmd)
-    os.system(cmd)
-    print()
-
-
-    # Video Simulation and Synthesis
-    # - parse parameters
-    print('='*50 + '\n\t\tVideo Simulation\n' + '='*50)
-
-    cmd = 'python src/video-synthesis-simulation.py {} {} {} {} {} {}'.format(str_debug, 
-        str_write, folder_input, folder_model, folder_output, file_parameters)
-    if verbose:
-        print(cmd)
-    os.system(cmd)
-    print()
-
-    if noise_model != None:
-        folder_ii = os.path.join(folder_output,'image')
-        folder_oo = os.path.join(folder_output,'noise')
-
-        cmd = 'python src/video-synthesis-noise.py -vr {} {} {} {} -t {} -s {}'.format(str_debug, 
-            str_write, folder_ii, folder_oo, noise_model, noise_percent, noise_percent)
-        if verbose:
-            print(cmd)
-        os.system(cmd)
-        print()
+    # Breathing model, video synthesis and noise in a single process
+    opt = dict([('jobs', args.jobs), ('backend', args.backend), ('overwrite', overwrite), 
+                ('debug', debug), ('verbose', verbose)])
+    if args.render_workers is not None: opt['render_workers'] = args.render_workers
+    if args.noise_workers is not None:  opt['noise_workers']  = args.noise_workers
+    stages = run_pipeline(folder_input, folder_model, folder_output, params, opt)
+    print(pipeline_report(stages))
+    if pipeline_failed(stages):
+        return 1
+    return 0
 
 if __name__ == "__main__":
     # execute only if run as a script
-    main()
\ No newline at end of file
+    sys.exit(main())
\ No newline at end of file
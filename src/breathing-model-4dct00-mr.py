@@ -5,9 +5,10 @@
 # @Last Modified time: 2021-08-02 22:32:58
 
 import os                       # os library
+import sys                      # exit code
 import argparse                 # argument parser
 
-from registration import register_4dct00_mr
+from registration import register_4dct00_mr, registration_report
 
 def main():
     # Arguments details
@@ -20,6 +21,9 @@ def main():
                         help='Output folder to store transformations')
     parser.add_argument('-w', '--overwrite', action='store_true',
                         help='Overwrite existent registrations')
+    parser.add_argument('-c', '--cache', type=str, default=None,
+                        help='Shared cache folder of registrations. \
+                        Default: environment variable CINEMRI_REGISTRATION_CACHE')
     parser.add_argument('-d','--debug', action='store_true',
                         help='Enable debug mode')
     parser.add_argument('-v','--verbose', action='store_true',
@@ -50,10 +54,17 @@ def main():
     if not args.debug: 
         os.system('mkdir -p ' + output_path )           # make directory
 
-    # Script
-    register_4dct00_mr(file_fixed, file_moving, output_path, debug, overwrite)
-
+    # Script. Stages rigid, affine and SyN. Stages with unchanged parameters and inputs are reused
+    jobs = register_4dct00_mr(file_fixed, file_moving, output_path, debug, overwrite, cache_dir = args.cache)
+    if debug or jobs == []:
+        return 0
+    print(registration_report(jobs))
+    failed = [job['name'] for job in jobs if job['exit_code'] != 0]
+    if failed != []:
+        print('[Error] Registration stages failed: ' + ', '.join(failed))
+        return 1
+    return 0
 
 if __name__ == "__main__":
     # execute only if run as a script
-    main()
\ No newline at end of file
+    sys.exit(main())
\ No newline at end of file
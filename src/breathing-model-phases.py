@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+# @Author: jose
+# @Date:   2021-08-05 10:12:31
+# @Last Modified by:   jose
+# @Last Modified time: 2021-08-05 12:40:08
+
+import os                       # os library
+import argparse                 # argument parser
+import SimpleITK as sitk
+
+from folder import *
+from video import *
+
+def main():
+    # Arguments details
+    parser = argparse.ArgumentParser(description='Compose the sequential registrations of the breathing model \
+                        into one deformation field per phase, relative to the reference phase')
+    parser.add_argument("model_folder", type=str, 
+                        help='Model folder with breathing model transformations')
+    parser.add_argument('-r', '--reference', type=int, default=0,
+                        help='Reference phase')
+    parser.add_argument('-p', '--phases', type=int, default=10,
+                        help='Number of phases in 4DCT')
+    parser.add_argument('-w', '--overwrite', action='store_true',
+                        help='Overwrite existent deformation fields')
+    parser.add_argument('-d','--debug', action='store_true',
+                        help='Enable debug mode')
+    parser.add_argument('-v','--verbose', action='store_true',
+                        help='Enable verbose mode')
+
+    # Parse arguments
+    args = parser.parse_args()
+    folder_model = args.model_folder
+    ref_phase = args.reference
+    phases = args.phases
+    overwrite = args.overwrite
+    debug = args.debug
+    verbose = args.verbose
+
+    print('\nRunning script to compose reference to phase deformation fields.')
+    if debug:
+        print('[Debug Mode]')
+
+    compose_phase_dfields(folder_model, ref_phase, phases, overwrite, debug, verbose)
+
+if __name__ == "__main__":
+    # execute only if run as a script
+    main()
@@ -5,9 +5,10 @@
 # @Last Modified time: 2021-08-02 20:47:46
 
 import os                       # os library
+import sys                      # exit code
 import argparse                 # argument parser
 
-from registration import register_sequential_syn
+from registration import register_breathing_model
 
 def main():
     # Arguments details
@@ -22,6 +23,37 @@ def main():
     parser.add_argument('-o', '--one_way', action='store_true',
                         help='Enable sequential registration for fixed to moving only. \
                         The default behavior is to register fixed to moving and viceversa')
+    parser.add_argument('-i', '--inverse', action='store_true',
+                        help='Register each pair once (fixed to moving) and publish moving to fixed \
+                        with the inverse warp of SyN. Reports the inverse consistency error')
+    parser.add_argument('-b', '--backend', type=str, default='ants', choices=['ants', 'sitk'],
+                        help='Registration backend: ants (antsRegistration SyN) or sitk \
+                        (SimpleITK demons, in process). Default: ants')
+    parser.add_argument('-r', '--rtstruct', type=str, default=None,
+                        help='Dicom rt file. Registrations are cropped to the bounding box of the contours')
+    parser.add_argument('-l', '--labels', type=str, nargs='+', default=None,
+                        help='Labels of the contours that define the bounding box. Default: all')
+    parser.add_argument('-m', '--margin', type=float, default=20.0,
+                        help='Motion margin added to the bounding box (mm). Default: 20')
+    parser.add_argument('-a', '--affine', type=str, default=None,
+                        help='Affine transform 4dct to contours space (e.g. 4dct00_to_mr_0GenericAffine.mat). \
+                        Default: contours in 4dct world coordinates')
+    parser.add_argument('--star', action='store_true',
+                        help='Star topology: register every phase directly to the reference phase (fixed: phase, \
+                        moving: reference). Fields are written in the phase folder, one per phase')
+    parser.add_argument('--reference', type=int, default=0,
+                        help='Reference phase of the star topology. Default: 0')
+    parser.add_argument('-s', '--warm-start', action='store_true',
+                        help='Initialize each registration with the field of the previous pair. \
+                        The pairs are split in one chain per job')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='Number of registrations running at the same time. Default: 1')
+    parser.add_argument('-t', '--threads', type=int, default=0,
+                        help='Total number of ITK threads split between the registrations. \
+                        Default: 0 (number of cores)')
+    parser.add_argument('-c', '--cache', type=str, default=None,
+                        help='Shared cache folder of registrations. \
+                        Default: environment variable CINEMRI_REGISTRATION_CACHE')
     parser.add_argument('-d','--debug', action='store_true',
                         help='Enable debug mode')
     parser.add_argument('-v','--verbose', action='store_true',
@@ -29,45 +61,16 @@ def main():
 
     # Parse arguments
     args = parser.parse_args()
-    input_folder = args.input_folder
-    output_folder = args.output_folder
-    one_way = args.one_way
-    overwrite = args.overwrite
+    opt = vars(args)
+    input_folder = opt.pop('input_folder')
+    output_folder = opt.pop('output_folder')
 
-    # Files organized alphabetically
-    files = os.listdir(input_folder)
-    files.sort()
-    print('\nRunning script to register 3d images sequentially.')
-    if args.debug:
-        print('[Debug Mode]')
-    if args.verbose:    
-        print('\nFiles found: \n' + str(files))
-    print('\nRegistration\n')
-    # os.system('export ANTSPATH=/usr/bin/')
-    
-    # List of files indexes. Added a zero (0) to complete the sequence
-    idx = list(range(len(files)))
-    idx.append(0)
-    # print(idx)
-
-    # Create directory to save output
-    output_path = os.path.join(output_folder,'seq/')    # Output path
-    os.system('echo mkdir -p ' + output_path )          # echo mkdir
-    if not args.debug: 
-        os.system('mkdir -p ' + output_path )           # make directory
-
-    # Script loop
-    for k in range(len(files)):
-        # Register fixed to moving incrementally
-        fixed_image = os.path.join(input_folder, files[idx[k]])      # Fixed image path
-        moving_image = os.path.join(input_folder, files[idx[k+1]])   # Moving image path
-
-        register_sequential_syn(fixed_image, moving_image, output_path, args.debug, overwrite)
-
-        # Register now moving to fixed. Default behavior two ways (not one_way).
-        if not one_way:
-            register_sequential_syn(moving_image, fixed_image, output_path, args.debug, overwrite)
+    jobs = register_breathing_model(input_folder, output_folder, opt)
+    failed = [job['name'] for job in jobs if job['exit_code'] != 0]
+    if not args.debug and failed != []:
+        return 1
+    return 0
 
 if __name__ == "__main__":
     # execute only if run as a script
-    main()
\ No newline at end of file
+    sys.exit(main())
\ No newline at end of file
@@ -5,6 +5,8 @@
 # @Last Modified time: 2021-07-09 15:44:24
 
 import os                           # os library, used to read files
+import shutil                       # copy files
+import hashlib                      # file hashes
 
 def clean_file_name_and_format(file):
     '''
@@ -143,4 +145,40 @@ def filter_folders_prefix( prefixs, folder_list, remove=False ):
                 if prefix in folder:
                     out = False
             if out: listv.append(folder)
-    return listv
\ No newline at end of file
+    return listv
+
+_file_hashes = dict()               # file hashes of this process. Key: (path, size, modification time)
+
+def file_sha256(file):
+    '''
+    Hash of the content of a file. Hashes are reused while the file does not change
+    Input: 
+        file: string
+    Output: 
+        string. sha256 hex digest
+    '''
+    stat = os.stat(file)
+    key = (os.path.abspath(file), stat.st_size, stat.st_mtime_ns)
+    if not key in _file_hashes:
+        sha = hashlib.sha256()
+        with open(file, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                sha.update(block)
+        _file_hashes[key] = sha.hexdigest()
+    return _file_hashes[key]
+
+def publish_file(src, dst):
+    '''
+    Place a file in a new path with a hard link. Copy the file when a link is not possible 
+    (e.g. different file systems). The destination is replaced atomically
+    Input: 
+        src: string
+        dst: string
+    '''
+    tmp = dst + '.part'
+    if os.path.exists(tmp): os.remove(tmp)
+    try:
+        os.link(src, tmp)
+    except OSError:
+        shutil.copy2(src, tmp)
+    os.replace(tmp, dst)
@@ -20,7 +20,7 @@ def main():
     parser.add_argument("output_file", type=str,
                         help='Output file with noise')
     parser.add_argument('-t','--type', type=str, default='gaussian',
-                        help='Noise types: gaussian (default), saltpepper, speckle, rician.')
+                        help='Noise types: gaussian (default), saltpepper, speckle, rician, kspace (with -r).')
     parser.add_argument('-s','--stddev', type=float, default=10.0,
                         help='Noise standard deviation')
     parser.add_argument('-r', '--percentage', action='store_true',
@@ -56,35 +56,13 @@ def main():
     except:
         print('Unable to read input image file.')
 
-    output = sitk.Image()
-
     if verbose:
         print('Apply Noise:\t', str_type)
 
-    if percentage:
-        if str_type == 'gaussian':
-            output = gaussian_noise_percentage(image, stddev)
-        elif str_type == 'saltpepper':
-            pass
-        elif str_type == 'speckle':
-            pass
-        elif str_type == 'rician':
-            pass
-            output = rician_noise_percentage(image, stddev)
-        else:
-            print('Unsupported noise type')
-    else:
-        if str_type == 'gaussian':
-            output = sitk.AdditiveGaussianNoise(image, stddev)
-        elif str_type == 'saltpepper':
-            output = sitk.SaltAndPepperNoise(image, stddev)
-        elif str_type == 'speckle':
-            output = sitk.SpeckleNoise(image, stddev)
-        elif str_type == 'rician':
-            pass
-            # output = RicianNoise(image, stddev)
-        else:
-            print('Unsupported noise type')
+    output = image_noise(image, str_type, stddev, percentage)
+    if output is None:
+        print('Unsupported noise type')
+        output = sitk.Image()
 
     if plot:
         if verbose:
@@ -4,6 +4,10 @@
 # @Last Modified by:   jose
 # @Last Modified time: 2021-08-03 17:13:57
 
+import os
+import json
+import tempfile
+import zipfile
 import pydicom as dcm
 import numpy as np
 import matplotlib.pyplot as plt
@@ -11,6 +15,9 @@ import SimpleITK as sitk
 
 from skimage.draw import polygon
 from skimage.color import rgb2gray, gray2rgb
+from concurrent.futures import ThreadPoolExecutor
+
+from folder import file_sha256
 
 def image_info( image, text = 'Image Information' ):
     '''
@@ -83,6 +90,172 @@ def read_compose_transform(dfield_file, affine_file, compose_trfm = None, invers
         compose_trfm.AddTransform(affine)                       # Add affine to composition. First transform to apply
     return compose_trfm
 
+def dfield_inverse_consistency(warp_file, inverse_file):
+    # Inverse consistency error of a deformation field and its inverse. Every point of the warp grid
+    # is mapped with the warp and then with the inverse, and the distance to the original point is measured
+    # Input:
+    # warp_file: string with dfield file name
+    # inverse_file: string with inverse dfield file name
+    # Output: 
+    # mean error, max error (mm)
+    warp_image = sitk.ReadImage(warp_file, sitk.sitkVectorFloat64)
+    reference = sitk.Image(warp_image.GetSize(), sitk.sitkUInt8)
+    reference.CopyInformation(warp_image)
+
+    composite = sitk.CompositeTransform(3)
+    composite.AddTransform(sitk.DisplacementFieldTransform(sitk.ReadImage(inverse_file, sitk.sitkVectorFloat64)))
+    composite.AddTransform(sitk.DisplacementFieldTransform(warp_image))     # last added transform is applied first
+    residual = sitk.TransformToDisplacementField(composite, sitk.sitkVectorFloat64, reference.GetSize(), 
+                    reference.GetOrigin(), reference.GetSpacing(), reference.GetDirection())
+    error = np.linalg.norm(sitk.GetArrayViewFromImage(residual), axis = -1)
+    return float(error.mean()), float(error.max())
+
+_structure_sets = dict()            # structure sets of this process. Key: (path, size, modification time)
+
+def structure_set_cache_folder( cache_dir = None ):
+    '''
+    Folder of the persisted structure sets (see read_structure_set)
+    Input:
+        cache_dir: string. Default: environment variable CINEMRI_STRUCTURE_CACHE
+    Output:
+        string or None (cache disabled)
+    '''
+    if cache_dir is None:
+        cache_dir = os.environ.get('CINEMRI_STRUCTURE_CACHE')
+    return cache_dir if cache_dir else None
+
+def read_structure_set( dcm_file, cache_dir = None ):
+    '''
+    Read a dicom rt structure set once. The labels (RTROIObservationsSequence) are paired by index 
+    with the contours (ROIContourSequence). The contours of each roi are decoded only when 
+    requested (see structure_set_contours). The structure set is kept for the process while the 
+    file does not change, and persisted with the decoded contours in cache_dir (see structure_set_save).
+    Input:
+        dcm_file: string. File name of the dicom rt
+        cache_dir: string. Folder of persisted structure sets (see structure_set_cache_folder)
+    Output:
+        sset: dict. Keys: file, labels (list of strings), index (label -> roi index), 
+            colors (list of RGB colors), contours (roi index -> list of numpy arrays [n,3]), 
+            dataset (pydicom dataset, None when loaded from the cache), cache (file of the 
+            persisted structure set or None), modified (contours decoded after the last save)
+    '''
+    stat = os.stat(dcm_file)
+    key = (os.path.abspath(dcm_file), stat.st_size, stat.st_mtime_ns)
+    if key in _structure_sets:
+        return _structure_sets[key]
+
+    cache_dir = structure_set_cache_folder(cache_dir)
+    file_cache = None
+    if cache_dir is not None:
+        file_cache = os.path.join(cache_dir, file_sha256(dcm_file) + '.npz')
+    sset = None
+    if file_cache is not None and os.path.exists(file_cache):
+        sset = read_structure_set_cache(file_cache)
+    if sset is None:
+        ds = dcm.read_file(dcm_file)            # Create filedataset
+        obsr = ds.RTROIObservationsSequence     # Description of contours
+        ctrs = ds.ROIContourSequence            # Contours values
+        labels = [str(obsr[k].ROIObservationLabel) for k in range(len(obsr))]
+        index = dict()
+        for k, label in enumerate(labels):
+            if not label in index: index[label] = k      # first roi with the label
+        colors = [[int(c) for c in ctrs[k].ROIDisplayColor] if k < len(ctrs) and 'ROIDisplayColor' in ctrs[k] else [] 
+                  for k in range(len(labels))]
+        sset = dict([('labels', labels), ('index', index), ('colors', colors), ('contours', dict()), ('dataset', ds)])
+    sset['file'] = dcm_file
+    sset['cache'] = file_cache
+    sset['modified'] = False
+    _structure_sets[key] = sset
+    return sset
+
+def read_structure_set_cache( file_cache ):
+    '''
+    Read a persisted structure set (see structure_set_save). Only arrays and a json index are
+    read, no python objects
+    Input:
+        file_cache: string. npz file
+    Output:
+        sset: dict or None when the file can not be read
+    '''
+    try:
+        with np.load(file_cache, allow_pickle = False) as data:
+            info = json.loads(str(data['info']))
+            contours = dict([(int(k), [data['roi{}_{}'.format(k, j)] for j in range(n)]) 
+                             for k, n in info['contours'].items()])
+    except (IOError, ValueError, KeyError, EOFError, zipfile.BadZipFile):
+        print('[Warning] Unreadable structure set cache {}. Ignored'.format(file_cache))
+        return None
+    for roi in contours.values():
+        for contour in roi:
+            contour.flags.writeable = False
+    return dict([('labels', info['labels']), ('index', info['index']), ('colors', info['colors']), 
+                 ('contours', contours), ('dataset', None)])
+
+def contour_data_array( item ):
+    '''
+    Points of a contour item (ContourData) as a numpy array. The values are decoded directly 
+    from the raw element when it was not read before
+    Input:
+        item: pydicom dataset. Item of ContourSequence
+    Output:
+        numpy array [n,3]
+    '''
+    elem = item.get_item(0x30060050)        # ContourData
+    if isinstance(elem.value, bytes):
+        values = np.array(elem.value.replace(b'\\', b' ').split(), dtype = np.float64)
+    else:
+        values = np.asarray(item.ContourData, dtype = np.float64)
+    return values.reshape([-1, 3])
+
+def structure_set_contours( sset, label ):
+    '''
+    Contours of a label in a structure set (see read_structure_set). Decoded once.
+    Input:
+        sset: dict
+        label: string
+    Output:
+        contours: list of numpy arrays [n,3]. One per contour (slice). Empty when the label does not exist
+        color: list with RGB color. Values from 0 to 255
+    '''
+    if not label in sset['index']:
+        return [], []
+    k = sset['index'][label]
+    if not k in sset['contours']:
+        if sset['dataset'] is None:         # loaded from the cache without this roi
+            sset['dataset'] = dcm.read_file(sset['file'])
+        ctrs = sset['dataset'].ROIContourSequence
+        contours = []
+        if k < len(ctrs) and 'ContourSequence' in ctrs[k]:
+            contours = [contour_data_array(item) for item in ctrs[k].ContourSequence]
+        for contour in contours:
+            contour.flags.writeable = False     # shared by all the readers
+        sset['contours'][k] = contours
+        sset['modified'] = True
+    return sset['contours'][k], sset['colors'][k]
+
+def structure_set_save( sset ):
+    '''
+    Persist a structure set with its decoded contours in the cache folder (see read_structure_set).
+    The contours are saved as arrays of a npz file with a json index (labels, colors, number of 
+    contours of each roi), therefore reading the cache never runs code. Written only when new 
+    contours were decoded. Each writer uses its own temporary file, and the cache file is 
+    replaced at once, therefore concurrent processes never read a partial file.
+    Input:
+        sset: dict
+    '''
+    if sset['cache'] is None or not sset['modified']:
+        return
+    folder = os.path.dirname(sset['cache'])
+    os.makedirs(folder, exist_ok = True)
+    info = dict([('labels', sset['labels']), ('index', sset['index']), ('colors', sset['colors']),
+                 ('contours', dict([(str(k), len(roi)) for k, roi in sset['contours'].items()]))])
+    arrays = dict([('roi{}_{}'.format(k, j), contour) for k, roi in sset['contours'].items() 
+                   for j, contour in enumerate(roi)])
+    with tempfile.NamedTemporaryFile(dir = folder, suffix = '.part', delete = False) as f:
+        np.savez(f, info = np.array(json.dumps(info)), **arrays)
+    os.replace(f.name, sset['cache'])
+    sset['modified'] = False
+
 def read_contours_labels( dcm_file ):
     '''
     Read the labels inside rt dicom file
@@ -91,12 +264,7 @@ def read_contours_labels( dcm_file ):
     Output:
         list of strings
     '''
-    ds = dcm.read_file(dcm_file)            # Create filedataset
-    obsr = ds.RTROIObservationsSequence     # Description of contours
-    labels = []
-    for k in range(len(obsr)):
-        labels.append(obsr[k].ROIObservationLabel)    # check the desired label
-    return labels
+    return list(read_structure_set(dcm_file)['labels'])
 
 def read_contours( dcm_file, label ):
     '''
@@ -105,26 +273,34 @@ def read_contours( dcm_file, label ):
       dcm_file: string. File name of the dicom rt
       label: string. Name of the contour that is desired to extract from the dicom file
     Output:
-        contours : list of list. The globlal len refer to the amount of slices with contours. 
+        contours : list of numpy arrays. The globlal len refer to the amount of slices with contours. 
                 The interal len is variable depending of the number of point defining the contour.
-                The internal list contains 3D coordinates as: [x1, y1, z1, x2, y2, z2, ...]
+                The internal arrays contain 3D coordinates as: [x1, y1, z1, x2, y2, z2, ...]
         color: list with RGB color. Values from 0 to 255
     '''
-    ds = dcm.read_file(dcm_file)            # Create filedataset
-    obsr = ds.RTROIObservationsSequence     # Description of contours
-    ctrs = ds.ROIContourSequence            # Contours values
-
-    # labels = []
-    contours = []
-    color = []
-    for k in range(len(obsr)):
-        if label == obsr[k].ROIObservationLabel:    # check the desired label
-            color = list(ctrs[k].ROIDisplayColor)   # read the color
-            ctr_seq = ctrs[k].ContourSequence       
-            for j in range(len(ctr_seq)):           # Explore the contour
-                contours.append(list(ctr_seq[j].ContourData))
-            break
-    return contours, color
+    contours, color = structure_set_contours(read_structure_set(dcm_file), label)
+    return [contour.reshape(-1) for contour in contours], list(color)
+
+def contours_bounding_box( dcm_file, labels ):
+    '''
+    Bounding box of the contours of several labels in world coordinates
+    Input:
+        dcm_file: string. File name of the dicom rt
+        labels: list of strings. Names of the contours
+    Output:
+        point_min: numpy array [3]. Minimum x, y, z (mm)
+        point_max: numpy array [3]. Maximum x, y, z (mm)
+    '''
+    sset = read_structure_set(dcm_file)
+    points = []
+    for label in labels:
+        contours, _ = structure_set_contours(sset, label)
+        points += contours
+    structure_set_save(sset)
+    if points == []:
+        raise ValueError('No contours found in {} for labels {}'.format(dcm_file, labels))
+    points = np.concatenate(points)
+    return points.min(axis = 0), points.max(axis = 0)
 
 def point_world_to_image( point_xyz, origin, spacing, direction):
     # Function to convert a world coordinate point (metric) to an image point (pixel coordinates)
@@ -199,22 +375,112 @@ def contour_to_mask_2d( contour, ref_image, return_numpy = False ):
         image.CopyInformation(slice)
         return sitk.Cast(image,slice.GetPixelID())
 
-def contour_to_mask_3d( contours, ref_image, return_numpy = False ):
-    # Function to create a 3D mask using contours
+def contours_world_to_image( contours, ref_image ):
+    # Transform all the points of a list of contours to image coordinates with a single matrix product
+    # Input:
+    #   contours: list of list (or numpy arrays). Points as [x1, y1, z1, x2, y2, z2, ...]
+    #   ref_image: sitk.Image
+    # Output:
+    #   list of numpy arrays [n,3]. One per contour
+    points = [np.asarray(contour, dtype = np.float64).reshape([-1, 3]) for contour in contours]
+    if points == []:
+        return []
+    sizes = [len(p) for p in points]
+    d_np = np.asarray(ref_image.GetDirection()).reshape([3,3])
+    s_np = np.diag(np.asarray(ref_image.GetSpacing()))
+    ds = np.linalg.inv(s_np)@np.linalg.inv(d_np)        # inverse computed once for all the points
+    uvw = (np.concatenate(points) - np.asarray(ref_image.GetOrigin()))@ds.transpose()
+    return np.split(uvw, np.cumsum(sizes)[:-1])
+
+def polygon_to_mask( cc, shape ):
+    # Rasterize a closed polygon with a scanline fill of all its edges at once. Same pixels as
+    # skimage.draw.polygon: pixel centers inside the polygon (even-odd rule), polygon vertices, 
+    # and pixel centers on an odd number of edges. A center where two edges cross (self 
+    # intersecting polygon) or on two overlapping edges is only in the mask when it is inside
+    # Input:
+    #   cc: numpy array [n,2] or [n,3]. Image coordinates (column, row), z ignored
+    #   shape: tuple (rows, columns)
+    # Output:
+    #   mask: numpy array uint8
+    rows, cols = shape
+    x0, y0 = cc[:,0], cc[:,1]                       # edges from each point to the next one
+    x1, y1 = np.roll(x0, -1), np.roll(y0, -1)
+
+    # Rows (pixel centers) crossed by each edge, closed [ymin, ymax]. Horizontal edges cross none
+    r0 = np.clip(np.ceil(np.minimum(y0, y1)), 0, rows).astype(np.int64)
+    r1 = np.clip(np.floor(np.maximum(y0, y1)) + 1, 0, rows).astype(np.int64)
+    counts = np.where(y0 != y1, np.maximum(r1 - r0, 0), 0)
+    edge = np.repeat(np.arange(len(x0)), counts)
+    row = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts) + r0[edge]
+    x = x0[edge] + (row - y0[edge])*(x1[edge] - x0[edge])/(y1[edge] - y0[edge])
+
+    # Inside: odd number of crossings at the left of the pixel. Crossings at the lower end of 
+    # an edge (half open [ymin, ymax)) are counted once per vertex
+    lower = row < np.maximum(y0[edge], y1[edge])
+    col = np.clip(np.ceil(x[lower]), 0, cols).astype(np.int64)
+    crossings = np.bincount(row[lower]*(cols + 1) + col, minlength = rows*(cols + 1)).reshape([rows, cols + 1])
+    mask = (np.cumsum(crossings[:,:cols], axis = 1) & 1).astype(np.uint8)
+
+    # Boundary: number of edges through each pixel center, the edge ends included
+    on_edge = (np.abs(x - np.round(x)) < 1e-9) & (x > -0.5) & (x < cols - 0.5)
+    edges = np.bincount(row[on_edge]*cols + np.round(x[on_edge]).astype(np.int64), 
+                        minlength = rows*cols).reshape([rows, cols])
+    horizontal = (y0 == y1) & (y0 == np.round(y0)) & (y0 >= 0) & (y0 < rows)
+    for xa, xb, y in zip(np.minimum(x0, x1)[horizontal], np.maximum(x0, x1)[horizontal], y0[horizontal]):
+        ca, cb = max(0, int(np.ceil(xa))), min(cols, int(np.floor(xb)) + 1)
+        if ca < cb: edges[int(y), ca:cb] += 1
+    mask |= (edges & 1).astype(np.uint8)
+
+    # Vertices at pixel centers
+    vertex = (x0 == np.round(x0)) & (y0 == np.round(y0)) & (x0 >= 0) & (x0 < cols) & (y0 >= 0) & (y0 < rows)
+    mask[y0[vertex].astype(np.int64), x0[vertex].astype(np.int64)] = 1
+    return mask
+
+def contours_to_mask_slice( polygons, shape ):
+    # Rasterize the contours of one slice with the even-odd rule: a pixel inside an odd number
+    # of contours is in the mask (holes and multiple contours in the same slice)
+    # Input:
+    #   polygons: list of numpy arrays [n,3]. Image coordinates, z ignored
+    #   shape: tuple (rows, columns)
+    # Output:
+    #   mask: numpy array uint8
+    mask = np.zeros(shape, dtype = np.uint8)
+    for cc in polygons:
+        mask ^= polygon_to_mask(cc, shape)
+    return mask
+
+def contour_to_mask_3d( contours, ref_image, return_numpy = False, workers = None ):
+    # Function to create a 3D mask using contours. The points of all the contours are transformed
+    # at once, the contours are grouped by slice and the slices are rasterized in parallel
+    # (even-odd rule, see contours_to_mask_slice)
     # Input
     #   contours: list of list
     #   ref_image: sitk.Image. Reference 3D image
+    #   return_numpy: bool. Return a numpy array or a sitk.Image
+    #   workers: int. Number of threads. Default: number of cores
     # Output
     #   mask_image: sitk.Image or numpy array. Image with the same size and coordinates as ref_image
     size = ref_image.GetSize()
     mask_image = np.zeros((size[2],size[1],size[0]), dtype=np.uint8) # Create empty image with same properties
-    for c in range(len(contours)):
-        z = get_zvalue_from_contour( contours[c], ref_image )
-        cc = contour_world_to_image(contours[c], ref_image)
-        mask2d = contour_to_mask_2d(cc, ref_image[:,:,z], return_numpy = True)
-        mask_image[z,:,:] = mask_image[z,:,:] + mask2d # in case of multiple contours in the same slice
-        # print(z)
-        # print(image_info(mask2d))
+
+    # Slice of each contour from its first point, the contouring is made in the axial slices
+    slices = dict()
+    for cc in contours_world_to_image(contours, ref_image):
+        if len(cc) == 0: continue
+        z = int(np.floor(cc[0,2])) # z pixel coordinate, negative values are outside the image
+        if 0 <= z < size[2]:
+            slices.setdefault(z, []).append(cc)
+
+    def rasterize(z):
+        mask_image[z,:,:] = contours_to_mask_slice(slices[z], (size[1], size[0]))
+
+    if workers is None: workers = os.cpu_count() or 1
+    if workers > 1 and len(slices) > 1:
+        with ThreadPoolExecutor(max_workers = min(workers, len(slices))) as executor:
+            list(executor.map(rasterize, slices))
+    else:
+        for z in slices: rasterize(z)
+
     if return_numpy:
         return mask_image
     else:
@@ -5,39 +5,76 @@
 # @Last Modified time: 2021-06-08 22:43:15
 
 import os
+import multiprocessing
 import numpy as np
 import SimpleITK as sitk
+import scipy.fft                # float32 batched ffts
+
+from folder import listdir_fullpath, listdir_fullpath_onlyfiles, fullpath_to_localpath
 
 # from imutils.image import image_info
 
-def gaussian_noise_percentage(image, percent):
+def noise_image_stats(image):
+    '''
+    Image statistics used by the noise models, computed in one pass
+    Input:
+        image: sitk image
+    Output:
+        stats: dict. Keys: min, max, mean, sigma, count
+    '''
+    filt = sitk.StatisticsImageFilter()
+    filt.Execute(image)
+    stats = dict([('min', filt.GetMinimum()), ('max', filt.GetMaximum()), ('mean', filt.GetMean()), 
+                  ('sigma', filt.GetSigma()), ('count', image.GetNumberOfPixels())])
+    return stats
+
+def noise_merge_stats(list_stats):
+    '''
+    Statistics of a set of images (e.g. all frames of a video) from the statistics of each image
+    Input:
+        list_stats: list of dict. See noise_image_stats
+    Output:
+        stats: dict
+    '''
+    count = sum([st['count'] for st in list_stats])
+    mean = sum([st['mean']*st['count'] for st in list_stats])/count
+    # sum of squares of each image from its unbiased variance
+    sumsq = sum([(st['sigma']**2)*(st['count'] - 1) + (st['mean']**2)*st['count'] for st in list_stats])
+    sigma = np.sqrt(max(0.0, (sumsq - count*mean**2)/max(1, count - 1)))
+    stats = dict([('min', min([st['min'] for st in list_stats])), ('max', max([st['max'] for st in list_stats])),
+                  ('mean', mean), ('sigma', sigma), ('count', count)])
+    return stats
+
+def noise_sigma_percentage(stats, percent):
+    '''
+    Standard deviation of the noise as a percentage of the standard deviation of the normalized 
+    image (intensities in [0,1]), in image intensity units
+    Input:
+        stats: dict. See noise_image_stats
+        percent: float
+    Output:
+        float
+    '''
+    # sigma of the normalized image is sigma/(max - min)
+    # new_sigma = sigma * percent * (maxx - minx) + minx
+    return stats['sigma'] * percent + stats['min']
+
+def gaussian_noise_percentage(image, percent, stats = None, seed = None):
     # how to: https://stackoverflow.com/questions/31834803/how-to-add-5-percent-gaussian-noise-to-image
+    # stats: dict. Image statistics (noise_image_stats), e.g. shared by all frames of a video
+    # seed: int. Seed of the noise (default: wall clock)
 
     # stats
-    stats = sitk.StatisticsImageFilter()
-    stats.Execute(image)
-    minx = stats.GetMinimum()
-    maxx = stats.GetMaximum()
-    meanx = stats.GetMean()
-    stdx = stats.GetSigma()
-    # print('Image stats \nmin {}, max {}, mean {}, std {}'.format(minx,maxx,meanx,stdx))
-
-    # normalize image
-    img = sitk.ShiftScale( sitk.Cast( image, sitk.sitkFloat64 ), -minx, 1/(maxx - minx) )
-    # img = sitk.RescaleIntensity( sitk.Cast( image, sitk.sitkFloat64 ), 0.0, 1.0 ) # equivalent
-    
-    # stats to get std
-    stats = sitk.StatisticsImageFilter()
-    stats.Execute(img)
-    sigma = stats.GetSigma()
-    # print(sigma)
-    
-    # new_sigma = sigma * percent
-    new_sigma = sigma * percent * (maxx - minx) + minx
+    if stats is None:
+        stats = noise_image_stats(image)
+    new_sigma = noise_sigma_percentage(stats, percent)
     # print(new_sigma)
 
     # gaussian noise
-    output = sitk.AdditiveGaussianNoise(image, new_sigma)
+    if seed is None:
+        output = sitk.AdditiveGaussianNoise(image, new_sigma)
+    else:
+        output = sitk.AdditiveGaussianNoise(image, new_sigma, 0.0, int(seed) % 2**32)
 
     # stats = sitk.StatisticsImageFilter()
     # stats.Execute(output)
@@ -48,51 +85,35 @@ def gaussian_noise_percentage(image, percent):
     # print('Image stats \nmin {}, max {}, mean {}, std {}'.format(minx,maxx,meanx,stdx))
     return output
 
-def ricernd(v, s):
+def ricernd(v, s, rng = None):
     # See https://www.mathworks.com/matlabcentral/fileexchange/14237-rice-rician-distribution
-    x = s * np.random.normal(size=np.size(v)).reshape(v.shape) + v
-    y = s * np.random.normal(size=np.size(v)).reshape(v.shape)
+    # rng: numpy random generator (default: global numpy random state)
+    if rng is None: rng = np.random
+    x = s * rng.normal(size=np.size(v)).reshape(v.shape) + v
+    y = s * rng.normal(size=np.size(v)).reshape(v.shape)
     r = np.sqrt(x**2.0 + y**2.0)
     return r
 
-def rician_noise_percentage(image, percent):
-    # stats
-    stats = sitk.StatisticsImageFilter()
-    stats.Execute(image)
-    minx = stats.GetMinimum()
-    maxx = stats.GetMaximum()
-    meanx = stats.GetMean()
-    stdx = stats.GetSigma()
-    # print('Image stats \nmin {}, max {}, mean {}, std {}'.format(minx,maxx,meanx,stdx))
+def rician_noise_percentage(image, percent, stats = None, seed = None):
+    # stats: dict. Image statistics (noise_image_stats), e.g. shared by all frames of a video
+    # seed: int. Seed of the noise (default: global numpy random state)
 
-    # normalize image
-    imgf64 = sitk.Cast( image, sitk.sitkFloat64 )
-    img = sitk.ShiftScale( imgf64, -minx, 1/(maxx - minx) )
-    
-    # stats to get std
-    stats = sitk.StatisticsImageFilter()
-    stats.Execute(img)
-    sigma = stats.GetSigma()
-    # print('Sigma:', sigma)
-    
-    # new_sigma = sigma * percent
-    new_sigma = sigma * percent * (maxx - minx) + minx
+    # stats
+    if stats is None:
+        stats = noise_image_stats(image)
+    minx = stats['min']
+    maxx = stats['max']
+    new_sigma = noise_sigma_percentage(stats, percent)
     # print('Sigma new:', new_sigma)
 
     # rician noise
     np_image = sitk.GetArrayFromImage(image)
-    np_noise = ricernd(np_image, new_sigma)
+    rng = None if seed is None else np.random.default_rng(seed)
+    np_noise = ricernd(np_image, new_sigma, rng)
     noise = sitk.GetImageFromArray(np_noise)
     # noise = sitk.Cast( noise, image.GetPixelID() )
     noise.CopyInformation(image)
 
-    stats.Execute(noise)
-    mino = stats.GetMinimum()
-    maxo = stats.GetMaximum()
-    meano = stats.GetMean()
-    stdo = stats.GetSigma()
-    # print('Noise stats \nmin {}, max {}, mean {}, std {}'.format(mino,maxo,meano,stdo))
-
     # print(image_info(image))
     # print(image_info(noise))
 
@@ -165,4 +186,325 @@ def gaussian_noise_old(image, std, mean = 0.0):
 #     img_max = minmax.GetMaximum()
     # image_noise = sitk.AdditiveGaussianNoise(image, 20.0, 0.0)
 #     print('Image+Noise: min {}, max {}'.format(minmax.GetMinimum(), minmax.GetMaximum()))
-    return image_noise
\ No newline at end of file
+    return image_noise
+
+def noise_stack_stats(stack, per_frame = False, max_mb = 256):
+    '''
+    Statistics of a stack of frames (t, y, x) used by the noise models. Frames are read in 
+    chunks, therefore the stack can be a memory mapped array
+    Input:
+        stack: numpy array (t, y, x)
+        per_frame: bool. Statistics of each frame (arrays of size t) or of the whole stack
+        max_mb: float. Memory budget of the chunks in megabytes
+    Output:
+        stats: dict. Keys: min, max, mean, sigma, count (see noise_image_stats)
+    '''
+    count = stack[0].size
+    chunk = max(1, int(max_mb*1024*1024) // (8*count))
+    minx, maxx, mean, sigma = [], [], [], []
+    for i in range(0, len(stack), chunk):
+        frames = np.asarray(stack[i:i+chunk]).reshape(-1, count)
+        minx.append(frames.min(axis = 1))
+        maxx.append(frames.max(axis = 1))
+        mean.append(frames.mean(axis = 1, dtype = np.float64))
+        sigma.append(frames.std(axis = 1, dtype = np.float64, ddof = 1))    # as StatisticsImageFilter
+    stats = dict([('min', np.concatenate(minx).astype(np.float64)), ('max', np.concatenate(maxx).astype(np.float64)),
+                  ('mean', np.concatenate(mean)), ('sigma', np.concatenate(sigma)), ('count', count)])
+    if per_frame:
+        return stats
+    list_stats = [dict([(key, stats[key][k]) for key in ['min', 'max', 'mean', 'sigma']] + [('count', count)]) 
+                  for k in range(len(stack))]
+    return noise_merge_stats(list_stats)
+
+def _stack_value(value, i, j):
+    # value of the frames i to j, broadcast to (t, y, x). Scalars are shared by all frames
+    value = np.asarray(value, dtype = np.float32)
+    if value.ndim == 0: return value
+    return value[i:j].reshape(-1, 1, 1)
+
+def kspace_mask(rows, partial_fourier = 1.0, undersampling = 1, center_fraction = 0.08):
+    '''
+    Sampling mask of the phase encoding lines of k-space (rows of a frame). Lines are in the
+    order of the fft (zero frequency first)
+    Input:
+        rows: int. Number of phase encoding lines
+        partial_fourier: float. Fraction of the lines acquired in (0.5, 1.0]. The last lines 
+            of the k-space are not acquired (zero filled)
+        undersampling: int. Acceleration factor, one of every undersampling lines is acquired
+        center_fraction: float. Fraction of the central lines always acquired with undersampling
+    Output:
+        mask: numpy array float32 (rows,). None when every line is acquired
+    '''
+    if partial_fourier >= 1.0 and undersampling <= 1:
+        return None
+    line = np.arange(rows) - rows//2                    # centered line number
+    mask = np.ones(rows, dtype = np.float32)
+    if undersampling > 1:
+        mask[(line % undersampling) != 0] = 0.0
+        mask[np.abs(line) < center_fraction*rows/2] = 1.0
+    mask[np.arange(rows) >= int(np.ceil(partial_fourier*rows))] = 0.0
+    return np.fft.ifftshift(mask)
+
+def noise_stack(stack, noise_type = 'gaussian', percent = 0.1, stats = None, seeds = None, max_mb = 256, 
+                kspace = None):
+    '''
+    Add noise to a stack of frames (t, y, x), noise as percentage (see noise_sigma_percentage).
+    Noise is generated in float32 for chunks of frames that fit in the memory budget. Each frame
+    has its own random substream, therefore the noise of a frame does not depend on the chunk 
+    size or on the other frames in the stack.
+        gaussian: frame + N(0, s)
+        rician: magnitude of (frame + N(0, s), N(0, s)), clamped to [min, max] (see ricernd)
+        kspace: complex gaussian noise N(0, s) + i N(0, s) added to the k-space of the frame 
+            (orthonormal fft2, same noise level in image space), sampling mask (see kspace_mask) 
+            and magnitude reconstruction. The magnitude has the rician noise floor
+    Input:
+        stack: numpy array (t, y, x)
+        noise_type: string. gaussian, rician or kspace
+        percent: float
+        stats: dict. Statistics of the whole stack or per frame (see noise_stack_stats). 
+            Default: statistics of the whole stack
+        seeds: int or list of numpy.random.SeedSequence (one per frame). Default: random
+        max_mb: float. Memory budget of the chunks in megabytes
+        kspace: dict. Arguments of kspace_mask (partial_fourier, undersampling, center_fraction)
+    Output:
+        output: numpy array (t, y, x) with the type of stack
+    '''
+    if not noise_type in ['gaussian', 'rician', 'kspace']:
+        raise ValueError('Unsupported noise type: ' + str(noise_type))
+    if stats is None:
+        stats = noise_stack_stats(stack, max_mb = max_mb)
+    if not isinstance(seeds, list):
+        seeds = np.random.SeedSequence(seeds).spawn(len(stack))
+    sigma = noise_sigma_percentage(stats, percent)
+
+    output = np.empty(stack.shape, dtype = stack.dtype)
+    limits = np.iinfo(stack.dtype) if np.issubdtype(stack.dtype, np.integer) else None
+    buffers = dict([('gaussian', 2), ('rician', 3), ('kspace', 7)])[noise_type]    # float32 frames, noise and k-space
+    chunk = max(1, int(max_mb*1024*1024) // (4*buffers*stack[0].size))
+    mask = None
+    if noise_type == 'kspace':
+        mask = kspace_mask(stack.shape[1], **(kspace if kspace is not None else dict()))
+        if mask is not None: mask = mask.reshape(-1, 1)     # lines (rows) of each frame
+    for i in range(0, len(stack), chunk):
+        j = min(len(stack), i + chunk)
+        frames = np.array(stack[i:j], dtype = np.float32)
+        s = _stack_value(sigma, i, j)
+        noise = np.empty_like(frames)
+        noise_y = np.empty_like(frames) if noise_type != 'gaussian' else None
+        for k in range(i, j):
+            rng = np.random.default_rng(seeds[k])
+            rng.standard_normal(out = noise[k-i], dtype = np.float32)
+            if noise_y is not None: rng.standard_normal(out = noise_y[k-i], dtype = np.float32)
+        noise *= s
+        if noise_type == 'kspace':
+            kdata = scipy.fft.fft2(frames, norm = 'ortho', workers = -1)     # complex64, batched over frames
+            noise_y *= s
+            kdata.real += noise
+            kdata.imag += noise_y
+            if mask is not None: kdata *= mask
+            frames = np.abs(scipy.fft.ifft2(kdata, norm = 'ortho', workers = -1))
+        else:
+            frames += noise
+        if noise_type == 'rician':
+            noise_y *= s
+            np.hypot(frames, noise_y, out = frames)
+            np.clip(frames, _stack_value(stats['min'], i, j), _stack_value(stats['max'], i, j), out = frames)
+        if limits is not None:
+            np.clip(frames, limits.min, limits.max, out = frames)
+        output[i:j] = frames
+    return output
+
+def noise_frame(image, noise_type = 'gaussian', percent = 0.1, stats = None, seed = None, kspace = None):
+    '''
+    Add noise to a 2D image with the batch noise engine (see noise_stack)
+    Input:
+        image: sitk image 2D
+        noise_type: string. gaussian, rician or kspace
+        percent: float
+        stats: dict. See noise_image_stats. Computed when not provided
+        seed: int or numpy.random.SeedSequence
+        kspace: dict. Sampling mask of kspace noise (see noise_stack)
+    Output:
+        output: sitk image
+    '''
+    if stats is None:
+        stats = noise_image_stats(image)
+    if not isinstance(seed, np.random.SeedSequence):
+        seed = np.random.SeedSequence(seed)
+    array = noise_stack(sitk.GetArrayViewFromImage(image)[np.newaxis], noise_type, percent, stats, [seed], kspace = kspace)
+    output = sitk.GetImageFromArray(array[0])
+    output.CopyInformation(image)
+    return output
+
+def image_noise(image, noise_type = 'gaussian', stddev = 10.0, percentage = False, stats = None, seed = None, 
+                kspace = None):
+    '''
+    Add noise to an image
+    Input:
+        image: sitk image
+        noise_type: string. gaussian, saltpepper, speckle, rician, kspace (only percentage)
+        stddev: float. Noise standard deviation (or percentage, see gaussian_noise_percentage)
+        percentage: bool. Noise as percentage
+        stats: dict. Image statistics (see noise_image_stats). Computed when not provided
+        seed: int. Seed of the noise (optional)
+        kspace: dict. Sampling mask of kspace noise (see noise_stack)
+    Output:
+        output: sitk image. None for unsupported types
+    '''
+    output = None
+    if percentage:
+        if noise_type == 'gaussian':
+            output = gaussian_noise_percentage(image, stddev, stats, seed)
+        elif noise_type == 'rician':
+            output = rician_noise_percentage(image, stddev, stats, seed)
+        elif noise_type == 'kspace':
+            output = noise_frame(image, 'kspace', stddev, stats, seed, kspace)
+    else:
+        kwargs = dict() if seed is None else dict([('seed', int(seed) % 2**32)])
+        if noise_type == 'gaussian':
+            output = sitk.AdditiveGaussianNoise(image, stddev, **kwargs)
+        elif noise_type == 'saltpepper':
+            output = sitk.SaltAndPepperNoise(image, stddev, **kwargs)
+        elif noise_type == 'speckle':
+            output = sitk.SpeckleNoise(image, stddev, **kwargs)
+    return output
+
+def noise_file(file_input, file_output, opt):
+    '''
+    Add noise to an image file. See noise_folder
+    Input:
+        file_input: string
+        file_output: string
+        opt: dict. Options of noise_folder, with the keys stats (shared statistics or None) and 
+            seed (seed of the file or None)
+    '''
+    if opt['verbose']:
+        print('Input file:\t', file_input)
+    image = sitk.ReadImage(file_input)
+    output = image_noise(image, opt['type'], opt['stddev'], opt['percentage'], opt['stats'], opt['seed'], opt['kspace'])
+    if output is None:
+        raise ValueError('Unsupported noise type: ' + str(opt['type']))
+    if opt['verbose']:
+        print('Output file:\t', file_output)
+    if not opt['debug']:
+        sitk.WriteImage(output, file_output)
+
+def noise_files(files_input, files_output, seeds, opt):
+    '''
+    Add noise to a set of image files of the same size with the batch noise engine (see noise_stack)
+    Input:
+        files_input: list of strings
+        files_output: list of strings
+        seeds: list of numpy.random.SeedSequence. One per file
+        opt: dict. Options of noise_folder, with the key stats (shared statistics or None)
+    '''
+    images = [sitk.ReadImage(file) for file in files_input]
+    stack = np.stack([sitk.GetArrayViewFromImage(image) for image in images])
+    stats = opt['stats'] if opt['stats'] is not None else noise_stack_stats(stack, per_frame = True, max_mb = opt['max_mb'])
+    output = noise_stack(stack, opt['type'], opt['stddev'], stats, seeds, opt['max_mb'], opt['kspace'])
+    for k, (image, file_output) in enumerate(zip(images, files_output)):
+        if opt['verbose']:
+            print('Output file:\t', file_output)
+        if not opt['debug']:
+            noise = sitk.GetImageFromArray(output[k])
+            noise.CopyInformation(image)
+            sitk.WriteImage(noise, file_output)
+
+def _noise_files_worker(args):
+    noise_files(*args)
+
+def _noise_file_worker(args):
+    noise_file(*args)
+
+def _noise_init(threads):
+    sitk.ProcessObject.SetGlobalDefaultNumberOfThreads(threads)
+
+def noise_folder(folder_input, folder_output, opt = 0):
+    '''
+    Add noise to all the images of a folder (e.g. frames of a video) in a single process or in a 
+    pool of processes. Output files keep the names of the input files. Existing outputs are 
+    kept unless overwrite is set. Gaussian, rician and kspace noise as percentage use the batch noise 
+    engine (see noise_stack) on chunks of frames sized to the memory budget.
+    Input:
+        folder_input: string
+        folder_output: string
+        opt: dict. Options (defaults in brackets): type ['gaussian'], stddev [10.0], percentage [False],
+            global_stats [False] (statistics of all images instead of per image, computed once), 
+            seed [None] (frame k uses the substream k of the seed), kspace [None] (sampling mask of 
+            kspace noise, see noise_stack), workers [1], max_mb [256] (memory budget per process), 
+            overwrite [False], debug [False], verbose [False]
+    Output:
+        files: list of strings. Output files
+    '''
+    if opt == 0:
+        opt = dict()
+    opt = dict(opt)
+    if not 'type' in opt:           opt['type']         = 'gaussian'
+    if not 'stddev' in opt:         opt['stddev']       = 10.0
+    if not 'percentage' in opt:     opt['percentage']   = False
+    if not 'global_stats' in opt:   opt['global_stats'] = False
+    if not 'seed' in opt:           opt['seed']         = None
+    if not 'kspace' in opt:         opt['kspace']       = None
+    if not 'workers' in opt:        opt['workers']      = 1
+    if not 'max_mb' in opt:         opt['max_mb']       = 256
+    if not 'overwrite' in opt:      opt['overwrite']    = False
+    if not 'debug' in opt:          opt['debug']        = False
+    if not 'verbose' in opt:        opt['verbose']      = False
+
+    list_files = listdir_fullpath_onlyfiles(folder_input)
+    if not opt['debug']:
+        os.makedirs(folder_output, exist_ok=True)
+    list_out_files = listdir_fullpath(folder_output) if os.path.isdir(folder_output) else []
+
+    ini = len(list_out_files)
+    if len(list_out_files) == len(list_files):
+        if not opt['overwrite']:
+            print('\nExisting output noise files. Use option -w to overwrite')
+            return []
+        ini = 0
+
+    # Statistics of all the images, read once
+    opt['stats'] = None
+    if opt['global_stats'] and opt['percentage']:
+        opt['stats'] = noise_merge_stats([noise_image_stats(sitk.ReadImage(file)) for file in list_files])
+        if opt['verbose']:
+            print('\nImage stats \nmin {}, max {}, mean {}, std {}'.format(opt['stats']['min'], 
+                    opt['stats']['max'], opt['stats']['mean'], opt['stats']['sigma']))
+
+    # Each file has its own seed, the noise does not depend on the worker that processes the file
+    seeds = np.random.SeedSequence(opt['seed']).spawn(len(list_files))
+    files_input = list_files[ini:]
+    files = [os.path.join(folder_output, fullpath_to_localpath([file])[0]) for file in files_input]
+    seeds = seeds[ini:]
+
+    if opt['percentage'] and opt['type'] in ['gaussian', 'rician', 'kspace']:
+        # chunks of frames sized to the memory budget (input, output and float32 buffers)
+        voxels = 1
+        if files_input != []:
+            reader = sitk.ImageFileReader()
+            reader.SetFileName(files_input[0])
+            reader.ReadImageInformation()
+            voxels = int(np.prod(reader.GetSize()))
+        chunk = max(1, int(opt['max_mb']*1024*1024) // (24*voxels))
+        tasks = [(files_input[i:i+chunk], files[i:i+chunk], seeds[i:i+chunk], opt) 
+                 for i in range(0, len(files_input), chunk)]
+        worker = _noise_files_worker
+    else:
+        tasks = []
+        for k, (file, file_output) in enumerate(zip(files_input, files)):
+            fopt = dict(opt)
+            fopt['seed'] = int(seeds[k].generate_state(1)[0])
+            tasks.append((file, file_output, fopt))
+        worker = _noise_file_worker
+
+    workers = min(opt['workers'], len(tasks))
+    if workers <= 1:
+        for task in tasks:
+            worker(task)
+        return files
+
+    threads = max(1, (os.cpu_count() or 1)//workers)   # split ITK threads between processes
+    with multiprocessing.Pool(workers, _noise_init, (threads,)) as pool:
+        for _ in pool.imap(worker, tasks):
+            pass
+    return files
@@ -0,0 +1,224 @@
+# -*- coding: utf-8 -*-
+# @Author: jose
+# @Date:   2021-08-04 11:30:12
+# @Last Modified by:   jose
+# @Last Modified time: 2021-08-04 11:30:12
+
+import os                       # os library, used to read files
+import time                     # stage timing
+import traceback                # errors of failed stages
+
+from folder import listdir_fullpath
+from registration import register_4dct00_mr, register_breathing_model
+from noise import noise_folder
+from video import dfield_cache, dfield_cache_info, compose_phase_dfields, video_options, video_simulation
+
+def pipeline_options( params ):
+    '''
+    Options of the breathing model and noise stages from the parameters of a yaml file (see parameters.yaml)
+    Input:
+        params: dict
+    Output:
+        opt: dict. Keys: noise_model, noise_percent, ref_phase, roi_margin, topology, labels_segments
+    '''
+    opt = dict()
+    opt['noise_model']      = None      # noise model
+    opt['noise_percent']    = 0.1       # noise percentage
+    opt['ref_phase']        = 0         # reference phase in 4dct
+    opt['roi_margin']       = None      # margin of the registration region around the segments (mm)
+    opt['topology']         = 'ring'    # breathing model: ring (sequential) or star (reference to phases)
+    opt['labels_segments']  = []        # segments in dicom rt
+
+    if 'Video' in params:
+        if 'reference-phase' in params['Video']:
+            opt['ref_phase'] = params['Video']['reference-phase']
+        if 'noise-model' in params['Video']:
+            opt['noise_model'] = params['Video']['noise-model']
+        if 'noise-percentage' in params['Video']:
+            opt['noise_percent'] = params['Video']['noise-percentage']
+    if 'Model' in params:
+        if 'roi-margin' in params['Model']:
+            opt['roi_margin'] = params['Model']['roi-margin']
+        if 'topology' in params['Model']:
+            opt['topology'] = params['Model']['topology']
+    if 'Segments' in params:
+        if 'labels-input' in params['Segments']:
+            opt['labels_segments'] = params['Segments']['labels-input']
+    return opt
+
+def run_stage( stages, name, function, *args, **kwargs ):
+    '''
+    Run a stage of the pipeline and record its status, wall time and error. A stage fails
+    when the function raises an exception.
+    Input:
+        stages: list of dict. The stage is appended
+        name: string
+        function: callable
+        args, kwargs: arguments of function
+    Output:
+        stage: dict. Keys: name, status (done, failed), time, error, output (return value)
+    '''
+    print('='*50 + '\n\t\t{}\n'.format(name) + '='*50)
+    stage = dict([('name', name), ('status', 'done'), ('time', 0.0), ('error', None), ('output', None)])
+    start = time.time()
+    try:
+        stage['output'] = function(*args, **kwargs)
+    except Exception as e:
+        stage['status'] = 'failed'
+        stage['error'] = '{}: {}'.format(type(e).__name__, e)
+        traceback.print_exc()
+    stage['time'] = time.time() - start
+    stages.append(stage)
+    print()
+    return stage
+
+def check_registration_jobs( jobs, text ):
+    '''
+    Raise an error when a registration job failed
+    Input:
+        jobs: list of dict. Registration jobs (see registration.py)
+        text: string. Name of the registrations in the error message
+    Output:
+        jobs: list of dict
+    '''
+    failed = [job['name'] for job in jobs if job['exit_code'] not in [0, None]]
+    if failed != []:
+        raise RuntimeError('{} failed: {}'.format(text, ', '.join(failed)))
+    return jobs
+
+def noise_video( folder_output, noise_model, noise_percent, overwrite = False, debug = False, 
+                    verbose = False, workers = 1, kspace = None, output_format = 'frames' ):
+    '''
+    Add noise to the frames of a video (folder_output/image to folder_output/noise). Only videos
+    written as frames are supported; the other output formats add the noise in the synthesis
+    (noise-fused in the yaml file)
+    Input:
+        folder_output: string. Output folder of the video
+        noise_model: string. gaussian, rician or kspace
+        noise_percent: float. Noise as a percentage of the image intensities
+        overwrite: bool
+        debug: bool
+        verbose: bool
+        workers: int. Number of processes
+        kspace: dict. Sampling mask of kspace noise (see noise_stack)
+        output_format: string. Output format of the video (see video_options)
+    Output:
+        files: list of strings. Output files
+    '''
+    if output_format != 'frames':
+        raise ValueError('Noise of {} videos is added in the synthesis, set noise-fused in the parameters '
+                         '(only frames videos are read by the noise stage)'.format(output_format))
+    opt = dict([('type', noise_model), ('stddev', noise_percent), ('percentage', True), ('workers', workers),
+                ('kspace', kspace), ('overwrite', overwrite), ('debug', debug), ('verbose', verbose)])
+    return noise_folder(os.path.join(folder_output, 'image'), os.path.join(folder_output, 'noise'), opt)
+
+def run_pipeline( folder_input, folder_model, folder_output, params, opt = 0 ):
+    '''
+    CineMRI simulation of a patient in a single process: breathing model (4dct00 to mr,
+    registration of the 4dct phases, reference to phase fields), video synthesis and noise.
+    The deformation fields composed by the phases stage stay in memory for the synthesis.
+    A failed stage stops the pipeline.
+    Input:
+        folder_input: string. Folder with 4dct, mr and rt folders
+        folder_model: string. Folder with the breathing model
+        folder_output: string. Output folder of the videos
+        params: dict. Parameters of the yaml file (see parameters.yaml)
+        opt: dict. Options (defaults in brackets): jobs [1] (registrations), render_workers [jobs]
+            (video synthesis), noise_workers [jobs] (noise stage), backend ['ants'], overwrite [False],
+            debug [False], verbose [False]
+    Output:
+        stages: list of dict. See run_stage and pipeline_report
+    '''
+    if opt == 0:
+        opt = dict()
+    if not 'jobs' in opt:       opt['jobs']      = 1
+    if not 'render_workers' in opt: opt['render_workers'] = opt['jobs']
+    if not 'noise_workers' in opt:  opt['noise_workers']  = opt['jobs']
+    if not 'backend' in opt:    opt['backend']   = 'ants'
+    if not 'overwrite' in opt:  opt['overwrite'] = False
+    if not 'debug' in opt:      opt['debug']     = False
+    if not 'verbose' in opt:    opt['verbose']   = False
+    popt = pipeline_options(params)
+    debug = opt['debug']
+
+    # Folders and Files
+    folder_4dct = os.path.join(folder_input, '4dct')
+    folder_mr = os.path.join(folder_input, 'mr')
+    folder_rt = os.path.join(folder_input, 'rt')
+
+    files_4dct = listdir_fullpath(folder_4dct)
+    file_4dct00 = files_4dct[0]
+    file_mr = listdir_fullpath(folder_mr)[0]
+
+    stages = []
+
+    # Breathing model
+    # - 4dct00 to mri
+    # - sequential registration (optionally cropped to the segments) and reference to phase fields,
+    #   or reference to phase registration (star topology)
+    folder_4dct_mr = os.path.join(folder_model, '4dct-mr/')
+    if not debug: os.makedirs(folder_4dct_mr, exist_ok=True)
+    stage = run_stage(stages, '4dct00 to mr', lambda: check_registration_jobs(
+                register_4dct00_mr(file_4dct00, file_mr, folder_4dct_mr, debug, overwrite = False), 'Registration stages'))
+    if stage['status'] != 'done': return stages
+
+    ropt = dict([('one_way', True), ('jobs', opt['jobs']), ('backend', opt['backend']),
+                ('debug', debug), ('verbose', opt['verbose'])])
+    if popt['roi_margin'] != None:
+        ropt['rtstruct'] = listdir_fullpath(folder_rt)[0]
+        ropt['margin'] = popt['roi_margin']
+        ropt['affine'] = os.path.join(folder_4dct_mr, '4dct00_to_mr_0GenericAffine.mat')
+        if popt['labels_segments'] != []: ropt['labels'] = popt['labels_segments']
+    if popt['topology'] == 'star':
+        ropt['star'] = True
+        ropt['reference'] = popt['ref_phase']
+    stage = run_stage(stages, 'Breathing Model', lambda: check_registration_jobs(
+                register_breathing_model(folder_4dct, folder_model, ropt), 'Registrations'))
+    if stage['status'] != 'done': return stages
+
+    # Deformation fields shared by the phases and synthesis stages. The phase fields are composed
+    # again when registrations ran (fields of changed registrations are also found by their sources)
+    cache = dfield_cache(video_options(params)['cache_mb'])
+    if popt['topology'] != 'star':
+        registered = stage['output'] != []
+        stage = run_stage(stages, 'Phase Fields', compose_phase_dfields, folder_model, popt['ref_phase'],
+                    len(files_4dct), registered, debug, opt['verbose'], cache)
+        if stage['status'] != 'done': return stages
+
+    # Video Simulation and Synthesis
+    stage = run_stage(stages, 'Video Simulation', video_simulation, folder_input, folder_model, folder_output,
+                params, opt['overwrite'], debug, opt['verbose'], opt['render_workers'], cache)
+    if opt['verbose']: print(dfield_cache_info(cache))
+    if stage['status'] != 'done': return stages
+
+    vopt = video_options(params)
+    if popt['noise_model'] != None and not vopt['noise_fused']:     # fused: noise written by the synthesis
+        run_stage(stages, 'Video Noise', noise_video, folder_output, popt['noise_model'], popt['noise_percent'],
+                opt['overwrite'], debug, opt['verbose'], opt['noise_workers'], vopt['noise_kspace'], vopt['output_format'])
+    return stages
+
+def pipeline_report( stages ):
+    '''
+    Table with status and wall time of the pipeline stages
+    Input:
+        stages: list of dict. Created by run_pipeline
+    Output:
+        string
+    '''
+    info = '\n{:<22}  {:>8}  {:>10}  {}'.format('stage', 'status', 'time (s)', 'error')
+    for stage in stages:
+        error = '' if stage['error'] is None else stage['error']
+        info += '\n{:<22}  {:>8}  {:>10.1f}  {}'.format(stage['name'], stage['status'], stage['time'], error)
+    total = sum([stage['time'] for stage in stages])
+    info += '\nTotal time (s): {:.1f}\n'.format(total)
+    return info
+
+def pipeline_failed( stages ):
+    '''
+    Check if a stage of the pipeline failed
+    Input:
+        stages: list of dict. Created by run_pipeline
+    Output:
+        bool
+    '''
+    return any([stage['status'] != 'done' for stage in stages])
@@ -5,36 +5,613 @@
 # @Last Modified time: 2021-08-02 22:33:35
 
 import os                       # os library
+import re                       # registration schedules
+import time                     # wall time of jobs
+import hashlib                  # registration keys
+import traceback                # errors of in-process registrations
+import threading                # pyramid cache shared by the job threads
+import subprocess               # run registrations
+import numpy as np
+import SimpleITK as sitk        # in-process registration backend
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
-def register_sequential_syn(file_4dct00, file_mr, output_path, debug = True, overwrite = True):
-    # Output file names
-    out_prefix = '{}to{}_'.format(os.path.splitext(os.path.basename(file_4dct00))[0][-2:], 
-                                os.path.splitext(os.path.basename(file_mr))[0][-2:])
-    output = os.path.join(output_path, out_prefix)
-    # print(out_prefix)
+from folder import file_sha256, publish_file
+
+# Registration cache. Registrations are identified by a key: the hash of the fixed and moving 
+# images and the registration command (without paths). Each output folder has a key file
+# (prefix + key.txt) for the existing registration, and a shared cache folder (option or 
+# environment variable CINEMRI_REGISTRATION_CACHE) keeps the outputs of every key:
+#   cache_folder/ab/abcdef.../0Warp.nii.gz
+
+def registration_cache_folder(cache_dir = None):
+    # Shared cache folder of registrations
+    # Input:
+    #   cache_dir: string. Folder. Default: environment variable CINEMRI_REGISTRATION_CACHE
+    # Output:
+    #   string or None (cache disabled)
+    if cache_dir is None:
+        cache_dir = os.environ.get('CINEMRI_REGISTRATION_CACHE')
+    return cache_dir if cache_dir else None
+
+def registration_key(files, cmd, output):
+    # Key of a registration. Paths are removed from the command, therefore the same images 
+    # and parameters give the same key in any folder
+    # Input:
+    #   files: list of strings. Input images (fixed, moving)
+    #   cmd: string. Registration command
+    #   output: string. Output prefix in the command
+    # Output:
+    #   string. sha256 hex digest or None when an input does not exist
+    if not all([os.path.isfile(f) for f in files]):
+        return None
+    params = cmd.replace(output, '{output}')
+    for k, f in enumerate(files):
+        params = params.replace(f, '{input' + str(k) + '}')
+    sha = hashlib.sha256()
+    for f in files:
+        sha.update(file_sha256(f).encode())
+    sha.update(' '.join(params.split()).encode())
+    return sha.hexdigest()
 
-    # Check if files already exist
-    output_already0 = out_prefix + '0Warp.nii.gz'
-    output_already1 = out_prefix + '0InverseWarp.nii.gz'
+def read_registration_key(output_path, out_prefix):
+    # Key of the registration in an output folder
+    # Output:
+    #   string or None
+    file_key = os.path.join(output_path, out_prefix + 'key.txt')
+    if not os.path.exists(file_key):
+        return None
+    with open(file_key, 'r') as f:
+        return f.read().strip()
 
-    write = True
-    files_overwrite = []
+def registration_cache_path(cache_dir, key):
+    # Folder of a key in the shared cache
+    return os.path.join(cache_dir, key[:2], key)
+
+def restore_registration(cache_dir, key, output_path, out_prefix, outputs):
+    # Publish the cached outputs of a key in the output folder (hard link or copy)
+    # Output:
+    #   bool. True if the registration was in the cache
+    if cache_dir is None or key is None:
+        return False
+    path = registration_cache_path(cache_dir, key)
+    if not all([os.path.exists(os.path.join(path, f)) for f in outputs]):
+        return False
+    for f in outputs:
+        publish_file(os.path.join(path, f), os.path.join(output_path, out_prefix + f))
+    with open(os.path.join(output_path, out_prefix + 'key.txt'), 'w') as f:
+        f.write(key + '\n')
+    return True
+
+def store_registration(job):
+    # Write the key file of a finished registration and add its outputs to the shared cache
+    # Input:
+    #   job: dict. Created with registration_job
+    key = job['key']
+    if key is None:
+        return
+    output = os.path.join(job['output_path'], job['name'])
+    with open(output + 'key.txt', 'w') as f:
+        f.write(key + '\n')
+    if job['cache_dir'] is None:
+        return
+    path = registration_cache_path(job['cache_dir'], key)
+    if os.path.isdir(path):
+        return
+    tmp = '{}.{}.part'.format(path, os.getpid())
+    os.makedirs(tmp, exist_ok = True)
+    for f in job['outputs']:
+        publish_file(output + f, os.path.join(tmp, f))
+    try:
+        os.rename(tmp, path)                    # complete entries only
+    except OSError:                             # entry added by another job
+        for f in os.listdir(tmp):
+            os.remove(os.path.join(tmp, f))
+        os.rmdir(tmp)
+
+def check_registration(output_path, out_prefix, outputs, key, overwrite, cache_dir):
+    # Decide if a registration has to run. Existing registrations are kept when their key 
+    # is unchanged (or unknown), and cached registrations are restored
+    # Input:
+    #   output_path: string. Folder of the output
+    #   out_prefix: string. Output prefix
+    #   outputs: list of strings. Output files (without prefix)
+    #   key: string. Registration key
+    #   overwrite: bool. Run the registration always
+    #   cache_dir: string. Shared cache folder or None
+    # Output:
+    #   bool. True if the registration has to run
     if overwrite:
-        write = True
+        return True
+    existing = os.path.exists(os.path.join(output_path, out_prefix + outputs[0]))
+    old_key = read_registration_key(output_path, out_prefix)
+    if existing and (old_key is None or old_key == key):
+        os.system('echo [Warning] Existing registration {}. Continue. Use option -w to overwrite'.format(out_prefix + outputs[0]))
+        return False
+    if restore_registration(cache_dir, key, output_path, out_prefix, outputs):
+        os.system('echo Registration {} restored from cache {}'.format(out_prefix, cache_dir))
+        return False
+    if existing:
+        os.system('echo Registration {} with different inputs or parameters. Registering again'.format(out_prefix))
+    return True
+
+def registration_job(name, cmd, output_path, log = True):
+    # Registration job to run with run_registration_job or run_registration_jobs
+    # Input:
+    #   name: string. Output prefix of the registration
+    #   cmd: string. antsRegistration command
+    #   output_path: string. Folder of the output
+    #   log: bool. Write the output of the command to a log file (name + log.txt)
+    # Output:
+    #   job: dict
+    log_file = os.path.join(output_path, name + 'log.txt') if log else None
+    return dict([('name', name), ('cmd', cmd), ('log', log_file), ('output_path', output_path),
+            ('outputs', []), ('key', None), ('cache_dir', None), ('post', []), 
+            ('exit_code', None), ('time', 0.0), ('iterations', None)])
+
+def run_registration_job(job, threads = 0, debug = False):
+    # Run a registration job in a subprocess. Exit code and wall time are stored in the job
+    # Input:
+    #   job: dict. Created with registration_job
+    #   threads: int. ITK threads of the job (0 = default, all cores). In-process jobs set the 
+    #            threads of their filters (see register_demons)
+    #   debug: bool. Only print the command
+    # Output:
+    #   job: dict
+    if debug:
+        os.system('echo ' + job['cmd'])
+        return job
+
+    # Outputs are removed, not overwritten. They can be links to files in the cache
+    for f in job['outputs']:
+        output = os.path.join(job['output_path'], job['name'] + f)
+        if os.path.exists(output): os.remove(output)
+
+    env = dict(os.environ)
+    if threads > 0:
+        env['ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS'] = str(threads)
+    start = time.time()
+    if 'prepare' in job:                        # e.g. choose the schedule of a warm start
+        job['prepare'](job)
+    os.system('echo ' + job['cmd'])
+    if 'function' in job:                       # in-process registration (SimpleITK backend)
+        log = open(job['log'], 'w') if job['log'] is not None else None
+        try:                                    # threads of the filters of this job only
+            job['iterations'] = job['function'](log = log, threads = threads, **job['arguments'])
+            job['exit_code'] = 0
+        except Exception:
+            print(traceback.format_exc(), file = log)
+            job['exit_code'] = 1
+        if log is not None: log.close()
+    elif job['log'] is None:
+        job['exit_code'] = subprocess.call(job['cmd'], shell = True, env = env)
     else:
+        with open(job['log'], 'w') as log:
+            job['exit_code'] = subprocess.call(job['cmd'], shell = True, env = env, 
+                                    stdout = log, stderr = subprocess.STDOUT)
+        job['iterations'] = registration_iterations(job['log'])
+    # Post processing steps in order, e.g. warm start composition, embedding of a cropped registration
+    for function, arguments in (job['post'] if job['exit_code'] == 0 else []):
         try:
-            files_overwrite = os.listdir(output_path)
-        except:
-            pass
-        if output_already0 in files_overwrite:
-            write = False
-            os.system('echo [Warning] Existing registration {}. Continue. Use option -w to overwrite'.format(output_already0))
-        elif output_already1 in files_overwrite:
-            write = False
-            os.system('echo [Warning] Existing registration {}. Continue. Use option -w to overwrite'.format(output_already1))
-        else:
-            write = True
-    
+            function(**arguments)
+        except Exception:
+            if job['log'] is None: print(traceback.format_exc())
+            else:
+                with open(job['log'], 'a') as log: print(traceback.format_exc(), file = log)
+            job['exit_code'] = 1
+            break
+    job['time'] = time.time() - start
+    if job['exit_code'] == 0:
+        store_registration(job)
+    return job
+
+def run_registration_jobs(jobs, workers = 1, threads = 0, debug = False):
+    # Run registration jobs in a bounded pool of subprocesses. The ITK threads are split
+    # between the jobs that run at the same time
+    # Input:
+    #   jobs: list of dict. Created with registration_job
+    #   workers: int. Maximum number of registrations at the same time
+    #   threads: int. Total ITK threads (0 = number of cores)
+    #   debug: bool. Only print the commands
+    # Output:
+    #   jobs: list of dict with exit code and wall time
+    if jobs == []: return jobs
+    workers = max(1, min(workers, len(jobs)))
+    total = threads if threads > 0 else (os.cpu_count() or 1)
+    threads_job = max(1, total//workers)
+    with ThreadPoolExecutor(max_workers = workers) as pool:
+        futures = [pool.submit(run_registration_job, job, threads_job, debug) for job in jobs]
+        return [future.result() for future in futures]
+
+def run_registration_chains(chains, workers = 1, threads = 0, debug = False):
+    # Run chains of registration jobs. The jobs of a chain run in order (e.g. each job is warm 
+    # started with the result of the previous one) and the chains run in parallel. A chain 
+    # stops at the first failed job
+    # Input:
+    #   chains: list of lists of dict. Created with registration_job
+    #   workers: int. Maximum number of chains at the same time
+    #   threads: int. Total ITK threads (0 = number of cores)
+    #   debug: bool. Only print the commands
+    # Output:
+    #   jobs: list of dict with exit code and wall time
+    def run_chain(chain, threads_job):
+        for job in chain:
+            run_registration_job(job, threads_job, debug)
+            if not debug and job['exit_code'] != 0:
+                break
+        return chain
+
+    chains = [chain for chain in chains if chain != []]
+    if chains == []: return []
+    workers = max(1, min(workers, len(chains)))
+    total = threads if threads > 0 else (os.cpu_count() or 1)
+    threads_job = max(1, total//workers)
+    with ThreadPoolExecutor(max_workers = workers) as pool:
+        futures = [pool.submit(run_chain, chain, threads_job) for chain in chains]
+        return [job for future in futures for job in future.result()]
+
+def registration_iterations(log_file):
+    # Number of iterations in the log of antsRegistration --verbose (one DIAGNOSTIC line per iteration)
+    # Output:
+    #   int or None
+    if log_file is None or not os.path.exists(log_file):
+        return None
+    with open(log_file, 'r', errors = 'ignore') as f:
+        return sum([1 for line in f if line.lstrip()[:1].isdigit() and 'DIAGNOSTIC,' in line])
+
+def registration_report(jobs):
+    # Table with exit code, iterations, wall time and log file of registration jobs
+    # Input:
+    #   jobs: list of dict
+    # Output:
+    #   string
+    info = '\n{:<22}  {:>6}  {:>10}  {:>10}  {}'.format('job', 'exit', 'iterations', 'time (s)', 'log')
+    for job in jobs:
+        exit_code = '-' if job['exit_code'] is None else str(job['exit_code'])
+        iterations = '-' if job['iterations'] is None else str(job['iterations'])
+        info += '\n{:<22}  {:>6}  {:>10}  {:>10.1f}  {}'.format(job['name'], exit_code, iterations, job['time'], job['log'])
+    total = sum([job['time'] for job in jobs])
+    info += '\nTotal job time (s): {:.1f}\n'.format(total)
+    return info
+
+def sequential_prefix(file_fixed, file_moving):
+    # Output prefix of a sequential registration. Last two characters of the file names (phase numbers)
+    # Output:
+    #   string. e.g. 00to01_
+    return '{}to{}_'.format(os.path.splitext(os.path.basename(file_fixed))[0][-2:], 
+                            os.path.splitext(os.path.basename(file_moving))[0][-2:])
+
+def publish_inverse_registration(file_fixed, file_moving, output_path):
+    # Publish the sequential registration moving to fixed with the outputs of fixed to moving. 
+    # SyN is symmetric: the warp of moving to fixed is the inverse warp of fixed to moving and viceversa.
+    # The key file of the reverse registration refers to the forward key, therefore a later 
+    # registration of the reverse direction is not skipped. No Warped image is published
+    # Input:
+    #   file_fixed: string. Fixed image of the registration
+    #   file_moving: string. Moving image of the registration
+    #   output_path: string. Folder of the output
+    # Output:
+    #   forward, reverse: strings. Output prefixes
+    forward = sequential_prefix(file_fixed, file_moving)
+    reverse = sequential_prefix(file_moving, file_fixed)
+    for src, dst in [('0InverseWarp.nii.gz', '0Warp.nii.gz'), ('0Warp.nii.gz', '0InverseWarp.nii.gz')]:
+        publish_file(os.path.join(output_path, forward + src), os.path.join(output_path, reverse + dst))
+
+    key = read_registration_key(output_path, forward)
+    file_key = os.path.join(output_path, reverse + 'key.txt')
+    if key is None:
+        if os.path.exists(file_key): os.remove(file_key)
+    else:
+        with open(file_key, 'w') as f:
+            f.write('inverse:' + key + '\n')
+    return forward, reverse
+
+# SimpleITK backend. Multi-resolution demons registration (fast symmetric forces) in process.
+# The pyramid of every image is kept in a cache: each 4DCT phase takes part in two sequential 
+# registrations (as fixed and as moving) and its pyramid is built only once. The cache is shared 
+# by the jobs running in threads (see run_registration_jobs) and guarded with a lock.
+
+def pyramid_cache(max_items = 4):
+    # Cache of image pyramids (least recently used pyramids are removed)
+    # Input:
+    #   max_items: int. Maximum number of pyramids. Use at least the number of images to build 
+    #       every pyramid once
+    # Output:
+    #   cache: dict
+    return dict([('pyramids', OrderedDict()), ('max_items', max_items), ('hits', 0), ('misses', 0),
+                 ('lock', threading.Lock()), ('building', dict())])
+
+def _pyramid_cache_get(cache, key):
+    # Pyramid in the cache or None. Call with cache['lock'] held
+    pyramid = cache['pyramids'].get(key)
+    if pyramid is not None:
+        cache['hits'] += 1
+        cache['pyramids'].move_to_end(key)
+    return pyramid
+
+def image_pyramid(file, shrink_factors, smoothing_sigmas, cache = None, threads = 0):
+    # Multi-resolution pyramid of an image. Each level is smoothed (sigma in voxels) and shrunk.
+    # Shrink factors are reduced for small images (at least 8 voxels per dimension)
+    # Input:
+    #   file: string. Image file
+    #   shrink_factors: list of int. One per level, e.g. [8,4,2,1]
+    #   smoothing_sigmas: list of float. One per level, e.g. [3,2,1,0]
+    #   cache: dict. Created with pyramid_cache (optional)
+    #   threads: int. Threads of the filters (0: default)
+    # Output:
+    #   list of sitk.Image (float32). Coarse to fine
+    key = (os.path.abspath(file), os.stat(file).st_mtime_ns, tuple(shrink_factors), tuple(smoothing_sigmas))
+    if cache is None:
+        return build_image_pyramid(file, shrink_factors, smoothing_sigmas, threads)
+
+    with cache['lock']:
+        pyramid = _pyramid_cache_get(cache, key)
+        if pyramid is not None: return pyramid
+        building = cache['building'].setdefault(key, threading.Lock())
+    with building:                  # one thread builds the pyramid, the others wait for it
+        with cache['lock']:
+            pyramid = _pyramid_cache_get(cache, key)
+        if pyramid is None:
+            pyramid = build_image_pyramid(file, shrink_factors, smoothing_sigmas, threads)
+            with cache['lock']:
+                cache['misses'] += 1
+                cache['pyramids'][key] = pyramid
+                while len(cache['pyramids']) > cache['max_items']:
+                    cache['pyramids'].popitem(last = False)
+    with cache['lock']:
+        cache['building'].pop(key, None)
+    return pyramid
+
+def build_image_pyramid(file, shrink_factors, smoothing_sigmas, threads = 0):
+    # Multi-resolution pyramid of an image, without cache (see image_pyramid)
+    image = sitk.ReadImage(file, sitk.sitkFloat32)
+    smooth = sitk.SmoothingRecursiveGaussianImageFilter()
+    shrink = sitk.ShrinkImageFilter()
+    if threads > 0:
+        smooth.SetNumberOfThreads(threads)
+        shrink.SetNumberOfThreads(threads)
+    pyramid = []
+    for factor, sigma in zip(shrink_factors, smoothing_sigmas):
+        level = image
+        if sigma > 0:
+            smooth.SetSigma([sigma*sp for sp in image.GetSpacing()])
+            level = smooth.Execute(level)
+        factors = [max(1, min(factor, size//8)) for size in image.GetSize()]
+        if max(factors) > 1:
+            shrink.SetShrinkFactors(factors)
+            level = shrink.Execute(level)
+        pyramid.append(level)
+    return pyramid
+
+def register_demons(file_fixed, file_moving, output, shrink_factors = [8,4,2,1], smoothing_sigmas = [3,2,1,0],
+                    iterations = [100,70,50,20], std_deviation = 1.5, initial_field = None, cache = None, log = None, 
+                    threads = 0):
+    # Deformable registration with multi-resolution demons. The field of each level initializes 
+    # the next level. Outputs have the names of antsRegistration (fields map fixed points to moving):
+    #   output + 0Warp.nii.gz, output + 0InverseWarp.nii.gz, output + Warped.nii.gz
+    # Input:
+    #   file_fixed: string. Fixed image
+    #   file_moving: string. Moving image
+    #   output: string. Output prefix
+    #   shrink_factors, smoothing_sigmas, iterations: lists. One value per level (coarse to fine)
+    #   std_deviation: float. Smoothing of the displacement field (pixels of each level)
+    #   initial_field: string. Deformation field file to initialize the first level (optional)
+    #   cache: dict. Pyramid cache, created with pyramid_cache (optional)
+    #   log: file. Registration log (default: standard output)
+    #   threads: int. Threads of the filters of this registration (0: default). The global ITK 
+    #       default is shared by all the jobs and is not changed
+    # Output:
+    #   int. Total number of iterations
+    fixed_pyramid = image_pyramid(file_fixed, shrink_factors, smoothing_sigmas, cache, threads)
+    moving_pyramid = image_pyramid(file_moving, shrink_factors, smoothing_sigmas, cache, threads)
+
+    demons = sitk.FastSymmetricForcesDemonsRegistrationFilter()
+    resample = sitk.ResampleImageFilter()
+    resample.SetInterpolator(sitk.sitkLinear)
+    resample.SetOutputPixelType(sitk.sitkVectorFloat64)
+    invert = sitk.InvertDisplacementFieldImageFilter()
+    invert.SetMaximumNumberOfIterations(20)
+    invert.SetMaxErrorToleranceThreshold(0.1)
+    invert.SetMeanErrorToleranceThreshold(0.001)
+    invert.SetEnforceBoundaryCondition(True)
+    if threads > 0:
+        for filt in [demons, resample, invert]: filt.SetNumberOfThreads(threads)
+    demons.SetStandardDeviations(std_deviation)
+    demons.SetSmoothDisplacementField(True)
+    field = None
+    if initial_field is not None:
+        field = sitk.ReadImage(initial_field, sitk.sitkVectorFloat64)
+    total_iterations = 0
+    for level, (fixed, moving, num_iterations) in enumerate(zip(fixed_pyramid, moving_pyramid, iterations)):
+        if field is None:
+            field = sitk.Image(fixed.GetSize(), sitk.sitkVectorFloat64)
+            field.CopyInformation(fixed)
+        else:       # previous level field in the grid of this level
+            resample.SetReferenceImage(fixed)
+            field = resample.Execute(field)
+        demons.SetNumberOfIterations(num_iterations)
+        field = demons.Execute(fixed, moving, field)
+        total_iterations += demons.GetElapsedIterations()
+        print('Level {}: size {}, iterations {}, metric {:.6f}'.format(level, fixed.GetSize(), 
+            demons.GetElapsedIterations(), demons.GetMetric()), file = log)
+
+    fixed = fixed_pyramid[-1]
+    if field.GetSize() != fixed.GetSize():      # coarse last level
+        resample.SetReferenceImage(fixed)
+        field = resample.Execute(field)
+    inverse = invert.Execute(field)
+    sitk.WriteImage(field, output + '0Warp.nii.gz')
+    sitk.WriteImage(inverse, output + '0InverseWarp.nii.gz')
+
+    moving = sitk.ReadImage(file_moving)
+    warp = sitk.ResampleImageFilter()
+    warp.SetReferenceImage(sitk.ReadImage(file_fixed))
+    warp.SetTransform(sitk.DisplacementFieldTransform(sitk.Image(field)))
+    warp.SetInterpolator(sitk.sitkLinear)
+    if threads > 0: warp.SetNumberOfThreads(threads)
+    sitk.WriteImage(warp.Execute(moving), output + 'Warped.nii.gz')
+    print('Output: ' + output, file = log)
+    return total_iterations
+
+# Warm start. A sequential registration can be initialized with the field of the previous pair
+# (neighbouring breathing phases have similar motion). When the initial field already explains most
+# of the difference between the images, the coarsest level of the schedule is skipped.
+
+def warm_start_similarity(file_fixed, file_moving, file_initial, shrink = 4):
+    # Mean squared difference between the images without and with the initial field (coarse resolution)
+    # Input:
+    #   file_fixed, file_moving: strings. Images
+    #   file_initial: string. Initial deformation field
+    #   shrink: int. Shrink factor of the images
+    # Output:
+    #   mse_identity, mse_initial: float
+    fixed = sitk.ReadImage(file_fixed, sitk.sitkFloat32)
+    moving = sitk.ReadImage(file_moving, sitk.sitkFloat32)
+    fixed = sitk.Shrink(fixed, [max(1, min(shrink, size//8)) for size in fixed.GetSize()])
+    initial = sitk.DisplacementFieldTransform(sitk.ReadImage(file_initial, sitk.sitkVectorFloat64))
+    array_fixed = sitk.GetArrayViewFromImage(fixed)
+    mse = []
+    for transform in [sitk.Transform(), initial]:
+        warped = sitk.Resample(moving, fixed, transform, sitk.sitkLinear, 0.0)
+        mse.append(float(np.mean((sitk.GetArrayViewFromImage(warped) - array_fixed)**2)))
+    return mse[0], mse[1]
+
+def skip_coarse_level(cmd):
+    # Remove the coarsest level of the schedule of a registration command
+    for option in ['--convergence \\[', '--iterations ', '--shrink-factors ', '--smoothing-sigmas ']:
+        cmd = re.sub('(' + option + ')[0-9.]+x', '\\1', cmd)
+    return cmd
+
+def prepare_warm_start(job):
+    # Choose the schedule of a warm started job before it runs (the initial field is the result 
+    # of the previous job). The coarsest level is skipped when the similarity is high
+    # Input:
+    #   job: dict. Keys used: initial (dict with file, fixed, moving, ratio), cmd, arguments (sitk backend)
+    initial = job['initial']
+    if not os.path.exists(initial['file']):
+        raise IOError('Missing initial field of warm start: ' + initial['file'])
+    mse_identity, mse_initial = warm_start_similarity(initial['fixed'], initial['moving'], initial['file'])
+    short = mse_initial <= initial['ratio']*mse_identity
+    job['warm_start'] = 'short' if short else 'full'
+    print('Warm start {}: mse identity {:.4f}, mse initial {:.4f}, schedule {}'.format(job['name'], 
+            mse_identity, mse_initial, job['warm_start']))
+    if short:
+        job['cmd'] = skip_coarse_level(job['cmd'])
+        if 'arguments' in job:
+            for key in ['shrink_factors', 'smoothing_sigmas', 'iterations']:
+                job['arguments'][key] = job['arguments'][key][1:]
+
+def collapse_warm_start(output):
+    # Outputs of an antsRegistration warm started with a displacement field. The initial field and 
+    # the SyN field are composed in 0Warp when antsRegistration writes them apart (0Warp, 1Warp), 
+    # and the inverse is computed when it is missing (the initial field has no inverse)
+    # Input:
+    #   output: string. Output prefix
+    if os.path.exists(output + '1Warp.nii.gz'):
+        initial = sitk.ReadImage(output + '0Warp.nii.gz', sitk.sitkVectorFloat64)
+        syn = sitk.ReadImage(output + '1Warp.nii.gz', sitk.sitkVectorFloat64)
+        composite = sitk.CompositeTransform(3)
+        composite.AddTransform(sitk.DisplacementFieldTransform(initial))
+        composite.AddTransform(sitk.DisplacementFieldTransform(sitk.Image(syn)))    # applied first
+        field = sitk.TransformToDisplacementField(composite, sitk.sitkVectorFloat64, syn.GetSize(),
+                    syn.GetOrigin(), syn.GetSpacing(), syn.GetDirection())
+        sitk.WriteImage(field, output + '0Warp.nii.gz')
+        for name in ['1Warp.nii.gz', '1InverseWarp.nii.gz', '0InverseWarp.nii.gz']:
+            if os.path.exists(output + name): os.remove(output + name)
+    if not os.path.exists(output + '0InverseWarp.nii.gz'):
+        field = sitk.ReadImage(output + '0Warp.nii.gz', sitk.sitkVectorFloat64)
+        inverse = sitk.InvertDisplacementField(field, maximumNumberOfIterations = 20, 
+                maxErrorToleranceThreshold = 0.1, meanErrorToleranceThreshold = 0.001, enforceBoundaryCondition = True)
+        sitk.WriteImage(inverse, output + '0InverseWarp.nii.gz')
+
+# Region of interest (ROI). Sequential registrations can run on the images cropped to a box around 
+# the contoured structures plus a motion margin. The fields are embedded back (zero displacement 
+# outside the box) into the full image geometry for rendering.
+
+def image_roi(file_reference, point_min, point_max, margin, folder):
+    # Region of an image that contains a box in world coordinates plus a margin
+    # Input:
+    #   file_reference: string. Image with the geometry of the 4dct
+    #   point_min, point_max: lists. Box corners in world coordinates (mm)
+    #   margin: float. Margin added to the box in every direction (mm)
+    #   folder: string. Folder for the cropped images
+    # Output:
+    #   roi: dict. Keys: index, size (region in voxels), full_size, folder, files (cropped in this run)
+    reader = sitk.ImageFileReader()
+    reader.SetFileName(file_reference)
+    reader.ReadImageInformation()
+    geometry = sitk.Image([1,1,1], sitk.sitkUInt8)      # geometry only, the size is not used
+    geometry.SetOrigin(reader.GetOrigin())
+    geometry.SetSpacing(reader.GetSpacing())
+    geometry.SetDirection(reader.GetDirection())
+
+    corners = [[x, y, z] for x in [point_min[0] - margin, point_max[0] + margin]
+                         for y in [point_min[1] - margin, point_max[1] + margin]
+                         for z in [point_min[2] - margin, point_max[2] + margin]]
+    indexes = [geometry.TransformPhysicalPointToContinuousIndex([float(v) for v in c]) for c in corners]
+    full_size = list(reader.GetSize())
+    index = [max(0, int(min([i[d] for i in indexes]))) for d in range(3)]
+    upper = [min(full_size[d] - 1, int(max([i[d] for i in indexes])) + 1) for d in range(3)]
+    size = [max(1, upper[d] - index[d] + 1) for d in range(3)]
+    return dict([('index', index), ('size', size), ('full_size', full_size), ('folder', folder), ('files', set())])
+
+def roi_crop_file(file, roi, debug = False):
+    # Crop an image to the region of interest. Each image is cropped once per run
+    # Input:
+    #   file: string. Image file
+    #   roi: dict. Created with image_roi
+    #   debug: bool. Do not write the cropped image
+    # Output:
+    #   string. Cropped image file (same file name in the roi folder)
+    file_crop = os.path.join(roi['folder'], os.path.basename(file))
+    if not debug and not file in roi['files']:
+        os.makedirs(roi['folder'], exist_ok = True)
+        image = sitk.ReadImage(file)
+        sitk.WriteImage(sitk.RegionOfInterest(image, roi['size'], roi['index']), file_crop)
+        roi['files'].add(file)
+    return file_crop
+
+def embed_registration(output, outputs, file_fixed, file_moving, index):
+    # Embed the outputs of a cropped registration in the full image geometry. Displacements 
+    # outside the region are zero, and the warped image outside the region is the moving image
+    # Input:
+    #   output: string. Output prefix
+    #   outputs: list of strings. Output files (without prefix)
+    #   file_fixed, file_moving: strings. Full images
+    #   index: list of int. First voxel of the region
+    reader = sitk.ImageFileReader()
+    reader.SetFileName(file_fixed)
+    reader.ReadImageInformation()
+    for name in outputs:
+        crop = sitk.ReadImage(output + name)
+        if 'Warp.nii' in name:      # 0Warp, 0InverseWarp
+            full = sitk.Image(list(reader.GetSize()), crop.GetPixelID())
+            full.SetOrigin(reader.GetOrigin())
+            full.SetSpacing(reader.GetSpacing())
+            full.SetDirection(reader.GetDirection())
+        else:                       # Warped
+            full = sitk.Cast(sitk.ReadImage(file_moving), crop.GetPixelID())
+        full = sitk.Paste(full, crop, crop.GetSize(), [0,0,0], index)
+        sitk.WriteImage(full, output + name)
+
+def register_sequential_syn(file_4dct00, file_mr, output_path, debug = True, overwrite = True, run = True, cache_dir = None,
+                            backend = 'ants', pyramids = None, roi = None, initial = None, warm_ratio = 0.5):
+    # Sequential registration. Backends: ants (antsRegistration SyN) or sitk (SimpleITK demons in process,
+    # pyramids shared through a pyramid cache). With a roi (see image_roi) the cropped images are 
+    # registered and the outputs embedded in the full geometry. With initial (dict with the file and 
+    # the key of the previous registration) the registration is warm started, and the coarsest level 
+    # is skipped if the initial mean squared difference is below warm_ratio of the identity one
+    # Output file names
+    out_prefix = sequential_prefix(file_4dct00, file_mr)
+    output = os.path.join(output_path, out_prefix)
+    outputs = ['0Warp.nii.gz', '0InverseWarp.nii.gz', 'Warped.nii.gz']
+    # print(out_prefix)
+
+    files = [file_4dct00, file_mr]      # full images
+    if roi is not None:
+        file_4dct00 = roi_crop_file(file_4dct00, roi, debug)
+        file_mr = roi_crop_file(file_mr, roi, debug)
+
     # Command for registration
     cmd = 'antsRegistration --verbose 1 --dimensionality 3 --float 0\
     --output [{}, {}Warped.nii.gz]\
@@ -44,54 +621,245 @@ def register_sequential_syn(file_4dct00, file_mr, output_path, debug = True, ove
     --metric CC[{},{},1,4] --convergence [250x250x90x30,1e-6,15]\
     --shrink-factors 8x4x2x1 --smoothing-sigmas 3x2x1x0vox\
     '.format(output, output, file_4dct00, file_mr)
+    if backend == 'sitk':   # command of the registration. Used as a record and for the registration key
+        arguments = dict([('file_fixed', file_4dct00), ('file_moving', file_mr), ('output', output), ('cache', pyramids)])
+        cmd = 'register_demons --fixed {} --moving {} --output {} --shrink-factors 8x4x2x1\
+        --smoothing-sigmas 3x2x1x0vox --iterations 100x70x50x20 --std-deviation 1.5\
+        '.format(file_4dct00, file_mr, output)
+        arguments.update([('shrink_factors', [8,4,2,1]), ('smoothing_sigmas', [3,2,1,0]), ('iterations', [100,70,50,20])])
+    cmd_key = cmd
+    if initial is not None:     # warm start. The key depends on the previous registration
+        if backend == 'sitk':
+            arguments['initial_field'] = initial['file']
+            cmd += ' --initial-field {}'.format(initial['file'])
+        else:
+            cmd += ' --initial-moving-transform {}'.format(initial['file'])
+        cmd_key = cmd.replace(initial['file'], '{initial}') + ' --initial-key {} --warm-ratio {}'.format(initial['key'], warm_ratio)
 
-    # Execute the command
-    if write:
-        os.system('echo ' + cmd)
-        if not debug:
-            os.system(cmd)
+    # Check if the registration already exists (same key) or is in the cache
+    cache_dir = registration_cache_folder(cache_dir)
+    key = registration_key([file_4dct00, file_mr] + (files if roi is not None else []), cmd_key, output)
+    write = check_registration(output_path, out_prefix, outputs, key, overwrite, cache_dir)
 
-def register_4dct00_mr(file_4dct00, file_mr, output_path, debug = True, overwrite = True):
+    # Execute the command. Without run the job is returned to be scheduled
+    if not write:
+        return None
+    job = registration_job(out_prefix, cmd, output_path, log = not run)
+    job.update([('outputs', outputs), ('key', key), ('cache_dir', cache_dir)])
+    if backend == 'sitk':
+        job.update([('function', register_demons), ('arguments', arguments)])
+    if initial is not None:
+        job.update([('prepare', prepare_warm_start), ('initial', dict([('file', initial['file']), 
+                    ('fixed', file_4dct00), ('moving', file_mr), ('ratio', warm_ratio)]))])
+        if backend != 'sitk':
+            job['post'].append((collapse_warm_start, dict([('output', output)])))
+    if roi is not None:
+        job['post'].append((embed_registration, dict([('output', output), ('outputs', outputs), 
+                    ('file_fixed', files[0]), ('file_moving', files[1]), ('index', roi['index'])])))
+    if run:
+        run_registration_job(job, debug = debug)
+    return job
+
+def register_4dct00_mr(file_4dct00, file_mr, output_path, debug = True, overwrite = True, run = True, cache_dir = None):
+    # Registration 4dct00 to mr in three stages: rigid, affine and SyN. Each stage is a checkpoint with 
+    # its own key (parameters, inputs and key of the previous stage) and is initialized with the linear
+    # transform of the previous stage. Only the stages after a change run again. Outputs:
+    #   4dct00_to_mr_rigid_0GenericAffine.mat, 4dct00_to_mr_affine_0GenericAffine.mat (checkpoints)
+    #   4dct00_to_mr_0GenericAffine.mat, 4dct00_to_mr_1Warp.nii.gz, ... (final, as a single registration)
+    # Output:
+    #   jobs: list of dict. Stages to run, in order (a chain, see run_registration_chains)
 
     # Output file names
     out_prefix = '4dct00_to_mr_'
-    output = os.path.join(output_path, out_prefix)
-
-    # Check if file already exist
-    output_already = out_prefix + '1Warp.nii.gz'
-    
-    write = True
-    files_overwrite = []
-    if overwrite:
-        write = True
-    else:
-        try:
-            files_overwrite = os.listdir(output_path)
-        except:
-            pass
-        if output_already in files_overwrite:
-            write = False
-            os.system('echo [Warning] Existing registration {}. Continue. Use option -w to overwrite'.format(output_already))
-        else:
-            write = True
+    stages = [('rigid', out_prefix + 'rigid_', ['0GenericAffine.mat']),
+              ('affine', out_prefix + 'affine_', ['0GenericAffine.mat']),
+              ('syn', out_prefix, ['1Warp.nii.gz', '1InverseWarp.nii.gz', '0GenericAffine.mat', 
+                                   'Warped.nii.gz', 'InverseWarped.nii.gz'])]
 
-    # Command for registration
-    cmd = 'antsRegistration --verbose 1 --dimensionality 3 --float 0\
-    --output [{},{}Warped.nii.gz,{}InverseWarped.nii.gz]\
+    # Commands for registration
+    cmd_base = 'antsRegistration --verbose 1 --dimensionality 3 --float 0\
     --interpolation Linear --use-histogram-matching 0\
     --winsorize-image-intensities [0.005,0.995]\
+    '
+    cmd_stage = dict()
+    cmd_stage['rigid'] = '--output [{}]\
     --initial-moving-transform [{},{},1]\
     --transform Rigid[0.1] --metric MI[{},{},1,32,Regular,0.25]\
     --convergence [1000x500x250x100,1e-6,10] --shrink-factors 12x8x4x2 --smoothing-sigmas 4x3x2x1vox\
+    '
+    cmd_stage['affine'] = '--output [{}]\
+    --initial-moving-transform {}\
     --transform Affine[0.1] --metric MI[{},{},1,32,Regular,0.25]\
     --convergence [1000x500x250x100,1e-6,10] --shrink-factors 12x8x4x2 --smoothing-sigmas 4x3x2x1vox\
-    --transform SyN[0.1,3,0] --metric CC[{},{},1,4]\
+    '
+    cmd_stage['syn'] = '--output [{0},{0}Warped.nii.gz,{0}InverseWarped.nii.gz]\
+    --initial-moving-transform {1}\
+    --transform SyN[0.1,3,0] --metric CC[{2},{3},1,4]\
     --convergence [250x200x180x90x25,1e-6,10] --shrink-factors 10x6x4x2x1 --smoothing-sigmas 5x3x2x1x0vox\
-    '.format(output, output, output, file_4dct00, file_mr, file_4dct00, file_mr, 
-    file_4dct00, file_mr, file_4dct00, file_mr)
-
-    # Execute the command
-    if write:
-        os.system('echo ' + cmd)
-        if not debug:
-            os.system(cmd)
\ No newline at end of file
+    '
+
+    # Registration of a previous version (single command, without key)
+    file_final = os.path.join(output_path, out_prefix + stages[-1][2][0])
+    if not overwrite and os.path.exists(file_final) and read_registration_key(output_path, out_prefix) is None:
+        os.system('echo [Warning] Existing registration {}. Continue. Use option -w to overwrite'.format(file_final))
+        return []
+
+    cache_dir = registration_cache_folder(cache_dir)
+    jobs = []
+    previous_key = None
+    file_initial = None
+    for stage, prefix, outputs in stages:
+        output = os.path.join(output_path, prefix)
+        if stage == 'rigid':
+            cmd = cmd_base + cmd_stage[stage].format(output, file_4dct00, file_mr, file_4dct00, file_mr)
+            cmd_key = cmd
+        else:
+            cmd = cmd_base + cmd_stage[stage].format(output, file_initial, file_4dct00, file_mr)
+            cmd_key = cmd.replace(file_initial, '{initial}') + ' --initial-key {}'.format(previous_key)
+
+        # Check if the stage already exists (same key) or is in the cache
+        key = registration_key([file_4dct00, file_mr], cmd_key, output)
+        if check_registration(output_path, prefix, outputs, key, overwrite, cache_dir):
+            job = registration_job(prefix, cmd, output_path, log = not run)
+            job.update([('outputs', outputs), ('key', key), ('cache_dir', cache_dir)])
+            jobs.append(job)
+        else:
+            key = read_registration_key(output_path, prefix)
+        previous_key = key
+        file_initial = output + '0GenericAffine.mat'
+
+    # Execute the commands. Without run the jobs are returned to be scheduled
+    if run:
+        jobs = run_registration_chains([jobs], debug = debug)
+    return jobs
+
+# Breathing model. Registrations of the 4dct phases in a ring (sequential, k to k+1) or in a star 
+# (each phase to the reference phase)
+
+def register_breathing_model(input_folder, output_folder, opt = 0):
+    # Register the phases of a 4dct (images of a folder in alphabetical order). Fields are written in 
+    # output_folder/seq (ring) or output_folder/phase (star)
+    # Input:
+    #   input_folder: string. Folder with the 4dct phases
+    #   output_folder: string. Model folder
+    #   opt: dict. Options (defaults in brackets): one_way [False], inverse [False], star [False], 
+    #       reference [0], warm_start [False], jobs [1], threads [0], backend ['ants'], cache [None], 
+    #       rtstruct [None], labels [None], margin [20.0], affine [None], overwrite [False], 
+    #       debug [False], verbose [False]
+    # Output:
+    #   jobs: list of dict. Registrations that ran (see registration_report)
+    defaults = dict([('one_way', False), ('inverse', False), ('star', False), ('reference', 0), 
+        ('warm_start', False), ('jobs', 1), ('threads', 0), ('backend', 'ants'), ('cache', None),
+        ('rtstruct', None), ('labels', None), ('margin', 20.0), ('affine', None), ('overwrite', False),
+        ('debug', False), ('verbose', False)])
+    opt = dict(opt) if opt else dict()
+    for key in defaults:
+        if not key in opt: opt[key] = defaults[key]
+
+    # Files organized alphabetically
+    files = os.listdir(input_folder)
+    files.sort()
+    print('\nRunning script to register 3d images sequentially.')
+    if opt['debug']:
+        print('[Debug Mode]')
+    if opt['verbose']:    
+        print('\nFiles found: \n' + str(files))
+    print('\nRegistration\n')
+    # os.system('export ANTSPATH=/usr/bin/')
+    
+    # List of files indexes. Added a zero (0) to complete the sequence
+    idx = list(range(len(files)))
+    idx.append(0)
+    # print(idx)
+
+    # Create directory to save output. Star topology fields are the reference to phase fields (see video.py)
+    output_path = os.path.join(output_folder,'phase/' if opt['star'] else 'seq/')    # Output path
+    os.system('echo mkdir -p ' + output_path )          # echo mkdir
+    if not opt['debug']: 
+        os.system('mkdir -p ' + output_path )           # make directory
+
+    # Region of interest around the contours
+    roi = None
+    if opt['rtstruct'] is not None:
+        from image import read_contours_labels, contours_bounding_box
+        labels = opt['labels'] if opt['labels'] is not None else read_contours_labels(opt['rtstruct'])
+        point_min, point_max = contours_bounding_box(opt['rtstruct'], labels)
+        if opt['affine'] is not None:     # box corners in 4dct coordinates
+            inverse = sitk.ReadTransform(opt['affine']).GetInverse()
+            corners = [inverse.TransformPoint([float(x), float(y), float(z)]) for x in [point_min[0], point_max[0]]
+                        for y in [point_min[1], point_max[1]] for z in [point_min[2], point_max[2]]]
+            point_min = [min([c[d] for c in corners]) for d in range(3)]
+            point_max = [max([c[d] for c in corners]) for d in range(3)]
+        roi = image_roi(os.path.join(input_folder, files[0]), point_min, point_max, opt['margin'], 
+                        os.path.join(output_path, 'roi'))
+        voxels = roi['size'][0]*roi['size'][1]*roi['size'][2]
+        full_voxels = roi['full_size'][0]*roi['full_size'][1]*roi['full_size'][2]
+        print('Region of interest. Labels: {}. Index: {}. Size: {} of {} ({:.1f}% of the voxels)\n'.format(
+                labels, roi['index'], roi['size'], roi['full_size'], 100.0*voxels/full_voxels))
+
+    # Registrations are collected as jobs and run in a pool. Jobs are grouped in chains:
+    # with warm start the fixed to moving registrations of a chain run in order
+    chains = []
+    # pyramids shared between registrations. One per phase and schedule (full and warm start)
+    pyramids = pyramid_cache(2*len(files)) if opt['backend'] == 'sitk' else None
+    chain_size = -(-len(files)//max(1, opt['jobs'])) if opt['warm_start'] else 1
+    previous_key = None
+    for k in range(len(files)):
+        # Star topology. Each phase to the reference, all in parallel
+        if opt['star']:
+            if k == opt['reference']: continue
+            fixed_image = os.path.join(input_folder, files[k])
+            moving_image = os.path.join(input_folder, files[opt['reference']])
+            job = register_sequential_syn(fixed_image, moving_image, output_path, opt['debug'], opt['overwrite'], run = False, cache_dir = opt['cache'], 
+                    backend = opt['backend'], pyramids = pyramids, roi = roi)
+            if job is not None: chains.append([job])
+            continue
+
+        # Register fixed to moving incrementally
+        fixed_image = os.path.join(input_folder, files[idx[k]])      # Fixed image path
+        moving_image = os.path.join(input_folder, files[idx[k+1]])   # Moving image path
+
+        initial = None
+        if k % chain_size == 0:
+            chains.append([])
+        elif opt['warm_start']:           # field of the previous pair
+            prefix = sequential_prefix(os.path.join(input_folder, files[idx[k-1]]), fixed_image)
+            initial = dict([('file', os.path.join(output_path, prefix + '0Warp.nii.gz')), ('key', previous_key)])
+
+        job = register_sequential_syn(fixed_image, moving_image, output_path, opt['debug'], opt['overwrite'], run = False, cache_dir = opt['cache'], 
+                    backend = opt['backend'], pyramids = pyramids, roi = roi, initial = initial)
+        previous_key = job['key'] if job is not None else read_registration_key(output_path, sequential_prefix(fixed_image, moving_image))
+        if job is not None: chains[-1].append(job)
+
+        # Register now moving to fixed. Default behavior two ways (not opt['one_way']).
+        # With inverse the reverse direction is published after the registration
+        if not opt['one_way'] and not opt['inverse']:
+            job = register_sequential_syn(moving_image, fixed_image, output_path, opt['debug'], opt['overwrite'], run = False, cache_dir = opt['cache'], 
+                    backend = opt['backend'], pyramids = pyramids, roi = roi)
+            if job is not None: chains.append([job])
+
+    jobs = run_registration_chains(chains, opt['jobs'], opt['threads'], opt['debug'])
+    if opt['debug']:
+        return jobs
+    if jobs != []:
+        print(registration_report(jobs))
+
+    failed = [job['name'] for job in jobs if job['exit_code'] != 0]
+    if failed != []:
+        print('[Error] Registrations failed: ' + ', '.join(failed))
+        return jobs
+
+    # Reverse registrations with the inverse warps. With two images both directions are 
+    # registered (the sequence 0, 1, 0), therefore nothing is published
+    if opt['inverse'] and not opt['one_way'] and not opt['star'] and len(files) > 2:
+        from image import dfield_inverse_consistency
+        print('\nInverse registrations. Consistency error (mm)\n')
+        print('{:<10}  {:<10}  {:>8}  {:>8}'.format('forward', 'reverse', 'mean', 'max'))
+        for k in range(len(files)):
+            fixed_image = os.path.join(input_folder, files[idx[k]])
+            moving_image = os.path.join(input_folder, files[idx[k+1]])
+            forward, reverse = publish_inverse_registration(fixed_image, moving_image, output_path)
+            output = os.path.join(output_path, forward)
+            error_mean, error_max = dfield_inverse_consistency(output + '0Warp.nii.gz', output + '0InverseWarp.nii.gz')
+            print('{:<10}  {:<10}  {:>8.3f}  {:>8.3f}'.format(forward, reverse, error_mean, error_max))
+    return jobs
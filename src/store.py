@@ -0,0 +1,333 @@
+# -*- coding: utf-8 -*-
+# @Author: jose
+# @Date:   2021-08-09 10:02:17
+# @Last Modified by:   jose
+# @Last Modified time: 2021-08-09 16:45:30
+
+import os
+import json
+import hashlib
+import numpy as np
+import SimpleITK as sitk
+
+# Frame store. Video frames saved in chunks (numpy npz files) with a manifest that describes
+# every frame (one json line per frame). Layout of the store folder:
+#   store.json          video parameters, streams and image metadata
+#   manifest.jsonl      frame metadata: it, t, cycle, phases, proportion, amplitude, chunk, checksum
+#   chunk_000000.npz    one array (n, y, x) per stream
+
+def video_store_parameters( opt ):
+    '''
+    Video parameters that define the frames of a store. A store can be resumed only with
+    the same parameters.
+    Input:
+        opt: dict. Video options (see video_4d)
+    Output:
+        dict
+    '''
+    keys = ['view', 'slice', 'reference', 'phases', 'breathing_time', 'amplitude', 'random_amp',
+            'amplitude_seed', 'video_time', 'frame_per_sec', 'model', 'store_bits']
+    return dict([(key, opt[key]) for key in keys if key in opt])
+
+def frame_checksum( arrays ):
+    '''
+    Checksum of the stored arrays of a frame
+    Input:
+        arrays: list of numpy arrays. One per stream
+    Output:
+        string. sha1 hex digest
+    '''
+    sha = hashlib.sha1()
+    for array in arrays:
+        sha.update(np.ascontiguousarray(array).tobytes())
+    return sha.hexdigest()
+
+def quantize_frame( array, bits = 16 ):
+    '''
+    Quantize a frame to unsigned integers using its own range of values
+    Input:
+        array: numpy array
+        bits: int. 8 or 16
+    Output:
+        q: numpy array (uint8 or uint16)
+        offset: float. Minimum value
+        scale: float. Value of one quantization step
+    '''
+    levels = 2**bits - 1
+    dtype = np.uint8 if bits == 8 else np.uint16
+    offset = float(array.min())
+    vrange = float(array.max()) - offset
+    scale = vrange/levels if vrange > 0.0 else 1.0
+    q = np.round((array - offset)/scale).astype(dtype)
+    return q, offset, scale
+
+def dequantize_frame( q, offset, scale, dtype = np.float32 ):
+    '''
+    Recover the values of a quantized frame
+    Input:
+        q: numpy array (uint8 or uint16)
+        offset: float
+        scale: float
+        dtype: numpy type of the output
+    Output:
+        numpy array
+    '''
+    return (q*scale + offset).astype(dtype)
+
+def read_store_parameters( folder ):
+    '''
+    Video parameters of an existing store (see video_store_parameters)
+    Input:
+        folder: string. Store folder
+    Output:
+        dict or None if there is no store
+    '''
+    file_info = os.path.join(folder, 'store.json')
+    if not os.path.exists(file_info): return None
+    try:
+        with open(file_info, 'r') as f:
+            return json.load(f)['parameters']
+    except (ValueError, KeyError):
+        return None
+
+def read_store_manifest( folder ):
+    '''
+    Read the frames of the manifest. Incomplete lines (interrupted writes) are ignored
+    Input:
+        folder: string. Store folder
+    Output:
+        entries: list of dict
+    '''
+    entries = []
+    file_manifest = os.path.join(folder, 'manifest.jsonl')
+    if not os.path.exists(file_manifest): return entries
+    with open(file_manifest, 'r') as f:
+        for line in f:
+            try:
+                entries.append(json.loads(line))
+            except ValueError:
+                pass
+    return entries
+
+def repair_store_manifest( folder ):
+    '''
+    Remove the incomplete last line of the manifest (interrupted write), therefore the frames
+    appended later start in a new line
+    Input:
+        folder: string. Store folder
+    '''
+    file_manifest = os.path.join(folder, 'manifest.jsonl')
+    if not os.path.exists(file_manifest): return
+    with open(file_manifest, 'rb+') as f:
+        data = f.read()
+        if data == b'' or data.endswith(b'\n'): return
+        f.truncate(data.rfind(b'\n') + 1)
+    print('[Warning] Incomplete line removed from the manifest of the frame store')
+
+def read_store_chunk( folder, chunk ):
+    '''
+    Read a chunk of frames
+    Input:
+        folder: string. Store folder
+        chunk: int. Chunk number
+    Output:
+        dict. Stream name and array (n, y, x)
+    '''
+    file_chunk = os.path.join(folder, 'chunk_{:06d}.npz'.format(chunk))
+    with np.load(file_chunk) as data:
+        return dict([(name, data[name]) for name in data.files])
+
+def verify_store_entries( folder, entries, streams ):
+    '''
+    Keep the manifest entries whose chunk exists and whose data matches the checksum. Entries
+    are read in manifest order with one chunk in memory
+    Input:
+        folder: string. Store folder
+        entries: list of dict. Manifest entries
+        streams: list of strings. Stream names
+    Output:
+        list of dict
+    '''
+    valid = []
+    chunks = dict()
+    unreadable = set()
+    for entry in entries:
+        chunk = entry['chunk']
+        if chunk in unreadable: continue
+        if not chunk in chunks:
+            try:
+                chunks = dict([(chunk, read_store_chunk(folder, chunk))])
+            except (IOError, ValueError, KeyError, EOFError):
+                unreadable.add(chunk)
+                print('[Warning] Unreadable chunk {} in frame store. Frames will be rendered again'.format(chunk))
+                continue
+        data = chunks[chunk]
+        try:
+            arrays = [data[name][entry['index']] for name in streams]
+        except (KeyError, IndexError):
+            continue
+        if frame_checksum(arrays) == entry['checksum']:
+            valid.append(entry)
+    return valid
+
+def open_frame_store( folder, streams, opt, num_frames, overwrite = False, verify = True ):
+    '''
+    Open a frame store to write frames. Frames of an existing store with the same video
+    parameters are kept, and only missing frames need to be written.
+    Input:
+        folder: string. Store folder
+        streams: list of strings. Stream names
+        opt: dict. Video options (see video_4d). Keys used: store_chunk, store_compress, store_bits
+        num_frames: int. Total number of frames in the video
+        overwrite: bool. Remove the existing store
+        verify: bool. Check the existing frames with their checksums
+    Output:
+        store: dict. Key done has the frame numbers already stored
+    '''
+    file_info = os.path.join(folder, 'store.json')
+    parameters = video_store_parameters(opt)
+
+    if os.path.exists(file_info) and overwrite:
+        for f in os.listdir(folder):
+            if f == 'store.json' or f == 'manifest.jsonl' or f.startswith('chunk_'):
+                os.remove(os.path.join(folder, f))
+    os.makedirs(folder, exist_ok=True)
+
+    info = dict([('parameters', parameters), ('streams', streams), ('num_frames', num_frames), ('metadata', None)])
+    entries = []
+    done = set()
+    if os.path.exists(file_info):
+        with open(file_info, 'r') as f:
+            info_old = json.load(f)
+        if info_old['parameters'] != parameters or info_old['streams'] != streams or info_old['num_frames'] != num_frames:
+            print('[Warning] Existing frame store with different video parameters. Use option -w to overwrite')
+            return None
+        info = info_old
+        repair_store_manifest(folder)
+        entries = read_store_manifest(folder)
+        if verify: entries = verify_store_entries(folder, entries, streams)
+        done = set([entry['it'] for entry in entries])
+    else:
+        with open(file_info, 'w') as f:
+            json.dump(info, f, indent = 2)
+
+    # new chunks never reuse the number of a chunk in the folder or in the manifest
+    chunks = [int(f[6:12]) for f in os.listdir(folder) if f.startswith('chunk_') and f.endswith('.npz')]
+    chunks += [entry['chunk'] for entry in read_store_manifest(folder)]
+    return dict([('folder', folder), ('streams', streams), ('info', info), ('done', done),
+            ('chunk', max(chunks) + 1 if chunks != [] else 0), ('buffer', []),
+            ('chunk_size', opt['store_chunk']), ('compress', opt['store_compress']),
+            ('bits', opt['store_bits']), ('frame_per_sec', opt['frame_per_sec'])])
+
+def write_store_frame( store, frame, images ):
+    '''
+    Add a frame to the store. Frames are written when a chunk is complete
+    Input:
+        store: dict. Created with open_frame_store
+        frame: dict. Frame time variables (see video_frames)
+        images: list of sitk.Image 2D. One per stream
+    '''
+    if store['info']['metadata'] is None:       # image metadata from the first frame
+        template = images[0]
+        d = template.GetDirection()
+        store['info']['metadata'] = dict([('size', list(template.GetSize())),
+            ('origin', list(template.GetOrigin()) + [0.0]),
+            ('spacing', list(template.GetSpacing()) + [1.0/store['frame_per_sec']]),
+            ('direction', [d[0], d[1], 0.0, d[2], d[3], 0.0, 0.0, 0.0, 1.0]),
+            ('dtype', [str(sitk.GetArrayViewFromImage(image).dtype) for image in images])])
+        with open(os.path.join(store['folder'], 'store.json'), 'w') as f:
+            json.dump(store['info'], f, indent = 2)
+
+    store['buffer'].append((frame, [sitk.GetArrayFromImage(image) for image in images]))
+    if len(store['buffer']) >= store['chunk_size']:
+        flush_frame_store(store)
+
+def flush_frame_store( store ):
+    '''
+    Write the buffered frames as a new chunk and add them to the manifest. The chunk is
+    written before the manifest, therefore an interrupted write never leaves frames in the
+    manifest without data.
+    Input:
+        store: dict. Created with open_frame_store
+    '''
+    if store['buffer'] == []: return
+    chunk = store['chunk']
+    stacks = [[] for _ in store['streams']]
+    entries = []
+    for index, (frame, arrays) in enumerate(store['buffer']):
+        quantization = []
+        stored = []
+        for k, array in enumerate(arrays):
+            if store['bits'] in [8, 16]:
+                q, offset, scale = quantize_frame(array, store['bits'])
+                quantization.append([offset, scale])
+                array = q
+            stacks[k].append(array)
+            stored.append(array)
+        entry = dict([('it', int(frame['it'])), ('t', float(frame['t'])), ('cycle', float(frame['cycle'])),
+            ('floor_phase', int(frame['floor_phase'])), ('ceil_phase', int(frame['ceil_phase'])),
+            ('proportion', float(frame['proportion'])), ('amplitude', float(frame['amplitude'])),
+            ('chunk', chunk), ('index', index), ('checksum', frame_checksum(stored))])
+        if quantization != []: entry['quantization'] = quantization
+        entries.append(entry)
+
+    # chunk
+    file_chunk = os.path.join(store['folder'], 'chunk_{:06d}.npz'.format(chunk))
+    file_part = file_chunk + '.part'
+    arrays = dict([(name, np.stack(stack)) for name, stack in zip(store['streams'], stacks)])
+    with open(file_part, 'wb') as f:
+        if store['compress']: np.savez_compressed(f, **arrays)
+        else: np.savez(f, **arrays)
+    os.replace(file_part, file_chunk)
+    print(file_chunk)
+
+    # manifest
+    with open(os.path.join(store['folder'], 'manifest.jsonl'), 'a') as f:
+        for entry in entries:
+            f.write(json.dumps(entry) + '\n')
+        f.flush()
+        os.fsync(f.fileno())
+
+    store['done'].update([entry['it'] for entry in entries])
+    store['chunk'] = chunk + 1
+    store['buffer'] = []
+
+def close_frame_store( store ):
+    '''
+    Write the remaining frames of the store
+    Input:
+        store: dict. Created with open_frame_store
+    '''
+    flush_frame_store(store)
+
+def read_frame_store( folder, stream = 'image' ):
+    '''
+    Read all the frames of a stream in a frame store. Only frames whose data matches the checksum
+    of the manifest are read (see verify_store_entries)
+    Input:
+        folder: string. Store folder
+        stream: string. Stream name
+    Output:
+        frames: numpy array (t, y, x). Frames missing in the store or with unreadable data are zero
+        info: dict. Content of store.json
+    '''
+    with open(os.path.join(folder, 'store.json'), 'r') as f:
+        info = json.load(f)
+    k = info['streams'].index(stream)
+    metadata = info['metadata']
+    num_frames = info['num_frames']
+    dtype = np.dtype(metadata['dtype'][k])
+    frames = np.zeros((num_frames, metadata['size'][1], metadata['size'][0]), dtype = dtype)
+
+    entries = verify_store_entries(folder, read_store_manifest(folder), info['streams'])
+    entries = dict([(entry['it'], entry) for entry in entries])     # last valid entry of a frame
+    chunks = dict()
+    for it, entry in sorted(entries.items()):
+        if not entry['chunk'] in chunks:
+            chunks = dict([(entry['chunk'], read_store_chunk(folder, entry['chunk']))]) # one chunk in memory
+        array = chunks[entry['chunk']][stream][entry['index']]
+        if 'quantization' in entry:
+            offset, scale = entry['quantization'][k]
+            array = dequantize_frame(array, offset, scale, dtype)
+        if it < num_frames: frames[it] = array
+    return frames, info
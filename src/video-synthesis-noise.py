@@ -10,6 +10,7 @@ import numpy as np
 import SimpleITK as sitk
 
 from folder import *
+from noise import noise_folder
 
 def main():
     # Arguments descriptions
@@ -19,11 +20,24 @@ def main():
     parser.add_argument("output_folder", type=str,
                         help='Output folder to store video')
     parser.add_argument('-t','--type', type=str, default='gaussian',
-                        help='Noise types: gaussian (default), saltpepper, speckle, rician.')
+                        help='Noise types: gaussian (default), saltpepper, speckle, rician, kspace (with -r).')
     parser.add_argument('-s','--stddev', type=float, default=20.0,
                         help='Noise standard deviation')
     parser.add_argument('-r', '--percentage', action='store_true',
                         help='Noise as percentage')
+    parser.add_argument('--partial-fourier', type=float, default=1.0,
+                        help='kspace noise. Fraction of the phase encoding lines acquired. Default: 1.0')
+    parser.add_argument('--undersampling', type=int, default=1,
+                        help='kspace noise. Acceleration factor, one of every n lines acquired. Default: 1')
+    parser.add_argument('--center-fraction', type=float, default=0.08,
+                        help='kspace noise. Fraction of central lines acquired with undersampling. Default: 0.08')
+    parser.add_argument('-g', '--global-stats', action='store_true',
+                        help='Noise percentage relative to the statistics of all the images, computed once. \
+                        Default: statistics of each image')
+    parser.add_argument('--seed', type=int, default=None,
+                        help='Seed of the noise (image k uses the substream k of the seed). Default: random')
+    parser.add_argument('-j', '--workers', type=int, default=1,
+                        help='Number of processes to add noise in parallel. Default: 1')
     parser.add_argument('-w', '--overwrite', action='store_true',
                         help='Overwrite existent registrations')
     parser.add_argument('-d','--debug', action='store_true',
@@ -45,50 +59,15 @@ def main():
 
     if verbose:
         print('\nInput Folder:\n', folder_input)
-
-    list_files = listdir_fullpath_onlyfiles(folder_input)
-    # if verbose:
-    #     print('\nList of files:\n', fullpath_to_localpath(list_files))
-
-    # verbose options
-    options = ''
-    if (percentage or overwrite or debug or verbose):
-        options += '-'
-    if (percentage):
-        options += 'r'
-    if (overwrite):
-        options += 'w'
-    if (debug):
-        options += 'd'
-    if (verbose):
-        options += 'v'
-
-    if verbose:
         print('\nOutput Folder:\n', folder_output)
-    if not debug:
-        os.makedirs(folder_output, exist_ok=True)
-
-    list_out_files = listdir_fullpath(folder_output)
-
-    if len(list_out_files) == len(list_files):
-        if not overwrite:
-            print('\nExisting output noise files. Use option -w to overwrite')
-            return 0
-
-    ini = len(list_out_files)
-    end = len(list_files)
 
-    for k in range(ini,end):
-        file = list_files[k]
-        basename = fullpath_to_localpath([file])[0]
-        file_output = os.path.join(folder_output, basename)
-        
-        cmd = 'python image-noise.py {} {} -t {} -s {} {}'.format(file, 
-            file_output, str_type, stddev, options)
-        if verbose:
-            print(cmd)
-        if not debug:
-            os.system(cmd)
+    # All the images in this process (or a pool of processes)
+    opt = dict([('type', str_type), ('stddev', stddev), ('percentage', percentage), 
+                ('global_stats', args.global_stats), ('seed', args.seed), ('workers', args.workers),
+                ('kspace', dict([('partial_fourier', args.partial_fourier), ('undersampling', args.undersampling),
+                                 ('center_fraction', args.center_fraction)])),
+                ('overwrite', overwrite), ('debug', debug), ('verbose', verbose)])
+    noise_folder(folder_input, folder_output, opt)
     return
 
 
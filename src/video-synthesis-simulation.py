@@ -30,6 +30,8 @@ def main():
                         help='Overwrite existent videos')
     parser.add_argument('-p','--plot', action='store_true',
                         help='Enable plot of reference')
+    parser.add_argument('-j','--workers', type=int, default=1,
+                        help='Number of processes to render frames in parallel')
     parser.add_argument('-d','--debug', action='store_true',
                         help='Enable debug mode')
     parser.add_argument('-v','--verbose', action='store_true',
@@ -45,111 +47,23 @@ def main():
     debug = args.debug
     verbose = args.verbose
     plot = args.plot
-
-    # Default Parameters
-    view            = 'sagittal'
-    slice_num       = 180   # view slice value
-    video_time      = 20.0  # video desired total time
-    frame_per_sec   = 4     # video frames per second
-    ref_phase       = 0     # reference phase in 4dct
-    phases          = 10    # num phases 4dct
-    breathing_time  = 4.5   # breathing cycle time in seconds
-    amplitude       = 1.0   # amplitude of breathing
-    # noise_model     = None  # noise model
-    # noise_percent   = 0.1   # noise percentage
-    random_amp      = False # amplitude with random value from 1.0 to 2.0
-
-    labels_segments = []
-    labels_names    = []
+    workers = args.workers
 
     # Parse parameters
     stream = open(file_parameters, 'r')
     params = yaml.safe_load(stream)
+    opt = video_options(params)
+    labels_segments, _ = segment_labels(params)
 
-    if 'Video' in params:
-        if 'camera-view' in params['Video']:
-            view = params['Video']['camera-view']
-        if 'slice' in params['Video']:
-            slice_num = params['Video']['slice']
-        if 'video-time' in params['Video']:
-            video_time = params['Video']['video-time']
-        if 'frame-per-second' in params['Video']:
-            frame_per_sec = params['Video']['frame-per-second']
-        if 'reference-phase' in params['Video']:
-            ref_phase = params['Video']['reference-phase']
-        if 'breathing-amplitude-type' in params['Video']:
-            random_amp = True if params['Video']['breathing-amplitude-type'] == 'random' else False
-        if 'breathing-amplitude' in params['Video']:
-            amplitude = params['Video']['breathing-amplitude']
-        if 'breathing-cycle-time' in params['Video']:
-            breathing_time = params['Video']['breathing-cycle-time']
-        if 'noise-model' in params['Video']:
-            noise_model = params['Video']['noise-model']
-        if 'noise-percentage' in params['Video']:
-            noise_percent = params['Video']['noise-percentage']
-    if 'Segments' in params:
-        if 'labels-input' in params['Segments']:
-            labels_segments = params['Segments']['labels-input']
-        if 'labels-output' in params['Segments']:
-            labels_names = params['Segments']['labels-output']
-    
-    # Folders and Files
-    folder_4dct = os.path.join(folder_input, '4dct')
-    folder_mr = os.path.join(folder_input, 'mr')
-    folder_rt = os.path.join(folder_input, 'rt')
-
-    files_4dct = listdir_fullpath(folder_4dct)
-    file_4dct00 = files_4dct[0]
-    file_mr = listdir_fullpath(folder_mr)[0]
-    file_rt = listdir_fullpath(folder_rt)[0]
-    
-    file_reference = os.path.join(folder_model,'4dct-mr','4dct00_to_mr_Warped.nii.gz')
-    folder_trfm = os.path.join(folder_model,'seq/')
-
-    folder_out = os.path.join(folder_output, 'image/')
-    if not debug:
-        os.makedirs(folder_out, exist_ok=True)
-    
-    # Check if existing files in output
-    existing_files = listdir_fullpath(folder_out)
-    num_files = len(existing_files)
-    ts = 1/frame_per_sec
-    time = np.arange(0.0,video_time,ts)
-
-    if (num_files) == len(time):
-        if not overwrite:
-            print('[Warning] Existing CineMR files. Use option -w to overwrite')
-            return 0
-
-    # Reference Image (mr in 4dct space)
-    image_reference = sitk.ReadImage(file_reference, sitk.sitkFloat32)
-    if verbose:
-        print(image_info(image_reference,'Reference 3D, MR Image Information'))
-
-    # Read transform 4dct-mr
-    image_ct =  sitk.ReadImage(file_4dct00, sitk.sitkFloat32)
-    file_affine = os.path.join(folder_model, '4dct-mr', '4dct00_to_mr_0GenericAffine.mat')
-    file_dfield = os.path.join(folder_model, '4dct-mr', '4dct00_to_mr_1Warp.nii.gz')
-    trfm_mr2ct = read_compose_transform(file_dfield, file_affine)
-
-    # Dicom RS. Masks on mr and colors
-    image_mr = sitk.ReadImage(file_mr, sitk.sitkFloat32)
-    list_masks, list_colors = extract_image_masks(image_mr, file_rt, labels_segments, verbose)
-    
-    list_trfm_masks = [] # backwards for liver not to cover gtv
-    for mask in list_masks:
-        m = transform_image(mask, image_ct, trfm_mr2ct)
-        list_trfm_masks.append(m)
-
-    list_trfm_masks.reverse()
-
-    # Plot slice
+    # Plot slice of the reference image, masks and breathing model
+    model = None
     if (plot):
-        img2d = image3d_to_slice(image_reference, slice_num, view)
+        model = load_patient_model(folder_input, folder_model, labels_segments, opt['reference'], opt['phases'], verbose)
+        img2d = image3d_to_slice(model['reference'], opt['slice'], opt['view'])
         img2d_label = img2d
-        for i,mask in enumerate(list_trfm_masks):
-            label_2d = image3d_to_slice(mask, slice_num, view)
-            img2d_label = label_overlay(img2d_label, label_2d, list_colors[i])
+        for i,mask in enumerate(reversed(model['masks'])): # backwards for liver not to cover gtv
+            label_2d = image3d_to_slice(mask, opt['slice'], opt['view'])
+            img2d_label = label_overlay(img2d_label, label_2d, model['colors'][i])
         plt.figure()
         plt.subplot(1,2,1)
         imshow_2d(img2d, show=False)
@@ -157,33 +71,8 @@ def main():
         imshow_2d(img2d_label, show=False)
         plt.show()
 
-    # Reverse order, first gtv and then liver
-    list_trfm_masks.reverse()
-
-    # 4DCT transformations    
-    files_trfms = listdir_fullpath(folder_trfm) # print(files)
-    files_trfms_warp = filter_folders_prefix(['0Warp.'], files_trfms)
-    files_trfms_inv_warp = filter_folders_prefix(['0InverseWarp.'], files_trfms)
-    if verbose:
-        print('\nWarp transform files: \n', fullpath_to_localpath(files_trfms_warp))
-        print('\nInverse warp transform files: \n', fullpath_to_localpath(files_trfms_inv_warp))
-    files_transforms = files_trfms_warp + files_trfms_inv_warp
-
     # Video
-
-    opt = dict([('view', view),
-            ('slice', slice_num),
-            ('reference', ref_phase),
-            ('phases', phases),
-            ('breathing_time', breathing_time),
-            ('amplitude', amplitude),
-            ('video_time', video_time),
-            ('frame_per_sec', frame_per_sec),
-            ('random_amp', random_amp),
-            ('overwrite', overwrite),
-            ('debug', debug) ])
-
-    video_4d(file_reference, files_transforms, folder_output, opt, list_trfm_masks, labels_names)
+    video_simulation(folder_input, folder_model, folder_output, params, overwrite, debug, verbose, workers, model = model)
 
     return
 
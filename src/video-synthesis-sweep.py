@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+# @Author: jose
+# @Date:   2021-08-06 09:31:12
+# @Last Modified by:   jose
+# @Last Modified time: 2021-08-06 11:02:47
+
+import os
+import sys
+import copy
+import time
+import argparse                 # argument parser
+import yaml
+import numpy as np
+import SimpleITK as sitk
+
+from folder import *
+from image import *
+from video import *
+
+def main():
+    # Arguments descriptions
+    parser = argparse.ArgumentParser(description='Create several CineMR simulation videos using 4DCT scans. \
+                        The patient model is loaded once and a video is created for each combination of parameters')
+    parser.add_argument("input_folder", type=str, 
+                        help='Input folder with images')
+    parser.add_argument("model_folder", type=str, 
+                        help='Model folder with transformations')
+    parser.add_argument("output_folder", type=str,
+                        help='Output folder to store the videos. One folder per variant')
+    parser.add_argument("parameters", type=str,
+                        help='File with parameters')
+    parser.add_argument("sweep", type=str,
+                        help='File with the grid of parameters (Sweep)')
+    parser.add_argument('-w', '--overwrite', action='store_true',
+                        help='Overwrite existent videos')
+    parser.add_argument('-j','--workers', type=int, default=1,
+                        help='Number of processes to render frames in parallel')
+    parser.add_argument('-d','--debug', action='store_true',
+                        help='Enable debug mode')
+    parser.add_argument('-v','--verbose', action='store_true',
+                        help='Enable verbose mode')
+
+    # Parse arguments
+    args = parser.parse_args()
+    folder_input = args.input_folder
+    folder_model = args.model_folder
+    folder_output = args.output_folder
+    file_parameters = args.parameters
+    file_sweep = args.sweep
+    overwrite = args.overwrite
+    workers = args.workers
+    debug = args.debug
+    verbose = args.verbose
+
+    # Parse parameters
+    stream = open(file_parameters, 'r')
+    params = yaml.safe_load(stream)
+    if not 'Video' in params:
+        params['Video'] = dict()
+    opt_base = video_options(params)
+    labels_segments, labels_names = segment_labels(params)
+
+    # Parse grid of parameters. The model is shared, reference phase can not change
+    stream = open(file_sweep, 'r')
+    grid = yaml.safe_load(stream)['Sweep']
+    supported = ['breathing-amplitude', 'breathing-cycle-time', 'frame-per-second', 'slice', 
+                 'camera-view', 'video-time', 'breathing-amplitude-type']
+    for key in list(grid.keys()):
+        if not key in supported:
+            print('[Warning] Unsupported sweep parameter {}. Ignored'.format(key))
+            grid.pop(key)
+    variants = sweep_variants(grid)
+    print('\nVideo variants: {}'.format(len(variants)))
+
+    # Reference image, masks and breathing model. Loaded once for all the variants
+    model = load_patient_model(folder_input, folder_model, labels_segments, opt_base['reference'], opt_base['phases'], verbose)
+    cache = dfield_cache(opt_base['cache_mb'])
+
+    # Videos
+    for k, variant in enumerate(variants):
+        folder_variant = os.path.join(folder_output, variant_name(variant))
+        print('\n' + '='*50 + '\n\tVariant {}/{}: {}\n'.format(k+1, len(variants), variant_name(variant)) + '='*50)
+
+        params_variant = copy.deepcopy(params)
+        params_variant['Video'].update(variant)
+        opt = video_options(params_variant)
+        opt['model'] = model['model']
+        opt['workers'] = workers
+        opt['overwrite'] = overwrite
+        opt['debug'] = debug
+
+        start = time.time()
+        video_4d(model['reference'], model['transform_files'], folder_variant, opt, 
+                 model['masks'], labels_names, cache)
+        print('\nVariant {} time: {:.1f} s'.format(variant_name(variant), time.time() - start))
+
+    if verbose:
+        print(dfield_cache_info(cache))
+    return
+
+
+if __name__ == "__main__":
+    # execute only if run as a script
+    main()
@@ -6,11 +6,18 @@
 
 import os
 import sys
+import json
+import itertools
+import multiprocessing
 import numpy as np
 import SimpleITK as sitk
 
+from collections import OrderedDict
+
 from folder import *
 from image import *
+from store import *
+from noise import noise_image_stats, noise_frame
 
 def is_increase(list_path):
     increase = True
@@ -98,21 +105,369 @@ def image3d_multichannel_to_slice( image, slice_value, view = 'axial' ):
         slice_image = 0
     return slice_image
 
-def read_dfield_compose( compose_trfm_files, amplitude = 1.0, proportion = 1.0, slice_num = None, view = '' ):
+def dfield_cache( max_mb = 4096 ):
+    '''
+    Create an empty cache of deformation fields. Fields are stored unscaled as numpy arrays
+    and evicted in least recently used order when the cache exceeds its size in bytes.
+    Input:
+        max_mb: float. Maximum size of the cache in megabytes
+    Output:
+        cache: dict
+    '''
+    cache = dict()
+    cache['fields']    = OrderedDict()  # file -> (array, geometry)
+    cache['buffers']   = dict()         # reusable arrays to scale fields, (shape, type, index) -> array
+    cache['bytes']     = 0
+    cache['max_bytes'] = int(max_mb*1024*1024)
+    cache['hits']      = 0
+    cache['misses']    = 0
+    return cache
+
+def dfield_cache_info( cache, text = 'Deformation Field Cache' ):
+    '''
+    Return a string with the cache usage. Fields, size, hits and misses.
+    Input:
+        cache: dict. Created with dfield_cache
+        text: string. Title to the output
+    Output: string
+    '''
+    info = '\n===== '+ text +' ====='
+    info += '\nFields: \t\t' + str(len(cache['fields']))
+    info += '\nSize (MB): \t\t' + '{:.1f} / {:.1f}'.format(cache['bytes']/1024**2, cache['max_bytes']/1024**2)
+    info += '\nHits: \t\t\t' + str(cache['hits'])
+    info += '\nMisses: \t\t' + str(cache['misses'])
+    info += '\n'
+    return info
+
+def read_dfield_array( dfile, cache = None ):
+    '''
+    Read a deformation field as an unscaled numpy array. When a cache is given the
+    file is decoded only once and the array is reused in later calls.
+    Input:
+        dfile: string. Deformation field file
+        cache: dict. Created with dfield_cache (optional)
+    Output:
+        array: numpy array [z,y,x,3]. Read only when cached
+        geometry: tuple with (origin, spacing, direction)
+    '''
+    if cache is not None and dfile in cache['fields']:
+        cache['hits'] += 1
+        cache['fields'].move_to_end(dfile)      # most recently used
+        return cache['fields'][dfile]
+
+    dfield_image = sitk.ReadImage(dfile)        # Read deformation field as image
+    array = sitk.GetArrayFromImage(dfield_image)
+    geometry = (dfield_image.GetOrigin(), dfield_image.GetSpacing(), dfield_image.GetDirection())
+    if cache is not None:
+        cache['misses'] += 1
+        dfield_cache_put(cache, dfile, array, geometry)
+    return array, geometry
+
+def dfield_cache_put( cache, dfile, array, geometry ):
+    '''
+    Add a deformation field to the cache, e.g. a field computed in memory that is also
+    written to dfile. Least recently used fields are evicted.
+    Input:
+        cache: dict. Created with dfield_cache
+        dfile: string. Deformation field file
+        array: numpy array [z,y,x,3]
+        geometry: tuple with (origin, spacing, direction)
+    '''
+    if array.nbytes > cache['max_bytes'] or dfile in cache['fields']: return
+    array.flags.writeable = False               # shared between frames, never modify
+    cache['fields'][dfile] = (array, geometry)
+    cache['bytes'] += array.nbytes
+    while cache['bytes'] > cache['max_bytes']:  # evict least recently used
+        _, (old_array, _) = cache['fields'].popitem(last = False)
+        cache['bytes'] -= old_array.nbytes
+
+def dfield_cache_warm( cache, files ):
+    '''
+    Read deformation fields in the cache before they are used. Processes forked after the 
+    cache is warm share the decoded fields with the parent process.
+    Input:
+        cache: dict. Created with dfield_cache
+        files: list of strings. Deformation field files
+    '''
+    for dfile in files:
+        if cache['bytes'] >= cache['max_bytes']: break
+        read_dfield_array(dfile, cache)
+
+def dfield_array_to_image( array, geometry ):
+    '''
+    Create a deformation field image from a numpy array
+    Input:
+        array: numpy array [z,y,x,3]
+        geometry: tuple with (origin, spacing, direction)
+    Output:
+        dfield_image: sitk.Image (vector)
+    '''
+    dfield_image = sitk.GetImageFromArray(array, isVector = True)
+    dfield_image.SetOrigin(geometry[0])
+    dfield_image.SetSpacing(geometry[1])
+    dfield_image.SetDirection(geometry[2])
+    return dfield_image
+
+def dfield_buffer( array, cache = None, index = 0 ):
+    '''
+    Get a reusable array with the same shape and type of a deformation field array. 
+    Buffers are kept in the cache, one per shape and index.
+    Input:
+        array: numpy array
+        cache: dict. Created with dfield_cache (optional). Without cache a new array is returned
+        index: int. Buffer number, to use more than one buffer at the same time
+    Output:
+        buffer: numpy array
+    '''
+    if cache is None: return np.empty_like(array)
+    key = (array.shape, array.dtype.str, index)
+    if not key in cache['buffers']:
+        cache['buffers'][key] = np.empty_like(array)
+    return cache['buffers'][key]
+
+def scale_dfield_array( array, constant, cache = None, index = 0 ):
+    '''
+    Multiply a deformation field array by a constant in a single pass. The result is written 
+    in a reusable buffer (see dfield_buffer) and the input array is not modified.
+    Input:
+        array: numpy array [z,y,x,3]
+        constant: float
+        cache: dict. Created with dfield_cache (optional)
+        index: int. Buffer number
+    Output:
+        numpy array. The input array when constant is 1.0
+    '''
+    if constant == 1.0: return array
+    return np.multiply(array, constant, out = dfield_buffer(array, cache, index))
+
+def read_dfield_compose( compose_trfm_files, amplitude = 1.0, proportion = 1.0, slice_num = None, view = '', cache = None ):
     compose_trfm = sitk.CompositeTransform(3)
     for i,dfile in enumerate(compose_trfm_files):
         print(dfile)
-        dfield_image = sitk.ReadImage(dfile)                    # Read deformation field as image (inverse file provided)
-        if (amplitude != 1.0): dfield_image = multiply_multichannel(dfield_image,amplitude)
-        if (i == 0): dfield_image = multiply_multichannel(dfield_image,proportion)
+        array, geometry = read_dfield_array(dfile, cache)      # Read deformation field (inverse file provided)
+        constant = amplitude*proportion if (i == 0) else amplitude
+        dfield_image = dfield_array_to_image(scale_dfield_array(array, constant, cache), geometry) # image copies the buffer
         dfield_trfm = sitk.DisplacementFieldTransform(dfield_image)  # Read deformable transform
 #         print(image_info(dfield_slice))
 #         print(transform_info(dfield_trfm))
-        if (i == 0 ): compose_trfm = sitk.Transform(dfield_trfm)
-        else: compose_trfm.AddTransform(dfield_trfm)
+        compose_trfm.AddTransform(dfield_trfm)          # First file is the last transform to apply
     return compose_trfm
 
 
+def phase_dfield_name( phase, ref_num ):
+    '''
+    File name of the deformation field from a phase to the reference phase. The field 
+    maps points of the phase to the reference (same convention as antsRegistration 0Warp 
+    with the phase as fixed image and the reference as moving image).
+    Input:
+        phase: int. Phase number
+        ref_num: int. Reference phase number
+    Output:
+        string
+    '''
+    return '{}to{}_0Warp.nii.gz'.format(str(phase).zfill(2), str(ref_num).zfill(2))
+
+def phase_dfield_file( transform_files, ref_num, phase ):
+    '''
+    Find the deformation field of a phase to the reference phase
+    Input:
+        transform_files: list of strings. Files in the phase folder of the model
+        ref_num: int. Reference phase number
+        phase: int. Phase number
+    Output:
+        string or None for the reference phase (identity)
+    '''
+    if phase == ref_num: return None
+    return filter_folders_prefix([phase_dfield_name(phase, ref_num)], transform_files)[0]
+
+def phase_dfield_sources_name( phase, ref_num ):
+    '''
+    File name of the sources of a phase deformation field (see phase_dfield_sources)
+    Input:
+        phase: int. Phase number
+        ref_num: int. Reference phase number
+    Output:
+        string
+    '''
+    return '{}to{}_sources.json'.format(str(phase).zfill(2), str(ref_num).zfill(2))
+
+def dfield_source_key( dfile ):
+    '''
+    Identifier of the content of a sequential deformation field: the key of its registration
+    (prefix + key.txt, see registration.py) or the sha256 of the file when there is no key
+    Input:
+        dfile: string. Warp or inverse warp file
+    Output:
+        string
+    '''
+    name = os.path.basename(dfile)
+    for end in ['0InverseWarp.', '0Warp.']:
+        if end in name:
+            file_key = os.path.join(os.path.dirname(dfile), name.split(end)[0] + 'key.txt')
+            if os.path.exists(file_key):
+                with open(file_key, 'r') as f:
+                    return 'key:' + f.read().strip()
+    return 'sha256:' + file_sha256(dfile)
+
+def phase_dfield_sources( transform_files, ref_num, phase, phases = 10 ):
+    '''
+    Sequential deformation fields composed in the field of a phase, with their keys. A phase
+    field is current while the sources of the sequential registrations do not change
+    Input:
+        transform_files: list of strings. Sequential warp and inverse warp files
+        ref_num: int. Reference phase number
+        phase: int. Phase number
+        phases: int. Number of phases
+    Output:
+        sources: dict. File name and key (see dfield_source_key)
+    '''
+    list_path = shortest_path_of_image_sequence(list(range(phases)), ref_num, phase)
+    files = path_to_compose_transform_files(list_path, transform_files, False)
+    return dict([(os.path.basename(f), dfield_source_key(f)) for f in files])
+
+def read_phase_dfield_sources( folder_phase, ref_num, phase ):
+    '''
+    Sources written with a phase deformation field (see compose_phase_dfields)
+    Output:
+        sources: dict or None when unknown
+    '''
+    file_sources = os.path.join(folder_phase, phase_dfield_sources_name(phase, ref_num))
+    if not os.path.exists(file_sources): return None
+    try:
+        with open(file_sources, 'r') as f:
+            return json.load(f)
+    except ValueError:
+        return None
+
+def changed_phase_dfields( folder_phase, transform_files, ref_num, phases = 10 ):
+    '''
+    Phases whose deformation field was composed from other sequential registrations than the
+    current ones. Fields without sources (star topology, older models) are not checked
+    Input:
+        folder_phase: string. Folder of the phase fields
+        transform_files: list of strings. Sequential warp and inverse warp files
+        ref_num: int. Reference phase number
+        phases: int. Number of phases
+    Output:
+        list of int
+    '''
+    changed = []
+    for phase in range(phases):
+        if phase == ref_num: continue
+        old_sources = read_phase_dfield_sources(folder_phase, ref_num, phase)
+        if old_sources is None: continue
+        try:
+            sources = phase_dfield_sources(transform_files, ref_num, phase, phases)
+        except IndexError:          # incomplete sequential registrations
+            sources = None
+        if sources != old_sources: changed.append(phase)
+    return changed
+
+def compose_phase_dfield( transform_files, ref_num, phase, phases = 10, cache = None, verbose = False ):
+    '''
+    Compose the chain of sequential deformation fields from the reference to a phase into 
+    a single deformation field. Equivalent to the transform used by video_4d for the phase.
+    Input:
+        transform_files: list of strings. Sequential warp and inverse warp files
+        ref_num: int. Reference phase number
+        phase: int. Phase number
+        phases: int. Number of phases
+        cache: dict. Created with dfield_cache (optional)
+    Output:
+        dfield_image: sitk.Image (vector). Same grid as the sequential fields
+    '''
+    list_path = shortest_path_of_image_sequence(list(range(phases)), ref_num, phase)
+    compose_trfm_files = path_to_compose_transform_files(list_path, transform_files, verbose)
+    array, geometry = read_dfield_array(compose_trfm_files[0], cache)
+    size = [int(v) for v in array.shape[2::-1]]
+    trfm = read_dfield_compose(compose_trfm_files, cache = cache)
+    return sitk.TransformToDisplacementField(trfm, sitk.sitkVectorFloat64, size, *geometry)
+
+def compose_phase_dfields( folder_model, ref_num = 0, phases = 10, overwrite = False, debug = False, 
+                            verbose = False, cache = None ):
+    '''
+    Compose the sequential registrations of a breathing model (folder_model/seq) into one
+    deformation field per phase relative to the reference (folder_model/phase). The keys of the
+    sequential fields are written with each phase field (phase_dfield_sources_name), and an
+    existing field is composed again when its sequential registrations changed
+    Input:
+        folder_model: string. Model folder
+        ref_num: int. Reference phase number
+        phases: int. Number of phases in 4dct
+        overwrite: bool. Overwrite existent fields
+        debug: bool. Do not write the fields
+        verbose: bool
+        cache: dict. Created with dfield_cache (optional). The composed fields are also added
+            to the cache, therefore rendering in the same process does not read them again
+    Output:
+        files: list of strings. Fields written
+    '''
+    # Sequential transformations
+    folder_trfm = os.path.join(folder_model,'seq/')
+    files_trfms = listdir_fullpath(folder_trfm)
+    files_trfms_warp = filter_folders_prefix(['0Warp.'], files_trfms)
+    files_trfms_inv_warp = filter_folders_prefix(['0InverseWarp.'], files_trfms)
+    files_transforms = files_trfms_warp + files_trfms_inv_warp
+    if verbose:
+        print('\nWarp transform files: \n', fullpath_to_localpath(files_trfms_warp))
+        print('\nInverse warp transform files: \n', fullpath_to_localpath(files_trfms_inv_warp))
+
+    # Create directory to save output
+    output_path = os.path.join(folder_model,'phase/')  # Output path
+    if not debug:
+        os.makedirs(output_path, exist_ok=True)
+
+    # Compose the fields of each phase. Shared links of the chains are read once
+    if cache is None:
+        cache = dfield_cache()
+    files = []
+    for phase in range(phases):
+        if phase == ref_num: continue                   # identity
+        file_output = os.path.join(output_path, phase_dfield_name(phase, ref_num))
+        sources = phase_dfield_sources(files_transforms, ref_num, phase, phases)
+        if os.path.exists(file_output) and not overwrite:
+            old_sources = read_phase_dfield_sources(output_path, ref_num, phase)
+            if old_sources is None or old_sources == sources:
+                print('[Warning] Existing deformation field {}. Continue. Use option -w to overwrite'.format(file_output))
+                continue
+            print('Deformation field {} with different sequential registrations. Composing again'.format(file_output))
+
+        print('\nPhase {:02d} to reference {:02d}'.format(phase, ref_num))
+        dfield = compose_phase_dfield(files_transforms, ref_num, phase, phases, cache, verbose)
+        print(file_output)
+        if not debug:
+            sitk.WriteImage(dfield, file_output)
+            with open(os.path.join(output_path, phase_dfield_sources_name(phase, ref_num)), 'w') as f:
+                json.dump(sources, f, indent = 2)
+            dfield_cache_put(cache, file_output, sitk.GetArrayFromImage(dfield), 
+                (dfield.GetOrigin(), dfield.GetSpacing(), dfield.GetDirection()))
+            files.append(file_output)
+
+    if verbose:
+        print(dfield_cache_info(cache))
+    return files
+
+def read_dfield_phases( phase_files, amplitude = 1.0, proportion = 0.0, cache = None ):
+    '''
+    Blend the reference to phase deformation fields of the floor and ceil phases in a
+    single deformation field transform
+    Input:
+        phase_files: list with floor and ceil phase files (None for the reference phase)
+        amplitude: float
+        proportion: float. Weight of the ceil phase (0.0 to 1.0)
+    Output:
+        dfield_trfm: sitk.DisplacementFieldTransform or None for identity
+    '''
+    field = None
+    for dfile, weight in zip(phase_files, [1.0 - proportion, proportion]):
+        if dfile is None or weight == 0.0: continue     # reference phase has zero displacement
+        print(dfile)
+        array, geometry = read_dfield_array(dfile, cache)
+        if field is None: field = scale_dfield_array(array, amplitude*weight, cache, 0)
+        else: field = np.add(field, scale_dfield_array(array, amplitude*weight, cache, 1), out = dfield_buffer(array, cache, 0))
+    if field is None: return None
+    return sitk.DisplacementFieldTransform(dfield_array_to_image(field, geometry))
+
 def image3d_slice( image, slice_value, view = 'axial' ):
     '''
     Function to get an 2D slice from a 3D image. The orientation in coronal and sagittal is changed
@@ -134,22 +489,647 @@ def image3d_slice( image, slice_value, view = 'axial' ):
         slice_image = 0
     return slice_image
 
+def image3d_slab( image, slice_value, view = 'axial' ):
+    '''
+    Function to get a 3D image with only one slice (thickness of one voxel). It keeps the 
+    physical coordinates of the slice and it is used as reference grid to resample a plane.
+    Input:
+        image: sitk.Image 3D
+        slice_value: int. Slice number
+        view: string. Point of view [axial, sagittal or coronal]
+    Output:
+        slab_image: sitk.Image 3D
+    '''
+    if view == 'axial':
+        slab_image = image[:,:,slice_value:slice_value+1]    # axial = xy
+    elif view == 'coronal':
+        slab_image = image[:,slice_value:slice_value+1,:]    # coronal = xz
+    elif view == 'sagittal':
+        slab_image = image[slice_value:slice_value+1,:,:]    # sagital = yz
+    else:
+        slab_image = 0
+    return slab_image
+
+def resample_slice( image, slab, transform, view = 'axial', interpolator = sitk.sitkLinear, default_value = 0.0 ):
+    '''
+    Apply a transform only to the points of a slice plane. Equivalent to resample the full 3D image 
+    and then extract the slice, but the transform is evaluated only for the slice points.
+    Input:
+        image: sitk.Image 3D
+        slab: sitk.Image 3D. Slice plane obtained with image3d_slab
+        transform: sitk.Transform
+        view: string. Point of view [axial, sagittal or coronal]
+        interpolator: sitk.InterpolatorEnum
+        default_value: double
+    Output:
+        slice_image: sitk.Image 2D
+    '''
+    slab_warped = sitk.Resample(image, slab, transform, interpolator, default_value)
+    return image3d_slice(slab_warped, 0, view)
+
+def compose_images( images ):
+    '''
+    Stack scalar images in a single multichannel image. The images must share the same
+    grid (size, origin, spacing and direction).
+    Input:
+        images: list of sitk.Image 3D
+    Output:
+        stack: sitk.Image (vector) or None when the images do not share the same grid
+        pixel_ids: list with the pixel type of each image
+    '''
+    pixel_ids = [img.GetPixelID() for img in images]
+    pixel_stack = sitk.sitkFloat32 if all([p == sitk.sitkFloat32 for p in pixel_ids]) else sitk.sitkFloat64
+    try:
+        stack = sitk.Compose([sitk.Cast(img, pixel_stack) for img in images])
+    except RuntimeError:
+        stack = None
+    return stack, pixel_ids
+
+def resample_fused( stack, transform, pixel_ids, slice_value, view = 'axial', slab = None, 
+                    interpolator = sitk.sitkLinear, default_value = 0.0 ):
+    '''
+    Apply a transform to several images in a single pass and get the 2D slice of each one.
+    The transform is evaluated once per point and all the channels are interpolated there.
+    Input:
+        stack: sitk.Image (vector). Images obtained with compose_images
+        transform: sitk.Transform
+        pixel_ids: list with the pixel type of each output image
+        slice_value: int. Slice number
+        view: string. Point of view [axial, sagittal or coronal]
+        slab: sitk.Image 3D. Slice plane to resample only the slice (see image3d_slab). Optional
+        interpolator: sitk.InterpolatorEnum
+        default_value: double
+    Output:
+        list of sitk.Image 2D
+    '''
+    if slab is None:
+        warped = image3d_slice(sitk.Resample(stack, transform, interpolator, default_value), slice_value, view)
+    else:
+        warped = image3d_slice(sitk.Resample(stack, slab, transform, interpolator, default_value), 0, view)
+    return [sitk.VectorIndexSelectionCast(warped, i, pixel_id) for i, pixel_id in enumerate(pixel_ids)]
+
 def extract_image_masks(image, file_rt, label_strings, verbose = True):
-    if verbose: print('Labels in dicom file: \n', read_contours_labels(file_rt))
+    sset = read_structure_set(file_rt)      # parsed once, contours of the requested labels only
+    if verbose: print('Labels in dicom file: \n', sset['labels'])
     label_object = []
     color_object = []
     mask_object = []
     for label_str in label_strings:
-        contour, color = read_contours(file_rt,label_str)
+        contour, color = read_contours(file_rt,label_str)   # reuses the parsed structure set
         mask = contour_to_mask_3d( contour, image )
         if verbose: print(image_info(mask, 'Segment ' + label_str))
         label_object.append(label_object)
         color_object.append(color)
         mask_object.append(mask)
+    structure_set_save(sset)                # decoded contours persisted once
     return mask_object, color_object
 
+def video_options( params ):
+    '''
+    Video options for video_4d from the parameters of a yaml file (see parameters.yaml)
+    Input:
+        params: dict. Parameters loaded from the yaml file
+    Output:
+        opt: dict. Video options
+    '''
+    # Default Parameters
+    opt = dict([('view', 'sagittal'),       # view
+            ('slice', 180),                 # view slice value
+            ('video_time', 20.0),           # video desired total time
+            ('frame_per_sec', 4),           # video frames per second
+            ('reference', 0),               # reference phase in 4dct
+            ('phases', 10),                 # num phases 4dct
+            ('breathing_time', 4.5),        # breathing cycle time in seconds
+            ('amplitude', 1.0),             # amplitude of breathing
+            ('random_amp', False),          # amplitude with random value from 1.0 to 2.0
+            ('amplitude_seed', None),       # seed of the random amplitudes (None: new seed, kept by the store)
+            ('cache_mb', 4096),             # deformation field cache size in MB
+            ('output_format', 'frames'),    # frames, nifti, npy or store
+            ('store_chunk', 32),            # frames per chunk in the frame store
+            ('store_compress', True),       # compressed chunks
+            ('store_bits', 0),              # quantization of frames in the store: 0 (none), 8 or 16 bits
+            ('noise_model', None),          # noise model: gaussian, rician or kspace (noise as percentage)
+            ('noise_percent', 0.1),         # noise percentage
+            ('noise_fused', False),         # add noise in the render loop (noise stream) instead of a separate pass
+            ('noise_clean', True),          # with fused noise, write also the clean frames (image stream)
+            ('noise_seed', None),           # seed of the fused noise, frame k uses the substream k
+            ('noise_kspace', dict()) ])     # sampling mask of kspace noise: partial_fourier, undersampling, center_fraction
+
+    keys = [('camera-view', 'view'), ('slice', 'slice'), ('video-time', 'video_time'),
+            ('frame-per-second', 'frame_per_sec'), ('reference-phase', 'reference'),
+            ('breathing-amplitude', 'amplitude'), ('breathing-amplitude-seed', 'amplitude_seed'),
+            ('breathing-cycle-time', 'breathing_time'),
+            ('field-cache-size', 'cache_mb'), ('output-format', 'output_format'),
+            ('store-chunk-size', 'store_chunk'), ('store-compression', 'store_compress'), 
+            ('store-bits', 'store_bits'), ('noise-model', 'noise_model'), ('noise-percentage', 'noise_percent'),
+            ('noise-fused', 'noise_fused'), ('noise-clean', 'noise_clean'), ('noise-seed', 'noise_seed')]
+    if 'Video' in params:
+        for key, name in keys:
+            if key in params['Video']:
+                opt[name] = params['Video'][key]
+        kspace_keys = [('noise-partial-fourier', 'partial_fourier'), ('noise-undersampling', 'undersampling'),
+                       ('noise-center-fraction', 'center_fraction')]
+        opt['noise_kspace'] = dict([(name, params['Video'][key]) for key, name in kspace_keys if key in params['Video']])
+        if 'breathing-amplitude-type' in params['Video']:
+            opt['random_amp'] = True if params['Video']['breathing-amplitude-type'] == 'random' else False
+    return opt
+
+def segment_labels( params ):
+    '''
+    Labels of the segments from the parameters of a yaml file (see parameters.yaml)
+    Input:
+        params: dict. Parameters loaded from the yaml file
+    Output:
+        labels_segments: list of strings. Labels in the dicom rt file
+        labels_names: list of strings. Output folder names
+    '''
+    labels_segments = []
+    labels_names    = []
+    if 'Segments' in params:
+        if 'labels-input' in params['Segments']:
+            labels_segments = params['Segments']['labels-input']
+        if 'labels-output' in params['Segments']:
+            labels_names = params['Segments']['labels-output']
+    return labels_segments, labels_names
+
+def sweep_variants( grid ):
+    '''
+    List all the combinations of a grid of video parameters
+    Input:
+        grid: dict. Video parameter name (as in parameters.yaml) and list of values
+    Output:
+        variants: list of dict. Video parameter name and value
+    '''
+    keys = list(grid.keys())
+    values = [grid[key] if isinstance(grid[key], list) else [grid[key]] for key in keys]
+    return [dict(zip(keys, combination)) for combination in itertools.product(*values)]
+
+def variant_name( variant ):
+    '''
+    Folder name of a video variant, e.g. amp1.5_bt4.5_fps4_slice218_sagittal
+    Input:
+        variant: dict. Video parameter name and value
+    Output:
+        string
+    '''
+    short = dict([('breathing-amplitude', 'amp'), ('breathing-cycle-time', 'bt'), 
+            ('frame-per-second', 'fps'), ('slice', 'slice'), ('camera-view', ''), 
+            ('video-time', 'time'), ('breathing-amplitude-type', '')])
+    names = []
+    for key, value in variant.items():
+        prefix = short[key] if key in short else key
+        names.append('{}{}'.format(prefix, value))
+    return '_'.join(names)
+
+def load_patient_model( folder_input, folder_model, labels_segments, ref_phase = 0, phases = 10, verbose = False ):
+    '''
+    Load the patient images and the breathing model required to synthesize videos. The 
+    reference image (mr in 4dct space), the segment masks warped to the 4dct and the list of 
+    deformation field files.
+    Input:
+        folder_input: string. Folder with 4dct, mr and rt folders
+        folder_model: string. Folder with the breathing model
+        labels_segments: list of strings. Labels in the dicom rt file
+        ref_phase: int. Reference phase in 4dct
+        phases: int. Number of phases in 4dct
+    Output:
+        model: dict. Keys: reference, masks, colors, transform_files, model
+    '''
+    # Folders and Files
+    folder_4dct = os.path.join(folder_input, '4dct')
+    folder_mr = os.path.join(folder_input, 'mr')
+    folder_rt = os.path.join(folder_input, 'rt')
+
+    files_4dct = listdir_fullpath(folder_4dct)
+    file_4dct00 = files_4dct[0]
+    file_mr = listdir_fullpath(folder_mr)[0]
+    file_rt = listdir_fullpath(folder_rt)[0]
+    
+    file_reference = os.path.join(folder_model,'4dct-mr','4dct00_to_mr_Warped.nii.gz')
+    folder_trfm = os.path.join(folder_model,'seq/')
+
+    # Reference Image (mr in 4dct space)
+    image_reference = sitk.ReadImage(file_reference)
+    if verbose:
+        print(image_info(image_reference,'Reference 3D, MR Image Information'))
+
+    # Read transform 4dct-mr
+    image_ct =  sitk.ReadImage(file_4dct00, sitk.sitkFloat32)
+    file_affine = os.path.join(folder_model, '4dct-mr', '4dct00_to_mr_0GenericAffine.mat')
+    file_dfield = os.path.join(folder_model, '4dct-mr', '4dct00_to_mr_1Warp.nii.gz')
+    trfm_mr2ct = read_compose_transform(file_dfield, file_affine)
+
+    # Dicom RS. Masks on mr and colors
+    image_mr = sitk.ReadImage(file_mr, sitk.sitkFloat32)
+    list_masks, list_colors = extract_image_masks(image_mr, file_rt, labels_segments, verbose)
+    
+    list_trfm_masks = []
+    for mask in list_masks:
+        m = transform_image(mask, image_ct, trfm_mr2ct)
+        list_trfm_masks.append(m)
+
+    # 4DCT transformations    
+    files_trfms = listdir_fullpath(folder_trfm) if os.path.isdir(folder_trfm) else [] # star topology: no seq folder
+    files_trfms_warp = filter_folders_prefix(['0Warp.'], files_trfms)
+    files_trfms_inv_warp = filter_folders_prefix(['0InverseWarp.'], files_trfms)
+    if verbose:
+        print('\nWarp transform files: \n', fullpath_to_localpath(files_trfms_warp))
+        print('\nInverse warp transform files: \n', fullpath_to_localpath(files_trfms_inv_warp))
+    files_transforms = files_trfms_warp + files_trfms_inv_warp
+    model = 'sequential'
+
+    # Reference to phase fields (breathing-model-phases.py or star topology of breathing-model-registration.py).
+    # One field per phase
+    folder_phase = os.path.join(folder_model,'phase/')
+    if os.path.isdir(folder_phase):
+        files_phase = listdir_fullpath(folder_phase)
+        names_phase = [phase_dfield_name(p, ref_phase) for p in range(phases) if p != ref_phase]
+        # fields composed from other sequential registrations are not used
+        changed = changed_phase_dfields(folder_phase, files_transforms, ref_phase, phases)
+        if changed != []:
+            print('[Warning] Phase deformation fields of phases {} with different sequential registrations. '
+                  'Sequential model used'.format(changed))
+        elif all([filter_folders_prefix([name], files_phase) != [] for name in names_phase]):
+            model = 'phase'
+            files_transforms = filter_folders_prefix(names_phase, files_phase)
+            if verbose:
+                print('\nPhase transform files: \n', fullpath_to_localpath(files_transforms))
+
+    return dict([('reference', image_reference),
+            ('masks', list_trfm_masks),
+            ('colors', list_colors),
+            ('transform_files', files_transforms),
+            ('model', model) ])
+
+def video_frames( opt ):
+    '''
+    Compute the time variables of every frame in the video. The random amplitude of each 
+    breathing cycle is generated here in frame order from amplitude_seed, therefore the sequence 
+    does not depend on the order in which frames are rendered and is the same in a resumed video.
+    Without seed (None) the amplitudes change in every call.
+    Input:
+        opt: dict. Video options (see video_4d)
+    Output:
+        frames: list of dict. Keys: it, t, cycle, floor_phase, ceil_phase, residual, proportion, amplitude
+    '''
+    # time variables
+    ts = 1/opt['frame_per_sec']
+    time = np.arange(0.0,opt['video_time'],ts)
+    phase_per_sec = opt['breathing_time']/opt['phases']
+#     print(time)
+
+    # amplitude
+    amplitude = opt['amplitude']
+    if opt['random_amp']: amplitude = 1.0 # If random, first cycle is regular
+    rng = np.random.default_rng(opt['amplitude_seed'] if 'amplitude_seed' in opt else None)
+
+    frames = []
+    new_cycle = 0.0
+    for it,t in enumerate(time):
+        # time variables per iteration
+        cycle = t%opt['breathing_time']
+        if (abs(cycle - opt['breathing_time']) < 1e-6): cycle = 0.0 # this to avoid numerical aprox error of python. e.g when bt=3.6, t = 18 then cycle = 3.5999999
+        
+        # detect reboot cycle
+        if (new_cycle > cycle) and opt['random_amp']:
+            # print('random')
+            amplitude = rng.uniform(1.0,2.0)
+
+        new_cycle = cycle
+        floor_phase = int(np.floor(cycle/phase_per_sec))
+        ceil_phase = int(np.ceil(cycle/phase_per_sec))%10
+        residual = cycle%phase_per_sec
+        proportion = residual/phase_per_sec
+        frames.append(dict([('it', it), ('t', t), ('cycle', cycle), 
+            ('floor_phase', floor_phase), ('ceil_phase', ceil_phase), 
+            ('residual', residual), ('proportion', proportion), ('amplitude', amplitude)]))
+    return frames
+
+def frame_transform( frame, transform_files, opt, cache = None ):
+    '''
+    Read the transform of a video frame
+    Input:
+        frame: dict. Frame time variables (see video_frames)
+        transform_files: list of strings. Deformation field files of the breathing model
+        opt: dict. Video options (see video_4d)
+        cache: dict. Created with dfield_cache (optional)
+    Output:
+        trfm: sitk.Transform or None for identity
+    '''
+    floor_phase = frame['floor_phase']
+    ceil_phase = frame['ceil_phase']
+    proportion = frame['proportion']
+    amplitude = frame['amplitude']
+
+    trfm = None
+    if opt['model'] == 'phase':
+        # reference to phase fields. Blend floor and ceil phases
+        phase_files = [phase_dfield_file(transform_files, opt['reference'], floor_phase),
+                       phase_dfield_file(transform_files, opt['reference'], ceil_phase)]
+        if opt['verbose']: print(fullpath_to_localpath([f for f in phase_files if f is not None]))
+        if not opt['debug']:
+            trfm = read_dfield_phases( phase_files, amplitude, proportion, cache )
+    else:
+        # find the path
+        list_path = select_path(opt['phases'], opt['reference'], floor_phase, ceil_phase)
+#         print(list_path)
+        proportion = 1-proportion if (not is_increase(list_path)) else proportion
+#         print('% = ', proportion)
+        
+        #compose transform
+        compose_trfm_files = path_to_compose_transform_files(list_path, transform_files, opt['verbose'])
+        if opt['verbose']: print(fullpath_to_localpath(compose_trfm_files))
+        
+        if (not compose_trfm_files == [] and not opt['debug']):
+            # read the transforms
+            trfm = read_dfield_compose( compose_trfm_files, amplitude, proportion, opt['slice'], opt['view'], cache )
+    return trfm
+
+def render_frame( state, frame ):
+    '''
+    Render the 2D image and the 2D extra images of a video frame
+    Input:
+        state: dict. Images, transform files, options and cache prepared by video_4d
+        frame: dict. Frame time variables (see video_frames)
+    Output:
+        img_warped: sitk.Image 2D
+        img2d_extra: list of sitk.Image 2D
+    '''
+    opt = state['opt']
+
+    # initialize images to write (reference phase)
+    img_warped = sitk.Image(state['img'])
+    img2d_extra = [sitk.Image(img_ext) for img_ext in state['img2d_extra']]
+
+    trfm = frame_transform(frame, state['transform_files'], opt, state['cache'])
+    if trfm is not None:
+        img3d = state['img3d']
+        img3d_slab = state['img3d_slab']
+        extra_images = state['extra_images']
+        if state['img3d_stack'] is not None:
+            # transform once, interpolate reference and extra images
+            slab = img3d_slab if opt['slice_only'] else None
+            images_warped = resample_fused(state['img3d_stack'], trfm, state['stack_pixel_ids'], opt['slice'], opt['view'], slab)
+            img_warped = images_warped[0]
+            img2d_extra = images_warped[1:]
+        elif opt['slice_only']:
+            # transform only the output plane
+            img_warped = resample_slice(img3d, img3d_slab, trfm, opt['view'])
+            for i,img_ext in enumerate(extra_images):
+                img2d_extra[i] = resample_slice(img_ext, img3d_slab, trfm, opt['view'])
+        else:
+            # transform the image
+            img3d_warped = sitk.Resample(img3d, trfm, sitk.sitkLinear, 0.0)
+            # slice
+            img_warped = image3d_slice(img3d_warped, opt['slice'], opt['view'])
+            
+            # extra images
+            for i,img_ext in enumerate(extra_images):
+                # transform the image
+                img3d_extra_warped = sitk.Resample(img_ext, trfm, sitk.sitkLinear, 0.0)
+                # slice
+                img2d_extra[i] = image3d_slice(img3d_extra_warped, opt['slice'], opt['view'])
+    
+    # change direction
+    img_warped.SetDirection([-1,0,0,-1])
+    # print(image_info(img_warped))
+    
+    for img_ext in img2d_extra:
+        img_ext.SetDirection([-1,0,0,-1])
+    return img_warped, img2d_extra
+
+def frame_key( frame, opt, decimals = 6 ):
+    '''
+    Key of the transform parameters of a frame. Frames with the same key render the same
+    images. Proportion and amplitude are rounded to avoid numerical approximation errors.
+    Input:
+        frame: dict. Frame time variables (see video_frames)
+        opt: dict. Video options (see video_4d)
+        decimals: int. Decimals to round proportion and amplitude
+    Output:
+        tuple
+    '''
+    return (frame['floor_phase'], frame['ceil_phase'], round(frame['proportion'], decimals), 
+            round(frame['amplitude'], decimals), opt['view'], opt['slice'])
+
+_render_state = None    # state of the worker processes in parallel rendering
+
+def _render_init( state, threads ):
+    global _render_state
+    _render_state = state
+    sitk.ProcessObject.SetGlobalDefaultNumberOfThreads(threads)
+
+def _render_frame_worker( frame ):
+    return render_frame(_render_state, frame)
+
+def render_frames( state, frames, workers = 1 ):
+    '''
+    Render a list of video frames. With more than one worker the frames are distributed in a 
+    pool of processes, each one with its own deformation field cache. The output keeps the 
+    order of the frames. When opt['memo'] is enabled, frames with the same transform 
+    parameters (see frame_key) are rendered once and reused.
+    Input:
+        state: dict. Images, transform files, options and cache prepared by video_4d
+        frames: list of dict. Frame time variables (see video_frames)
+        workers: int. Number of processes
+    Output:
+        generator of (img_warped, img2d_extra) tuples. See render_frame
+    '''
+    opt = state['opt']
+    if opt['memo']:
+        keys = [frame_key(frame, opt, opt['memo_decimals']) for frame in frames]
+    else:
+        keys = list(range(len(frames)))     # all frames different
+    last_use = dict([(key, i) for i, key in enumerate(keys)])
+    first_use = dict([(key, i) for i, key in reversed(list(enumerate(keys)))])
+    frames_render = [frame for i, (frame, key) in enumerate(zip(frames, keys)) if first_use[key] == i]
+    if opt['memo'] and opt['verbose']:
+        print('\nFrames: {}, rendered: {}, reused: {}'.format(len(frames), len(frames_render), len(frames) - len(frames_render)))
+
+    if workers <= 1 or len(frames_render) <= 1:
+        results = (render_frame(state, frame) for frame in frames_render)
+        for result in _memo_frames(results, keys, first_use, last_use):
+            yield result
+        return
+
+    # fork shares the loaded images with the workers without copies
+    if 'fork' in multiprocessing.get_all_start_methods():
+        ctx = multiprocessing.get_context('fork')
+    else:
+        ctx = multiprocessing.get_context()
+    threads = max(1, (os.cpu_count() or 1)//workers)   # split ITK threads between processes
+    with ctx.Pool(workers, _render_init, (state, threads)) as pool:
+        results = pool.imap(_render_frame_worker, frames_render)
+        for result in _memo_frames(results, keys, first_use, last_use):
+            yield result
+
+def _memo_frames( results, keys, first_use, last_use ):
+    # results of the frames rendered (first use of each key) in order, repeated for every frame.
+    # A result is kept only until the last frame that uses it
+    memo = dict()
+    for i, key in enumerate(keys):
+        if first_use[key] == i: result = next(results)
+        else: result = memo[key]
+        if last_use[key] > i: memo[key] = result
+        else: memo.pop(key, None)
+        yield result
+
+def nifti_data_offset( file_name ):
+    '''
+    Position of the voxel data in an uncompressed nifti file (vox_offset in the header)
+    Input:
+        file_name: string. Nifti file (.nii)
+    Output:
+        offset: int. Bytes
+    '''
+    with open(file_name, 'rb') as f:
+        header = f.read(176)
+    sizeof_hdr = np.frombuffer(header[0:4], dtype='<i4')[0]
+    if sizeof_hdr == 348:   # nifti-1
+        return int(np.frombuffer(header[108:112], dtype='<f4')[0])
+    else:                   # nifti-2
+        return int(np.frombuffer(header[168:176], dtype='<i8')[0])
+
+def open_video_stream( file_name, template, num_frames, frame_per_sec = 4, output_format = 'nifti' ):
+    '''
+    Create a single file to store all the frames of a video stream. The file is written with a 
+    temporary name (.part) until the stream is closed. Output formats:
+        nifti: 3D image (x, y, t). The spacing in t is the frame time
+        npy: numpy array (t, y, x) and a json file with the image metadata
+    Both files can be read with memory mapping.
+    Input:
+        file_name: string. Output file without extension
+        template: sitk.Image 2D. Frame with the size, pixel type and metadata of the stream
+        num_frames: int. Number of frames
+        frame_per_sec: float. Video frames per second
+        output_format: string. nifti or npy
+    Output:
+        stream: dict. Keys: file, file_part, array (numpy memmap)
+    '''
+    size = template.GetSize()
+    dtype = sitk.GetArrayViewFromImage(template).dtype
+    shape = (num_frames, size[1], size[0])
+    d = template.GetDirection()
+    spacing = list(template.GetSpacing()) + [1.0/frame_per_sec]
+    origin = list(template.GetOrigin()) + [0.0]
+    direction = [d[0], d[1], 0.0, d[2], d[3], 0.0, 0.0, 0.0, 1.0]
+
+    if output_format == 'nifti':
+        file_out = file_name + '.nii'
+        file_part = file_name + '.part.nii'
+        volume = sitk.Image([size[0], size[1], num_frames], template.GetPixelID())
+        volume.SetSpacing(spacing)
+        volume.SetOrigin(origin)
+        volume.SetDirection(direction)
+        sitk.WriteImage(volume, file_part)      # header and empty frames
+        array = np.memmap(file_part, dtype = dtype, mode = 'r+', offset = nifti_data_offset(file_part), shape = shape)
+    else:
+        file_out = file_name + '.npy'
+        file_part = file_name + '.part.npy'
+        array = np.lib.format.open_memmap(file_part, mode = 'w+', dtype = dtype, shape = shape)
+        metadata = dict([('size', [size[0], size[1], num_frames]), ('origin', origin), 
+                ('spacing', spacing), ('direction', direction), ('frame_per_sec', frame_per_sec)])
+        with open(file_name + '.json', 'w') as f:
+            json.dump(metadata, f, indent = 2)
+    return dict([('file', file_out), ('file_part', file_part), ('array', array)])
+
+def close_video_stream( stream ):
+    '''
+    Write the remaining frames of a video stream and rename the file to its final name
+    Input:
+        stream: dict. Created with open_video_stream
+    '''
+    stream['array'].flush()
+    del stream['array']
+    os.replace(stream['file_part'], stream['file'])
+    print(stream['file'])
+
+def open_video_writer( output_folder, streams, opt, num_frames ):
+    '''
+    Prepare the output of a video. Frames are written in one file per frame and stream
+    (output_format frames), in one file per stream (nifti or npy, see open_video_stream) or
+    in a chunked frame store with a manifest (store, see open_frame_store).
+    Input:
+        output_folder: string
+        streams: list of tuple (name, folder, prefix). Stream file name, folder and prefix of frame files
+        opt: dict. Video options (see video_4d)
+        num_frames: int. Total number of frames in the video
+    Output:
+        writer: dict. Key done has the frame numbers already written (resume)
+    '''
+    writer = dict([('folder', output_folder), ('streams', streams), ('opt', opt), 
+            ('num_frames', num_frames), ('files', []), ('store', None), ('done', set())])
+
+    if opt['output_format'] == 'frames':
+        # frames with the files of all the streams. Temporary files of interrupted writes are removed
+        for name, folder, prefix in streams:
+            if not os.path.isdir(folder): continue
+            for f in filter_folders_prefix(['.part.nii'], listdir_fullpath(folder)):
+                os.remove(f)
+        files = [set(fullpath_to_localpath(listdir_fullpath(folder))) if os.path.isdir(folder) else set() 
+                 for name, folder, prefix in streams]
+        writer['done'] = set([it for it in range(num_frames) if all(['{}_{:04d}.nii'.format(prefix, it) in files[k] 
+                 for k, (name, folder, prefix) in enumerate(streams)])])
+    elif opt['output_format'] == 'store':
+        if not opt['debug']:
+            store = open_frame_store(os.path.join(output_folder, 'store'), [name for name, folder, prefix in streams], 
+                                     opt, num_frames, opt['overwrite'])
+            if store is None: writer['done'] = set(range(num_frames))     # different parameters, nothing to write
+            else: writer['done'] = set(store['done'])
+            writer['store'] = store
+    else:
+        # complete video with the files of all the streams (image is not written with noise-clean false)
+        extension = '.nii' if opt['output_format'] == 'nifti' else '.npy'
+        if all([os.path.exists(os.path.join(output_folder, name + extension)) for name, folder, prefix in streams]):
+            writer['done'] = set(range(num_frames))
+    return writer
+
+def write_video_frame( writer, frame, images ):
+    '''
+    Write the images of a frame, one per stream
+    Input:
+        writer: dict. Created with open_video_writer
+        frame: dict. Frame time variables (see video_frames)
+        images: list of sitk.Image 2D
+    '''
+    opt = writer['opt']
+    it = frame['it']
+    if opt['output_format'] == 'frames':
+        for (name, folder, prefix), image in zip(writer['streams'], images):
+            file_out = os.path.join(folder, '{}_{:04d}.nii'.format(prefix, it))
+            print(file_out)
+            if not opt['debug']: 
+                file_part = os.path.join(folder, '{}_{:04d}.part.nii'.format(prefix, it))
+                sitk.WriteImage(image, file_part)
+                os.replace(file_part, file_out)     # never a half written frame
+        return
+    
+    if opt['debug']: return
+    if opt['output_format'] == 'store':
+        if writer['store'] is not None: write_store_frame(writer['store'], frame, images)
+        return
+    if writer['files'] == []:   # streams are created with the first frame
+        for (name, folder, prefix), image in zip(writer['streams'], images):
+            file_name = os.path.join(writer['folder'], name)
+            writer['files'].append(open_video_stream(file_name, image, writer['num_frames'], 
+                                    opt['frame_per_sec'], opt['output_format']))
+    for stream, image in zip(writer['files'], images):
+        stream['array'][it] = sitk.GetArrayViewFromImage(image)
+
+def close_video_writer( writer ):
+    '''
+    Finish the output of a video
+    Input:
+        writer: dict. Created with open_video_writer
+    '''
+    if writer['store'] is not None:
+        close_frame_store(writer['store'])
+    for stream in writer['files']:
+        close_video_stream(stream)
+    writer['files'] = []
+
 def video_4d( reference_file, transform_files, output_folder, 
-            opt = 0, extra_images = [], extra_folders = [] ):
+            opt = 0, extra_images = [], extra_folders = [], cache = None ):
 
     # in case opt is empty or missing parameters
     if opt == 0:
@@ -163,50 +1143,101 @@ def video_4d( reference_file, transform_files, output_folder,
     if not 'video_time' in opt:     opt['video_time']     = 20.0
     if not 'frame_per_sec' in opt:  opt['frame_per_sec']  = 4
     if not 'random_amp' in opt:     opt['random_amp']     = False
+    if not 'amplitude_seed' in opt: opt['amplitude_seed'] = None
     if not 'overwrite' in opt:      opt['overwrite']      = False
     if not 'debug' in opt:          opt['debug']          = False
     if not 'verbose' in opt:        opt['verbose']        = False
+    if not 'cache_mb' in opt:       opt['cache_mb']       = 4096
+    if not 'slice_only' in opt:     opt['slice_only']     = True
+    if not 'model' in opt:          opt['model']          = 'sequential'
+    if not 'fused' in opt:          opt['fused']          = True
+    if not 'workers' in opt:        opt['workers']        = 1
+    if not 'memo' in opt:           opt['memo']           = True
+    if not 'memo_decimals' in opt:  opt['memo_decimals']  = 6
+    if not 'output_format' in opt:  opt['output_format']  = 'frames'
+    if not 'store_chunk' in opt:    opt['store_chunk']    = 32
+    if not 'store_compress' in opt: opt['store_compress'] = True
+    if not 'store_bits' in opt:     opt['store_bits']     = 0
+    if not 'noise_model' in opt:    opt['noise_model']    = None
+    if not 'noise_percent' in opt:  opt['noise_percent']  = 0.1
+    if not 'noise_fused' in opt:    opt['noise_fused']    = False
+    if not 'noise_clean' in opt:    opt['noise_clean']    = True
+    if not 'noise_seed' in opt:     opt['noise_seed']     = None
+    if not 'noise_kspace' in opt:   opt['noise_kspace']   = dict()
+
+    # deformation fields are decoded once and reused by all frames
+    if cache is None:
+        cache = dfield_cache(opt['cache_mb'])
 
     # print('W:', opt['overwrite'])
     
-    # read the reference image
-    img3d = sitk.ReadImage(reference_file)
+    # read the reference image (file name or loaded image)
+    if isinstance(reference_file, sitk.Image): img3d = reference_file
+    else: img3d = sitk.ReadImage(reference_file)
     img = image3d_slice(img3d, opt['slice'], opt['view'])
+    img3d_slab = image3d_slab(img3d, opt['slice'], opt['view']) # output plane, reference grid to resample
     if opt['verbose']: print(image_info(img), 'CineMR Image Information')
     minmax = sitk.MinimumMaximumImageFilter()
     minmax.Execute(img)
     # print('min {}, max {}\n'.format(minmax.GetMinimum(), minmax.GetMaximum()))
     
+    # fused noise. Statistics of the reference slice, computed once for all frames
+    noise_stats = None
+    if opt['noise_fused'] and opt['noise_model'] is not None:
+        noise_stats = noise_image_stats(img)
+        noise_seed = np.random.SeedSequence(opt['noise_seed'])
+
     # extra images
     img2d_extra = []
     for img_ext in extra_images:
         img2d_extra.append(image3d_slice(img_ext, opt['slice'], opt['view']))
-    
-    # time variables
-    ts = 1/opt['frame_per_sec']
-    time = np.arange(0.0,opt['video_time'],ts)
-    phase_per_sec = opt['breathing_time']/opt['phases']
-#     print(time)
 
-    # amplitude
-    amplitude = opt['amplitude']
-    if opt['random_amp']: amplitude = 1.0 # If random, first cycle is regular
+    # reference and extra images stacked to be resampled in a single pass
+    img3d_stack = None
+    stack_pixel_ids = []
+    if opt['fused'] and extra_images != []:
+        img3d_stack, stack_pixel_ids = compose_images([img3d] + extra_images)
+
+    # seed of the random amplitudes. A resumed store keeps the seed of its frames
+    if opt['random_amp'] and opt['amplitude_seed'] is None:
+        stored = None
+        if opt['output_format'] == 'store' and not opt['overwrite']:
+            stored = read_store_parameters(os.path.join(output_folder, 'store'))
+        if stored is not None and stored.get('amplitude_seed') is not None:
+            opt['amplitude_seed'] = stored['amplitude_seed']
+        else:
+            opt['amplitude_seed'] = int(np.random.SeedSequence().entropy)
+        if opt['verbose']: print('Amplitude seed: {}'.format(opt['amplitude_seed']))
+
+    # frames time variables
+    frames = video_frames(opt)
     
     # make output folders
+    frames_output = opt['output_format'] == 'frames'     # one file per frame
     folder_out = os.path.join(output_folder, 'image/')
     # if not opt['debug']: 
-    os.system('mkdir -p ' + folder_out)            # make directory
+    write_clean = noise_stats is None or opt['noise_clean']
+    if frames_output and write_clean: os.system('mkdir -p ' + folder_out)            # make directory
+    else: os.makedirs(output_folder, exist_ok=True)
     folder_out_extras = []
+    streams = [('image', folder_out, 'image')]
+    if noise_stats is not None:     # noise stream, same file names as video-synthesis-noise.py
+        folder_noise = os.path.join(output_folder, 'noise/')
+        if frames_output and not opt['debug']: os.makedirs(folder_noise, exist_ok=True)
+        streams.append(('noise', folder_noise, 'image'))
+        if not write_clean: streams = streams[1:]
     if (extra_folders == []):
         for k,_ in enumerate(img2d_extra):
             folder_ext = os.path.join(output_folder, 'struct{:02d}/'.format(k))
-            if not opt['debug']: os.system('mkdir -p ' + folder_ext)    # make directory
+            if not opt['debug'] and frames_output: os.system('mkdir -p ' + folder_ext)    # make directory
             folder_out_extras.append(folder_ext)
+            streams.append(('struct{:02d}'.format(k), folder_ext, 'structure'))
     else:
         for folder in extra_folders:
             folder_ext = os.path.join(output_folder, folder)
-            if not opt['debug']: os.system('mkdir -p ' + folder_ext)    # make directory
+            if not opt['debug'] and frames_output: os.system('mkdir -p ' + folder_ext)    # make directory
             folder_out_extras.append(folder_ext)
+            streams.append((folder, folder_ext, folder))
 
     # assert extra
     assert len(extra_images) == len(folder_out_extras)
@@ -215,93 +1246,98 @@ def video_4d( reference_file, transform_files, output_folder,
     # Prepare for loop
     info = '{:^5}  {:^5}  {:^5}  {:^5}  {:^5}  {:^5}'\
               .format('ts', 'cycle', 'phase', 'res', '%', 'amp')
-    it = 0
-    new_cycle = 0.0
+    writer = open_video_writer(output_folder, streams, opt, len(frames))
 
-    # Check if existing files in output
-    existing_files = listdir_fullpath(folder_out)
-    num_files = len(existing_files)
-    if num_files > 0:
+    # Check if existing files in output. Only missing frames are rendered
+    if len(writer['done']) > 0:
         print('Existing files, use option -w to overwrite')
-        if not opt['overwrite']:
-            it = num_files
-            time = time[num_files:]
+        if not opt['overwrite'] or opt['output_format'] == 'store':
+            frames = [frame for frame in frames if not frame['it'] in writer['done']]
     
     # if opt['overwrite']:
-            
 
-    for t in time:
-        # initialize image to write
-        img_warped = img
-        
-        # time variables per iteration
-        cycle = t%opt['breathing_time']
-        if (abs(cycle - opt['breathing_time']) < 1e-6): cycle = 0.0 # this to avoid numerical aprox error of python. e.g when bt=3.6, t = 18 then cycle = 3.5999999
-        
-        # detect reboot cycle
-        if (new_cycle > cycle) and opt['random_amp']:
-            # print('random')
-            amplitude = np.random.uniform(1.0,2.0)
+    state = dict([('img3d', img3d),
+            ('img', img),
+            ('img3d_slab', img3d_slab),
+            ('img3d_stack', img3d_stack),
+            ('stack_pixel_ids', stack_pixel_ids),
+            ('extra_images', extra_images),
+            ('img2d_extra', img2d_extra),
+            ('transform_files', transform_files),
+            ('opt', opt),
+            ('cache', cache) ])
 
-        new_cycle = cycle
-        floor_phase = int(np.floor(cycle/phase_per_sec))
-        ceil_phase = int(np.ceil(cycle/phase_per_sec))%10
-        residual = cycle%phase_per_sec
-        proportion = residual/phase_per_sec
-        
+    # workers share the fields decoded by the parent process
+    if opt['workers'] > 1 and not opt['debug'] and len(frames) > 1:
+        dfield_cache_warm(cache, transform_files)
+
+    for frame, (img_warped, img2d_ext) in zip(frames, render_frames(state, frames, opt['workers'])):
         # print iteration info
         print()
         print(info)
         print('{:5.2f}  {:5.2f}  {:2d}-{:<2d}  {:5.2f}  {:5.2f}  {:5.2f}'\
-              .format(t, cycle, floor_phase, ceil_phase, residual, proportion, amplitude))
-        
-        # find the path
-        list_path = select_path(opt['phases'], opt['reference'], floor_phase, ceil_phase)
-        #         print(list_path)
-        proportion = 1-proportion if (not is_increase(list_path)) else proportion
-#         print('% = ', proportion)
-        
-        #compose transform
-        compose_trfm_files = path_to_compose_transform_files(list_path, transform_files, opt['verbose'])
-        if opt['verbose']: print(fullpath_to_localpath(compose_trfm_files))
-        
-        if (not compose_trfm_files == [] and not opt['debug']):
-            # read the transforms
-            trfm = read_dfield_compose( compose_trfm_files, amplitude, proportion, opt['slice'], opt['view'] )
-            # transform the image
-            img3d_warped = sitk.Resample(img3d, trfm, sitk.sitkLinear, 0.0)
-            # slice
-            img_warped = image3d_slice(img3d_warped, opt['slice'], opt['view'])
-            
-            # extra images
-            for i,img_ext in enumerate(extra_images):
-                # transform the image
-                img3d_extra_warped = sitk.Resample(img_ext, trfm, sitk.sitkLinear, 0.0)
-                # slice
-                img2d_extra[i] = image3d_slice(img3d_extra_warped, opt['slice'], opt['view'])
-            
-        
-        # change direction
-        img_warped.SetDirection([-1,0,0,-1])
-        # print(image_info(img_warped))
-        
-        for img_ext in img2d_extra:
-            img_ext.SetDirection([-1,0,0,-1])
+              .format(frame['t'], frame['cycle'], frame['floor_phase'], frame['ceil_phase'], 
+                      frame['residual'], frame['proportion'], frame['amplitude']))
         
         # write the image
 #         img_warped = sitk.Cast(img_warped, sitk.sitkUInt16)
-        file_out = os.path.join(folder_out, 'image_{:04d}.nii'.format(it))
-        print(file_out)
-        if not opt['debug']: sitk.WriteImage(img_warped, file_out)
-        
-        file_extra = ''
-        for k,img_ext in enumerate(img2d_extra):
-            if (extra_folders == []):
-                file_extra = os.path.join(folder_out_extras[k], 'structure_{:04d}.nii'.format(it))
-            else:
-                file_extra = os.path.join(folder_out_extras[k], extra_folders[k] + '_{:04d}.nii'.format(it))
-            print(file_extra)
-            if not opt['debug']: sitk.WriteImage(img_ext, file_extra)
-        
-        it = it + 1
-    
\ No newline at end of file
+        images = [img_warped]
+        if noise_stats is not None:
+            seed = np.random.SeedSequence(noise_seed.entropy, spawn_key = (frame['it'],))   # substream of the frame
+            img_noise = noise_frame(img_warped, opt['noise_model'], opt['noise_percent'], noise_stats, seed, opt['noise_kspace'])
+            images = images + [img_noise] if opt['noise_clean'] else [img_noise]
+        write_video_frame(writer, frame, images + img2d_ext)
+
+    close_video_writer(writer)
+
+    if opt['verbose']: print(dfield_cache_info(cache))
+
+def video_simulation( folder_input, folder_model, folder_output, params, overwrite = False, debug = False, 
+                        verbose = False, workers = 1, cache = None, model = None ):
+    '''
+    Synthesize the CineMR video of a patient with the parameters of a yaml file (see parameters.yaml)
+    Input:
+        folder_input: string. Folder with 4dct, mr and rt folders
+        folder_model: string. Folder with the breathing model
+        folder_output: string. Output folder
+        params: dict. Parameters of the yaml file
+        overwrite: bool. Overwrite existent videos
+        debug: bool
+        verbose: bool
+        workers: int. Number of processes to render frames in parallel
+        cache: dict. Created with dfield_cache (optional), e.g. shared with compose_phase_dfields
+        model: dict. Created with load_patient_model (optional). Loaded when not provided
+    Output:
+        model: dict. Patient model used. None when the video exists and overwrite is not set
+    '''
+    opt = video_options(params)
+    labels_segments, labels_names = segment_labels(params)
+
+    folder_out = os.path.join(folder_output, 'image/')
+    if opt['noise_fused'] and opt['noise_model'] is not None and not opt['noise_clean']:
+        folder_out = os.path.join(folder_output, 'noise/')     # only noise frames
+    if not debug and opt['output_format'] == 'frames':
+        os.makedirs(folder_out, exist_ok=True)
+
+    # Check if existing files in output
+    existing_files = fullpath_to_localpath(listdir_fullpath(folder_out)) if os.path.isdir(folder_out) else []
+    time = np.arange(0.0, opt['video_time'], 1/opt['frame_per_sec'])
+    expected_files = ['image_{:04d}.nii'.format(it) for it in range(len(time))]
+
+    if opt['output_format'] == 'frames' and set(expected_files) <= set(existing_files):
+        if not overwrite:
+            print('[Warning] Existing CineMR files. Use option -w to overwrite')
+            return None
+
+    # Reference image, masks and breathing model
+    if model is None:
+        model = load_patient_model(folder_input, folder_model, labels_segments, opt['reference'], opt['phases'], verbose)
+
+    # Video
+    opt['model'] = model['model']
+    opt['workers'] = workers
+    opt['overwrite'] = overwrite
+    opt['debug'] = debug
+
+    video_4d(model['reference'], model['transform_files'], folder_output, opt, model['masks'], labels_names, cache)
+    return model
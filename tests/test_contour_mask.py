@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+# Rasterization of the rt contours (image.py) compared with skimage.draw.polygon
+
+import os
+import sys
+import numpy as np
+import SimpleITK as sitk
+from skimage.draw import polygon
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src'))
+from image import polygon_to_mask, contours_to_mask_slice, contour_to_mask_3d
+
+def skimage_mask( cc, shape ):
+    mask = np.zeros(shape, dtype = np.uint8)
+    rr, cc = polygon(cc[:,1], cc[:,0], shape)
+    mask[rr, cc] = 1
+    return mask
+
+def random_polygons( integer, num = 300, seed = 0 ):
+    rng = np.random.default_rng(seed)
+    for _ in range(num):
+        shape = tuple(rng.integers(5, 40, 2))
+        n = rng.integers(3, 10)
+        if integer: cc = rng.integers(-3, 43, (n, 2)).astype(np.float64)
+        else:       cc = rng.uniform(-3, 43, (n, 2))
+        yield cc, shape
+
+def test_float_polygons():
+    for cc, shape in random_polygons(False):
+        assert np.array_equal(polygon_to_mask(cc, shape), skimage_mask(cc, shape))
+
+def test_integer_polygons():
+    # vertices and diagonal, vertical and horizontal edges through pixel centers
+    for cc, shape in random_polygons(True, seed = 1):
+        assert np.array_equal(polygon_to_mask(cc, shape), skimage_mask(cc, shape))
+    diamond = np.array([[3, 1], [6, 4], [3, 7], [0, 4]], dtype = np.float64)
+    assert np.array_equal(polygon_to_mask(diamond, (8, 8)), skimage_mask(diamond, (8, 8)))
+
+def test_holes():
+    # contours of one slice with the even-odd rule: the inner contour is a hole
+    outer = np.array([[2, 2], [20, 2], [20, 20], [2, 20]], dtype = np.float64)
+    inner = np.array([[6.5, 6.5], [14.5, 6.5], [10.5, 15.5]])
+    mask = contours_to_mask_slice([outer, inner], (24, 24))
+    expected = skimage_mask(outer, (24, 24)) ^ skimage_mask(inner, (24, 24))
+    assert mask.max() == 1
+    assert np.array_equal(mask, expected)
+    assert mask[10, 10] == 0 and mask[3, 3] == 1
+
+def test_slice_of_contours():
+    # contours in slices -1 (outside) and 2
+    image = sitk.Image([16, 16, 4], sitk.sitkUInt8)
+    square = [[2, 2], [10, 2], [10, 10], [2, 10]]
+    contours = [np.array([[x, y, z] for x, y in square], dtype = np.float64).reshape(-1) for z in [-0.5, 2.0]]
+    mask = contour_to_mask_3d(contours, image, return_numpy = True, workers = 1)
+    assert mask[0].max() == 0
+    assert np.array_equal(mask[2], skimage_mask(np.array(square, dtype = np.float64), (16, 16)))
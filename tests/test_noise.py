@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+# Batch noise engine (noise.py): reproducible noise and statistics of frame stacks
+
+import os
+import sys
+import numpy as np
+import SimpleITK as sitk
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src'))
+from noise import noise_stack, noise_stack_stats, noise_merge_stats, noise_image_stats, noise_folder
+
+def frame_stack( frames = 9, dtype = np.float32 ):
+    rng = np.random.default_rng(3)
+    stack = rng.uniform(0, 200, (frames, 24, 20)) + np.arange(frames).reshape(-1, 1, 1)*10
+    return stack.astype(dtype)
+
+def test_noise_stack_seed():
+    stack = frame_stack()
+    for noise_type in ['gaussian', 'rician', 'kspace']:
+        output = noise_stack(stack, noise_type, 0.2, seeds = 7)
+        # chunks of one frame and of two frames
+        for max_mb in [0.001, 0.01]:
+            assert np.array_equal(output, noise_stack(stack, noise_type, 0.2, seeds = 7, max_mb = max_mb))
+        assert not np.array_equal(output, noise_stack(stack, noise_type, 0.2, seeds = 8))
+        # a frame does not depend on the other frames of the stack
+        stats = noise_stack_stats(stack)
+        seeds = np.random.SeedSequence(7).spawn(len(stack))
+        assert np.array_equal(output[4:6], noise_stack(stack[4:6], noise_type, 0.2, stats, seeds[4:6]))
+
+def test_noise_folder_workers( tmp_path ):
+    stack = frame_stack(7)
+    folder_input = str(tmp_path / 'image')
+    os.makedirs(folder_input)
+    for k, frame in enumerate(stack):
+        sitk.WriteImage(sitk.GetImageFromArray(frame), os.path.join(folder_input, 'image_{:04d}.nii'.format(k)))
+
+    outputs = []
+    for workers in [1, 3]:
+        folder_output = str(tmp_path / 'noise{}'.format(workers))
+        opt = dict([('type', 'gaussian'), ('stddev', 0.2), ('percentage', True), ('seed', 11),
+                    ('workers', workers), ('max_mb', 0.05)])        # four frames per task
+        files = noise_folder(folder_input, folder_output, opt)
+        assert len(files) == len(stack)
+        outputs.append(np.stack([sitk.GetArrayFromImage(sitk.ReadImage(f)) for f in sorted(files)]))
+    assert np.array_equal(outputs[0], outputs[1])
+
+def test_stack_stats():
+    stack = frame_stack(dtype = np.float64)
+    values = stack.reshape(-1)
+    for max_mb in [256, 0.005]:
+        stats = noise_stack_stats(stack, max_mb = max_mb)
+        assert stats['min'] == values.min() and stats['max'] == values.max()
+        assert stats['count'] == values.size
+        assert np.isclose(stats['mean'], values.mean())
+        assert np.isclose(stats['sigma'], values.std(ddof = 1))
+
+    # statistics of each frame image merged
+    merged = noise_merge_stats([noise_image_stats(sitk.GetImageFromArray(frame)) for frame in stack])
+    for key in ['min', 'max', 'mean', 'sigma', 'count']:
+        assert np.isclose(merged[key], stats[key])
+    per_frame = noise_stack_stats(stack, per_frame = True)
+    assert np.allclose(per_frame['sigma'], stack.reshape(len(stack), -1).std(axis = 1, ddof = 1))
@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+# Reference to phase deformation fields composed from the sequential registrations (video.py)
+
+import os
+import sys
+import numpy as np
+import SimpleITK as sitk
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src'))
+from folder import listdir_fullpath, filter_folders_prefix
+from image import shortest_path_of_image_sequence
+from video import (compose_phase_dfield, compose_phase_dfields, changed_phase_dfields, read_dfield_compose,
+                   path_to_compose_transform_files, phase_dfield_name)
+
+PHASES = 4
+
+def write_dfield( file, rng ):
+    # smooth displacement field of a small grid (mm)
+    size = [10, 9, 8]
+    z, y, x = np.meshgrid(*[np.linspace(0, np.pi, n) for n in size[::-1]], indexing = 'ij')
+    a = rng.uniform(-0.8, 0.8, 3)
+    array = np.stack([a[0]*np.sin(x)*np.sin(y), a[1]*np.sin(y)*np.sin(z), a[2]*np.sin(x)*np.sin(z)], axis = -1)
+    image = sitk.GetImageFromArray(array, isVector = True)
+    image.SetSpacing([1.5, 1.5, 2.0])
+    image.SetOrigin([-3.0, 2.0, 1.0])
+    sitk.WriteImage(image, file)
+
+def sequential_model( folder, seed = 0 ):
+    rng = np.random.default_rng(seed)
+    folder_seq = os.path.join(folder, 'seq')
+    os.makedirs(folder_seq, exist_ok = True)
+    for k in range(PHASES):
+        for a, b in [(k, (k + 1) % PHASES), ((k + 1) % PHASES, k)]:
+            prefix = '{:02d}to{:02d}_'.format(a, b)
+            for name in ['0Warp.nii.gz', '0InverseWarp.nii.gz']:
+                write_dfield(os.path.join(folder_seq, prefix + name), rng)
+            with open(os.path.join(folder_seq, prefix + 'key.txt'), 'w') as f:
+                f.write('{}{}\n'.format(prefix, seed))
+    return listdir_fullpath(folder_seq)
+
+def test_compose_matches_chain( tmp_path ):
+    files = filter_folders_prefix(['Warp.'], sequential_model(str(tmp_path)))
+    for phase in range(1, PHASES):
+        dfield = compose_phase_dfield(files, 0, phase, PHASES)
+        path = shortest_path_of_image_sequence(list(range(PHASES)), 0, phase)
+        chain = read_dfield_compose(path_to_compose_transform_files(path, files, False), amplitude = 1.0)
+        composed = sitk.DisplacementFieldTransform(sitk.Image(dfield))
+        for index in [(0, 0, 0), (3, 4, 5), (9, 8, 7), (5, 2, 1)]:
+            point = dfield.TransformIndexToPhysicalPoint(index)
+            assert np.allclose(composed.TransformPoint(point), chain.TransformPoint(point), atol = 1e-6)
+
+def test_recompose_changed_registrations( tmp_path ):
+    folder = str(tmp_path)
+    sequential_model(folder, seed = 0)
+    assert len(compose_phase_dfields(folder, 0, PHASES)) == PHASES - 1
+    assert compose_phase_dfields(folder, 0, PHASES) == []          # current fields are kept
+    folder_phase = os.path.join(folder, 'phase')
+    assert changed_phase_dfields(folder_phase, filter_folders_prefix(['Warp.'],
+                listdir_fullpath(os.path.join(folder, 'seq'))), 0, PHASES) == []
+
+    # registration 01to02 again (new key): only the fields of the chains through it change
+    with open(os.path.join(folder, 'seq', '01to02_key.txt'), 'w') as f:
+        f.write('new key\n')
+    files = filter_folders_prefix(['Warp.'], listdir_fullpath(os.path.join(folder, 'seq')))
+    changed = changed_phase_dfields(folder_phase, files, 0, PHASES)
+    assert changed == [2]
+    written = compose_phase_dfields(folder, 0, PHASES)
+    assert written == [os.path.join(folder, 'phase/', phase_dfield_name(2, 0))]
+    assert changed_phase_dfields(folder_phase, files, 0, PHASES) == []
@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+# Registration keys and cache (registration.py)
+
+import os
+import sys
+import shutil
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src'))
+from registration import registration_key, check_registration, registration_job, store_registration
+
+CMD = 'antsRegistration --dimensionality 3 --output [{output},{output}Warped.nii.gz] ' \
+      '--metric MI[{fixed},{moving},1,32] --convergence [100x70x50,1e-6,10]'
+OUTPUTS = ['0Warp.nii.gz', '0InverseWarp.nii.gz']
+
+def write_file( file, text ):
+    os.makedirs(os.path.dirname(file), exist_ok = True)
+    with open(file, 'w') as f:
+        f.write(text)
+
+def images( folder, moving = 'moving' ):
+    fixed, moving_file = os.path.join(folder, 'fixed.nii'), os.path.join(folder, 'moving.nii')
+    write_file(fixed, 'fixed')
+    write_file(moving_file, moving)
+    return fixed, moving_file
+
+def key( fixed, moving, output, cmd = CMD ):
+    return registration_key([fixed, moving], cmd.format(output = output, fixed = fixed, moving = moving), output)
+
+def test_registration_key( tmp_path ):
+    fixed, moving = images(str(tmp_path / 'a'))
+    output = str(tmp_path / 'a' / 'seq' / '00to01_')
+    key_a = key(fixed, moving, output)
+    assert key_a is not None and key_a == key(fixed, moving, output)
+
+    # same images and parameters in another folder
+    fixed_b, moving_b = images(str(tmp_path / 'b'))
+    assert key(fixed_b, moving_b, str(tmp_path / 'b' / 'out_')) == key_a
+
+    # other input, other parameter, missing input
+    fixed_c, moving_c = images(str(tmp_path / 'c'), moving = 'other moving')
+    assert key(fixed_c, moving_c, output) != key_a
+    assert key(fixed, moving, output, CMD.replace('100x70x50', '100x70x20')) != key_a
+    assert key(fixed, str(tmp_path / 'missing.nii'), output) is None
+
+def test_check_registration( tmp_path ):
+    folder = str(tmp_path / 'seq')
+    cache_dir = str(tmp_path / 'cache')
+    prefix = '00to01_'
+    fixed, moving = images(str(tmp_path))
+    key_a = key(fixed, moving, os.path.join(folder, prefix))
+    key_b = key(fixed, moving, os.path.join(folder, prefix), CMD.replace('MI', 'CC'))
+
+    assert check_registration(folder, prefix, OUTPUTS, key_a, False, None)      # no registration
+    for f in OUTPUTS:
+        write_file(os.path.join(folder, prefix + f), 'warp a ' + f)
+    assert not check_registration(folder, prefix, OUTPUTS, key_a, False, None)  # unknown key: kept
+
+    # finished registration with its key file, added to the cache
+    job = registration_job(prefix, 'cmd', folder, log = False)
+    job.update([('outputs', OUTPUTS), ('key', key_a), ('cache_dir', cache_dir)])
+    store_registration(job)
+    assert not check_registration(folder, prefix, OUTPUTS, key_a, False, cache_dir)
+    assert check_registration(folder, prefix, OUTPUTS, key_a, True, cache_dir)  # overwrite
+    assert check_registration(folder, prefix, OUTPUTS, key_b, False, cache_dir) # other parameters
+
+    # registration with other parameters in the folder (outputs removed before the registration
+    # as in run_registration_job, they are links of the cache): the cached key is restored
+    for f in OUTPUTS:
+        os.remove(os.path.join(folder, prefix + f))
+        write_file(os.path.join(folder, prefix + f), 'warp b ' + f)
+    write_file(os.path.join(folder, prefix + 'key.txt'), key_b + '\n')
+    assert not check_registration(folder, prefix, OUTPUTS, key_a, False, cache_dir)
+    with open(os.path.join(folder, prefix + OUTPUTS[0]), 'r') as f:
+        assert f.read() == 'warp a ' + OUTPUTS[0]
+    with open(os.path.join(folder, prefix + 'key.txt'), 'r') as f:
+        assert f.read().strip() == key_a
+
+    # without cache the registration runs again
+    shutil.rmtree(cache_dir)
+    assert check_registration(folder, prefix, OUTPUTS, key_b, False, cache_dir)
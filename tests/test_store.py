@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+# Frame store (store.py): resume of an interrupted video
+
+import os
+import sys
+import numpy as np
+import SimpleITK as sitk
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src'))
+from store import open_frame_store, write_store_frame, close_frame_store, read_frame_store
+
+STREAMS = ['image', 'tumor']
+NUM_FRAMES = 8
+
+def store_options():
+    return dict([('view', 'sagittal'), ('slice', 10), ('video_time', 2.0), ('frame_per_sec', 4),
+                 ('store_chunk', 2), ('store_compress', False), ('store_bits', 0)])
+
+def frame_images( it ):
+    image = np.full((6, 5), float(it), dtype = np.float32)
+    image[0, 0] = -it
+    return [sitk.GetImageFromArray(image), sitk.GetImageFromArray((image > 2).astype(np.uint8))]
+
+def frame_time( it ):
+    return dict([('it', it), ('t', it/4.0), ('cycle', it/4.0), ('floor_phase', 0), ('ceil_phase', 1),
+                 ('proportion', 0.5), ('amplitude', 1.0)])
+
+def write_frames( folder, frames ):
+    store = open_frame_store(folder, STREAMS, store_options(), NUM_FRAMES)
+    for it in frames:
+        if it in store['done']: continue
+        write_store_frame(store, frame_time(it), frame_images(it))
+    close_frame_store(store)
+    return store
+
+def check_frames( folder, frames ):
+    images, info = read_frame_store(folder, 'image')
+    for it in range(NUM_FRAMES):
+        expected = sitk.GetArrayFromImage(frame_images(it)[0]) if it in frames else 0
+        assert np.array_equal(images[it], np.zeros_like(images[it]) + expected)
+
+def test_resume_interrupted_flush( tmp_path ):
+    folder = str(tmp_path / 'store')
+    write_frames(folder, range(6))
+    # interrupted flush: partial manifest line and chunk of frames 4 and 5 not written
+    with open(os.path.join(folder, 'manifest.jsonl'), 'a') as f:
+        f.write('{"it": 3, "broken')
+    os.remove(os.path.join(folder, 'chunk_000002.npz'))
+    check_frames(folder, [0, 1, 2, 3])
+
+    store = open_frame_store(folder, STREAMS, store_options(), NUM_FRAMES)
+    assert store['done'] == set([0, 1, 2, 3])
+    write_frames(folder, range(NUM_FRAMES))
+    check_frames(folder, range(NUM_FRAMES))
+
+def test_resume_corrupt_chunk( tmp_path ):
+    folder = str(tmp_path / 'store')
+    write_frames(folder, range(NUM_FRAMES))
+    # chunk of frames 2 and 3 with other data: the checksums do not match
+    file_chunk = os.path.join(folder, 'chunk_000001.npz')
+    np.savez(file_chunk, image = np.ones((2, 6, 5), np.float32), tumor = np.ones((2, 6, 5), np.uint8))
+    check_frames(folder, [0, 1, 4, 5, 6, 7])
+
+    store = open_frame_store(folder, STREAMS, store_options(), NUM_FRAMES)
+    assert store['done'] == set([0, 1, 4, 5, 6, 7])
+    write_frames(folder, range(NUM_FRAMES))
+    check_frames(folder, range(NUM_FRAMES))